@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+"""Compare timer dispatch throughput of polling the database for the soonest timer
+against preloading upcoming timers into a TimerHeap.
+
+The database is simulated by an in-memory table in which every query costs a fixed round trip latency.
+Time is simulated too: instead of sleeping until a timer expires, the clock jumps to it.
+
+Usage: python -m benchmarks.dispatch [--timers N] [--latency SECONDS] [--spacing SECONDS]
+"""
+
+import argparse
+import asyncio
+import bisect
+import collections
+import datetime
+import json
+import time
+
+from utils.scheduler import TimerHeap
+
+Timer = collections.namedtuple('Timer', 'guild_id channel_id message_id expires')
+
+class FakeTimerTable:
+	def __init__(self, timers, latency):
+		self.rows = sorted((t.expires, t.channel_id, t.message_id, t.guild_id) for t in timers)
+		self.latency = latency
+		self.queries = 0
+
+	async def _query(self):
+		self.queries += 1
+		await asyncio.sleep(self.latency)
+
+	@staticmethod
+	def _record(row):
+		expires, channel_id, message_id, guild_id = row
+		return dict(guild_id=guild_id, channel_id=channel_id, message_id=message_id, expires=expires)
+
+	async def get_active_timer(self):
+		await self._query()
+		return self.rows and Timer(**self._record(self.rows[0]))
+
+	async def get_expired_timers(self, before, limit):
+		await self._query()
+		i = bisect.bisect_right(self.rows, (before, float('inf')))
+		return [Timer(**self._record(row)) for row in self.rows[:min(i, limit)]]
+
+	async def get_timers_after(self, after, before, limit):
+		await self._query()
+		i = bisect.bisect_right(self.rows, (*after, float('inf')))
+		j = bisect.bisect_right(self.rows, (before, float('inf')))
+		return [self._record(row) for row in self.rows[i:min(j, i + limit)]]
+
+	async def delete_timers(self, timers):
+		await self._query()
+		doomed = {(t.channel_id, t.message_id) for t in timers}
+		self.rows = [row for row in self.rows if (row[1], row[2]) not in doomed]
+
+async def polling(table, lookahead, batch_size):
+	"""the old dispatcher: query for the soonest timer, wait for it, then handle everything due"""
+	dispatched = 0
+	while True:
+		timer = await table.get_active_timer()
+		if not timer:
+			return dispatched
+		now = timer.expires
+		timers = await table.get_expired_timers(now + lookahead, batch_size)
+		await table.delete_timers(timers)
+		dispatched += len(timers)
+
+async def preloading(table, lookahead, batch_size, window, preload_size):
+	heap = TimerHeap(timer_class=Timer, window=window, preload_size=preload_size)
+	dispatched = 0
+	now = START
+	while True:
+		if heap.needs_refill(now):
+			lower, upper = heap.refill_bounds(now)
+			heap.extend(await table.get_timers_after(lower, upper, preload_size), upper)
+		timer = heap.peek()
+		if timer is None:
+			if not table.rows:
+				return dispatched
+			# jump to the next refill
+			now = max(now, heap.next_refill() or now)
+			continue
+		now = timer.expires
+		timers = heap.pop_due(now + lookahead, batch_size)
+		await table.delete_timers(timers)
+		dispatched += len(timers)
+
+START = datetime.datetime(2020, 1, 1)
+
+def make_timers(n, spacing):
+	return [
+		Timer(guild_id=1, channel_id=i % 50, message_id=i, expires=START + datetime.timedelta(seconds=i * spacing))
+		for i in range(n)]
+
+async def run(name, coro_factory, timers, latency):
+	table = FakeTimerTable(timers, latency)
+	start = time.perf_counter()
+	dispatched = await coro_factory(table)
+	elapsed = time.perf_counter() - start
+	assert dispatched == len(timers), (name, dispatched)
+	return dict(
+		design=name,
+		timers=dispatched,
+		queries=table.queries,
+		seconds=round(elapsed, 4),
+		timers_per_second=round(dispatched / elapsed))
+
+async def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--timers', type=int, default=2_000)
+	parser.add_argument('--latency', type=float, default=0.0005, help='simulated DB round trip time')
+	parser.add_argument('--spacing', type=float, default=2.0, help='seconds between consecutive timers')
+	args = parser.parse_args()
+
+	timers = make_timers(args.timers, args.spacing)
+	lookahead = datetime.timedelta(seconds=1)
+	batch_size = 1000
+	window = datetime.timedelta(hours=1)
+
+	results = [
+		await run('polling', lambda table: polling(table, lookahead, batch_size), timers, args.latency),
+		await run(
+			'preloading',
+			lambda table: preloading(table, lookahead, batch_size, window, 10_000),
+			timers, args.latency),
+	]
+	print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+	asyncio.run(main())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+"""Show that the memory used to remember kept messages stays flat, however many channels and messages there are.
+
+Simulates messages arriving in many channels, a few of which also have commands sending messages that must be kept,
+some of which are never received (so their IDs would have leaked before).
+Memory use is reported at regular checkpoints, and should not grow with the number of messages.
+
+Usage: python -m benchmarks.keep [--channels N] [--messages N] [--checkpoints N]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import tracemalloc
+
+from utils.keep import KeptMessages
+
+async def simulate(args):
+	keep = KeptMessages(ttl=60, max_size=args.max_size)
+	rng = random.Random(0)
+	message_id = 0
+	checkpoint_every = args.messages // args.checkpoints
+	results = []
+
+	tracemalloc.start()
+	baseline = tracemalloc.get_traced_memory()[0]
+	for i in range(1, args.messages + 1):
+		channel_id = rng.randrange(args.channels)
+		message_id += 1
+		if i % 100 == 0:
+			# a command sends a message that must be kept
+			async with keep.sending(channel_id):
+				keep.add(channel_id, message_id)
+		# one in ten of those messages never arrives
+		if i % 1000 != 0:
+			await keep.consume(channel_id, message_id)
+
+		if i % checkpoint_every == 0:
+			results.append(dict(
+				messages=i,
+				channel_entries=len(keep.channels),
+				kept_ids=len(keep),
+				queued=len(keep.queue),
+				traced_bytes=tracemalloc.get_traced_memory()[0] - baseline))
+	tracemalloc.stop()
+	return results
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--channels', type=int, default=1_000_000)
+	parser.add_argument('--messages', type=int, default=2_000_000)
+	parser.add_argument('--checkpoints', type=int, default=10)
+	parser.add_argument('--max-size', type=int, default=10_000)
+	args = parser.parse_args()
+	results = asyncio.run(simulate(args))
+	print(json.dumps(results, indent=2))
+
+	# messages that are never received are only remembered up to max_size, so memory must level off
+	assert all(result['kept_ids'] <= args.max_size for result in results)
+	assert all(result['queued'] <= 2 * args.max_size for result in results)
+	assert results[-1]['traced_bytes'] <= 2 * results[len(results) // 2]['traced_bytes'] + 1024 ** 2
+
+if __name__ == '__main__':
+	main()
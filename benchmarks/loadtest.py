@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+
+"""Drive the timer cogs with synthetic messages and measure how well they keep up.
+
+Discord is simulated: messages are dispatched to the cogs as if they came from the gateway, and bot.http is replaced
+by a fake that enforces per-channel rate limits, reports them in X-RateLimit-* headers and answers with 429s
+(which, like discord.py, it waits out and retries) when they're exceeded.
+The database is real: a throwaway database is created on the given Postgres server, loaded with sql/schema.sql and
+sql/functions.sql, and dropped afterwards. Counting queries requires asyncpg 0.29 or later.
+
+Each scenario reports ingest throughput (messages per second until every timer was written), dispatch throughput
+(messages deleted per second, from the first expiry to the last deletion), deletion lag percentiles,
+the number of 429s, the number of queries made and the number of failed timer writes.
+Results are printed as JSON, so that runs can be compared. A scenario fails if some timers weren't persisted or
+some messages weren't deleted in time, in which case the exit status is 1.
+
+Usage: python -m benchmarks.loadtest [--dsn DSN] [--scenario NAME]... [--set CONFIG_KEY=VALUE]... [--output FILE]
+"""
+
+import argparse
+import ast
+import asyncio
+import collections
+import datetime
+import itertools
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+
+import asyncpg
+import discord
+
+from bot import Chrona
+from utils import metrics
+
+SQL_DIR = Path(__file__).parent.parent / 'sql'
+
+EXTENSIONS = ('cogs.core.db', 'cogs.core.commands')
+
+BASE_CONFIG = dict(
+	prefixes=['!'],
+	timer_change_emoji='⏲',
+	timer_disable_emoji='🚫',
+	timer_emojis=['🕛'],
+)
+
+def percentile(sorted_xs, p):
+	if not sorted_xs:
+		return None
+	return sorted_xs[min(len(sorted_xs) - 1, int(len(sorted_xs) * p))]
+
+class Snowflakes:
+	"""generates unique message IDs for the given times"""
+	def __init__(self):
+		self.counter = itertools.count()
+
+	def __call__(self, when=None):
+		# the low 22 bits of a snowflake are not part of its timestamp
+		return discord.utils.time_snowflake(when or datetime.datetime.utcnow()) + next(self.counter) % (1 << 22)
+
+### fake Discord
+
+class FakeResponse:
+	def __init__(self, status, reason):
+		self.status = status
+		self.reason = reason
+
+class FakeBucket:
+	def __init__(self, limit, per):
+		self.limit = limit
+		self.per = per
+		self.remaining = limit
+		self.reset_at = 0.0
+
+	def take(self, now):
+		"""return how long to wait before retrying, or 0 if the request may go ahead"""
+		if now >= self.reset_at:
+			self.remaining = self.limit
+			self.reset_at = now + self.per
+		if self.remaining <= 0:
+			return self.reset_at - now
+		self.remaining -= 1
+		return 0
+
+class FakeHTTP:
+	"""Stands in for discord.py's HTTPClient, implementing only the endpoints that Chrona deletes messages with."""
+	LIMITS = {'delete': (5, 1.0), 'bulk_delete': (1, 1.0)}
+	GLOBAL_LIMIT = 50
+
+	def __init__(self, *, latency):
+		self.latency = latency
+		self.buckets = {}
+		self.global_bucket = FakeBucket(self.GLOBAL_LIMIT, 1.0)
+		# called with ((route, channel_id), headers) after every response, as the rate limiter's trace hook would be
+		self.listeners = []
+		self.existing = set()
+		self.deleted_at = {}  # message_id: datetime
+		self.requests = collections.Counter()
+		self.rate_limited = 0
+
+	async def _request(self, route, channel_id):
+		key = route, channel_id
+		bucket = self.buckets.get(key)
+		if bucket is None:
+			bucket = self.buckets[key] = FakeBucket(*self.LIMITS[route])
+		while True:
+			await asyncio.sleep(self.latency)
+			self.requests[route] += 1
+			now = time.monotonic()
+			retry_after = max(self.global_bucket.take(now), bucket.take(now))
+			if not retry_after:
+				break
+			self.rate_limited += 1
+			await asyncio.sleep(retry_after)
+
+		headers = {
+			'X-RateLimit-Limit': str(bucket.limit),
+			'X-RateLimit-Remaining': str(bucket.remaining),
+			'X-RateLimit-Reset-After': str(max(0, bucket.reset_at - now)),
+		}
+		for listener in self.listeners:
+			listener(key, headers)
+
+	def _delete(self, message_ids):
+		now = datetime.datetime.utcnow()
+		for message_id in message_ids:
+			self.existing.discard(message_id)
+			self.deleted_at[message_id] = now
+
+	async def delete_message(self, channel_id, message_id, *, reason=None):
+		await self._request('delete', channel_id)
+		if message_id not in self.existing:
+			raise discord.NotFound(FakeResponse(404, 'Not Found'), 'Unknown Message')
+		self._delete((message_id,))
+
+	async def delete_messages(self, channel_id, message_ids, *, reason=None):
+		await self._request('bulk_delete', channel_id)
+		if not 2 <= len(message_ids) <= 100:
+			raise discord.HTTPException(FakeResponse(400, 'Bad Request'), 'Invalid Form Body')
+		# unknown messages are ignored by this endpoint
+		self._delete(message_ids)
+
+	async def close(self):
+		pass
+
+class FakeGuild:
+	def __init__(self, id):
+		self.id = id
+
+class FakeUser:
+	def __init__(self, id):
+		self.id = id
+		self.bot = False
+
+	@property
+	def mention(self):
+		return f'<@{self.id}>'
+
+class FakeMessage:
+	def __init__(self, id, channel, author):
+		self.id = id
+		self.channel = channel
+		self.guild = channel.guild
+		self.author = author
+
+	@property
+	def created_at(self):
+		return discord.utils.snowflake_time(self.id)
+
+class FakeChannel:
+	def __init__(self, id, guild, bot):
+		self.id = id
+		self.guild = guild
+		self.bot = bot
+		self.messages = []
+
+	@property
+	def mention(self):
+		return f'<#{self.id}>'
+
+	def permissions_for(self, member):
+		return discord.Permissions.all()
+
+	def add_message(self, author, message_id=None):
+		message = FakeMessage(message_id or self.bot.snowflakes(), self, author)
+		self.messages.append(message)
+		self.bot.http.existing.add(message.id)
+		return message
+
+	async def send(self, content):
+		message = self.add_message(self.bot.fake_user)
+		# the gateway echoes our own messages back to us
+		self.bot.dispatch('message', message)
+		return message
+
+	async def history(self, *, limit=None, before=None, after=None, oldest_first=None):
+		for message in sorted(self.messages, key=lambda message: message.id):
+			if message.id not in self.bot.http.existing:
+				continue
+			if after is not None and message.id <= after.id:
+				continue
+			if before is not None and message.id >= before.id:
+				continue
+			yield message
+
+class FakeContext:
+	def __init__(self, message):
+		self.message = message
+		self.author = message.author
+		self.channel = message.channel
+
+class LoadTestBot(Chrona):
+	def __init__(self, *, config, pool, latency):
+		super().__init__(config={**BASE_CONFIG, **config})
+		self.pool = pool
+		self.http = FakeHTTP(latency=latency)
+		self.snowflakes = Snowflakes()
+		self.fake_user = FakeUser(self.snowflakes())
+		self.fake_channels = {}
+		self.event_tasks = set()
+		# failed timer writes, over every time the cogs were started
+		self.write_failures = 0
+
+	def get_channel(self, id):
+		return self.fake_channels.get(id)
+
+	def make_channels(self, n, guilds=1):
+		guilds = [FakeGuild(self.snowflakes()) for _ in range(guilds)]
+		channels = [FakeChannel(self.snowflakes(), guilds[i % len(guilds)], self) for i in range(n)]
+		self.fake_channels.update((channel.id, channel) for channel in channels)
+		return channels
+
+	async def wait_until_ready(self):
+		pass
+
+	async def on_message(self, message):
+		# there are no commands to process
+		pass
+
+	def _schedule_event(self, *args, **kwargs):
+		task = super()._schedule_event(*args, **kwargs)
+		self.event_tasks.add(task)
+		task.add_done_callback(self.event_tasks.discard)
+		return task
+
+	async def wait_for_events(self):
+		while self.event_tasks:
+			await asyncio.gather(*self.event_tasks)
+
+	@property
+	def db(self):
+		return self.cogs['DisappearingMessagesDatabase']
+
+	@property
+	def timers_cog(self):
+		return self.cogs['DisappearingMessages']
+
+	async def start_cogs(self):
+		for extension in EXTENSIONS:
+			self.load_extension(extension)
+		self.http.listeners = [self.timers_cog.deleter.ratelimits.update]
+		self.write_failures -= self._write_failures_metric()
+
+	def _write_failures_metric(self):
+		# reloading the extension makes a new metric, so this is read after every load and before every unload
+		return metrics.REGISTRY.metrics['chrona_timer_write_failures_total'].children[()].value
+
+	async def stop_cogs(self):
+		# like close(), but the bot may be started again
+		for cog in reversed(tuple(self.cogs.values())):
+			shutdown = getattr(cog, 'shutdown', None)
+			if shutdown is not None:
+				await shutdown()
+		self.write_failures += self._write_failures_metric()
+		for extension in reversed(EXTENSIONS):
+			self.unload_extension(extension)
+
+### harness
+
+class QueryCounter:
+	def __init__(self):
+		self.count = 0
+
+	async def init_connection(self, conn):
+		conn.add_query_logger(self.log_query)
+
+	def log_query(self, record):
+		self.count += 1
+
+class Run:
+	"""one scenario run: collects what it needs to report"""
+	def __init__(self, bot, queries):
+		self.bot = bot
+		self.queries = queries
+		self.queries_before = queries.count
+		self.expected = {}  # message_id: expires
+		self.ingest_started = None
+		self.ingest_seconds = None
+		self.unpersisted = None
+
+	def expect(self, message, expiry):
+		self.expected[message.id] = message.created_at + expiry
+
+	async def ingest(self, messages, expiry):
+		"""dispatch the messages as if they arrived from the gateway, then wait for their timers to be written"""
+		self.ingest_started = time.perf_counter()
+		for message in messages:
+			self.expect(message, expiry)
+			self.bot.dispatch('message', message)
+		await self.bot.wait_for_events()
+		await self.bot.timers_cog.ingest.join()
+		while len(self.bot.db.writer):
+			await self.bot.db.writer.flush()
+		self.ingest_seconds = time.perf_counter() - self.ingest_started
+		await self.check_persisted(expiry)
+
+	async def check_persisted(self, expiry):
+		"""count the timers that should be in the database by now but aren't.
+		Only timers that haven't expired yet are checked, as expired ones may have been dispatched and deleted.
+		"""
+		db = self.bot.db
+		if self.bot.timers_cog.sweeper is not None:
+			return  # no timers are stored per message
+		if db.memory_threshold is not None and expiry < db.memory_threshold:
+			return  # the timers are kept in memory only
+
+		now = datetime.datetime.utcnow()
+		pending = [message_id for message_id, expires in self.expected.items() if expires > now]
+		rows = await self.bot.pool.fetch('SELECT message_id FROM timers WHERE message_id = ANY ($1)', pending)
+		self.unpersisted = len(pending) - len(rows)
+
+	async def wait_for_deletions(self, timeout):
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			if self.expected.keys() <= self.bot.http.deleted_at.keys():
+				return
+			await asyncio.sleep(0.05)
+
+	def report(self, name, **params):
+		deleted_at = self.bot.http.deleted_at
+		lags = sorted(
+			max(0, (deleted_at[message_id] - expires).total_seconds())
+			for message_id, expires in self.expected.items()
+			if message_id in deleted_at)
+		result = dict(scenario=name, **params, messages=len(self.expected), deleted=len(lags))
+		if self.ingest_seconds is not None:
+			result['ingest_seconds'] = round(self.ingest_seconds, 4)
+			result['ingest_per_second'] = round(len(self.expected) / self.ingest_seconds)
+		if lags:
+			first_expiry = min(self.expected.values())
+			last_deletion = max(deleted_at[message_id] for message_id in self.expected if message_id in deleted_at)
+			window = max((last_deletion - first_expiry).total_seconds(), 1e-3)
+			result['dispatch_per_second'] = round(len(lags) / window)
+			result['lag_p50'] = round(percentile(lags, 0.5), 4)
+			result['lag_p99'] = round(percentile(lags, 0.99), 4)
+			result['lag_max'] = round(lags[-1], 4)
+		result['http_requests'] = dict(self.bot.http.requests)
+		result['rate_limited'] = self.bot.http.rate_limited
+		result['queries'] = self.queries.count - self.queries_before
+		result['timer_write_failures'] = self.bot.write_failures
+
+		failures = []
+		if self.unpersisted:
+			failures.append(f'{self.unpersisted} timers were not persisted')
+		if len(lags) < len(self.expected):
+			failures.append(f'only {len(lags)} of {len(self.expected)} messages were deleted')
+		result['failures'] = failures
+		return result
+
+### scenarios
+
+SCENARIOS = {}
+
+def scenario(func):
+	SCENARIOS[func.__name__] = func
+	return func
+
+async def set_timers(bot, channels, expiry):
+	"""set the timer of each channel without going through the command"""
+	for channel in channels:
+		await bot.db.set_expiry(channel, expiry)
+		# as the command would, so that watermark storage knows where to start sweeping from
+		await bot.db.set_last_timer_change(channel, bot.snowflakes())
+
+@scenario
+async def hot_channel(bot, run, args):
+	"""one channel receiving a burst of messages"""
+	expiry = datetime.timedelta(seconds=args.expiry)
+	[channel] = bot.make_channels(1)
+	await set_timers(bot, [channel], expiry)
+	user = FakeUser(bot.snowflakes())
+	await run.ingest([channel.add_message(user) for _ in range(args.messages)], expiry)
+	await run.wait_for_deletions(args.expiry + args.timeout)
+	return dict(channels=1)
+
+@scenario
+async def quiet_channels(bot, run, args):
+	"""many channels each receiving a few messages"""
+	expiry = datetime.timedelta(seconds=args.expiry)
+	channels = bot.make_channels(args.channels, guilds=max(1, args.channels // 10))
+	await set_timers(bot, channels, expiry)
+	user = FakeUser(bot.snowflakes())
+	per_channel = max(1, args.messages // args.channels)
+	messages = [channel.add_message(user) for _ in range(per_channel) for channel in channels]
+	await run.ingest(messages, expiry)
+	await run.wait_for_deletions(args.expiry + args.timeout)
+	return dict(channels=len(channels))
+
+@scenario
+async def restart_catch_up(bot, run, args):
+	"""messages sent while the bot was offline, half of which expired in the meantime"""
+	expiry = datetime.timedelta(seconds=args.expiry)
+	channels = bot.make_channels(args.channels, guilds=max(1, args.channels // 10))
+	user = FakeUser(bot.snowflakes())
+	now = datetime.datetime.utcnow()
+	per_channel = max(1, args.messages // args.channels)
+	for channel in channels:
+		await bot.db.set_expiry(channel, expiry)
+		await bot.db.set_last_timer_change(channel, bot.snowflakes(now - 2 * expiry))
+	# messages from the last 2 × expiry, oldest first
+	step = 2 * expiry / per_channel
+	for i in range(per_channel):
+		for channel in channels:
+			message = channel.add_message(user, bot.snowflakes(now - 2 * expiry + step * (i + 1) - step / 2))
+			run.expect(message, expiry)
+
+	# the cogs were already started, which would have caught up right away, so restart them
+	await bot.stop_cogs()
+	run.ingest_started = time.perf_counter()
+	await bot.start_cogs()
+	await bot.timers_cog.handle_missed_task
+	run.ingest_seconds = time.perf_counter() - run.ingest_started
+	await run.wait_for_deletions(args.expiry + args.timeout)
+	return dict(channels=len(channels))
+
+@scenario
+async def mass_timer_change(bot, run, args):
+	"""many channels having their timer set at once using the command, then receiving messages"""
+	expiry = datetime.timedelta(seconds=args.expiry)
+	channels = bot.make_channels(args.channels, guilds=max(1, args.channels // 10))
+	user = FakeUser(bot.snowflakes())
+	started = time.perf_counter()
+	commands = []
+	for channel in channels:
+		ctx = FakeContext(channel.add_message(user))
+		run.expect(ctx.message, expiry)
+		commands.append(bot.timers_cog.set_timer(ctx, channel, expiry=expiry))
+	await asyncio.gather(*commands)
+	timer_change_seconds = time.perf_counter() - started
+
+	per_channel = max(1, args.messages // args.channels)
+	await run.ingest([channel.add_message(user) for _ in range(per_channel) for channel in channels], expiry)
+	await run.wait_for_deletions(args.expiry + args.timeout)
+	return dict(channels=len(channels), timer_change_seconds=round(timer_change_seconds, 4))
+
+### main
+
+async def create_database(dsn):
+	name = f'chrona_loadtest_{uuid.uuid4().hex[:8]}'
+	conn = await asyncpg.connect(dsn)
+	try:
+		await conn.execute(f'CREATE DATABASE {name}')
+	finally:
+		await conn.close()
+
+	conn = await asyncpg.connect(dsn, database=name)
+	try:
+		for file in 'schema.sql', 'functions.sql':
+			await conn.execute((SQL_DIR / file).read_text())
+	finally:
+		await conn.close()
+	return name
+
+async def drop_database(dsn, name):
+	conn = await asyncpg.connect(dsn)
+	try:
+		await conn.execute(f'DROP DATABASE IF EXISTS {name}')
+	finally:
+		await conn.close()
+
+async def run_scenario(name, args, pool, queries, config):
+	await pool.execute(
+		'TRUNCATE expiries, timers, timer_counts, guild_timer_counts, failed_deletions, watermarks, last_timer_changes')
+	bot = LoadTestBot(config=config, pool=pool, latency=args.http_latency)
+	await bot.start_cogs()
+	try:
+		run = Run(bot, queries)
+		params = await SCENARIOS[name](bot, run, args)
+	finally:
+		await bot.stop_cogs()
+	return run.report(name, **params)
+
+def parse_setting(setting):
+	key, _, value = setting.partition('=')
+	try:
+		value = ast.literal_eval(value)
+	except (ValueError, SyntaxError):
+		pass  # a plain string
+	return key, value
+
+async def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument(
+		'--dsn', default=os.environ.get('CHRONA_LOADTEST_DSN', 'postgresql:///postgres'),
+		help='a Postgres server on which a throwaway database may be created')
+	parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='may be given more than once; default all')
+	parser.add_argument('--messages', type=int, default=5_000)
+	parser.add_argument('--channels', type=int, default=500)
+	parser.add_argument('--expiry', type=float, default=5.0, help='disappearing message timer, in seconds')
+	parser.add_argument('--timeout', type=float, default=60.0, help='how long to wait for deletions after expiry')
+	parser.add_argument('--http-latency', type=float, default=0.05, help='simulated Discord API round trip time')
+	parser.add_argument(
+		'--set', action='append', default=[], type=parse_setting, metavar='KEY=VALUE',
+		help='override a config.py setting, eg --set timer_storage=watermark')
+	parser.add_argument('--output', help='write results to this file instead of stdout')
+	args = parser.parse_args()
+	config = dict(args.set)
+
+	name = await create_database(args.dsn)
+	try:
+		queries = QueryCounter()
+		async with asyncpg.create_pool(args.dsn, database=name, init=queries.init_connection) as pool:
+			results = [
+				await run_scenario(scenario_name, args, pool, queries, config)
+				for scenario_name in args.scenario or SCENARIOS]
+	finally:
+		await drop_database(args.dsn, name)
+
+	output = json.dumps(dict(config=config, results=results), indent=2)
+	if args.output:
+		Path(args.output).write_text(output + '\n')
+	else:
+		print(output)
+	if any(result['failures'] for result in results):
+		raise SystemExit(1)
+
+if __name__ == '__main__':
+	asyncio.run(main())
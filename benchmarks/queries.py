@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""Measure the per-call cost of getting a query's SQL and running it, before and after queries were precompiled.
+
+Without --dsn, only the cost of getting the SQL is measured: rendering a Jinja macro on every call,
+against reading an attribute of the RenderedQueries made once at load time.
+With --dsn, the get_expiry query is also run against a temporary table on that Postgres server,
+as rendered text on a connection without a statement cache (so it's parsed and planned every time),
+as rendered text relying on asyncpg's statement cache, and as a statement prepared up front.
+
+Usage: python -m benchmarks.queries [--iterations N] [--dsn DSN]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import asyncpg
+import jinja2
+
+from utils.queries import RenderedQueries
+
+SQL_DIR = Path(__file__).parent.parent / 'sql'
+
+def load_module():
+	env = jinja2.Environment(loader=jinja2.FileSystemLoader(str(SQL_DIR)), line_statement_prefix='-- :')
+	return env.get_template('queries.sql').module
+
+def per_call(elapsed, iterations):
+	return round(elapsed / iterations * 1e6, 3)
+
+def bench_rendering(iterations):
+	module = load_module()
+	queries = RenderedQueries(module, create_timers_upsert=('create_timers', 'upsert'))
+	results = []
+	for name, get_sql in [
+		('render get_expiry per call', module.get_expiry),
+		('render create_timers per call', lambda: module.create_timers('upsert')),
+		('precompiled get_expiry', lambda: queries.get_expiry),
+		('precompiled create_timers', lambda: queries.create_timers_upsert),
+	]:
+		start = time.perf_counter()
+		for _ in range(iterations):
+			get_sql()
+		results.append(dict(benchmark=name, microseconds_per_call=per_call(time.perf_counter() - start, iterations)))
+	return results
+
+async def bench_queries(dsn, iterations):
+	module = load_module()
+	queries = RenderedQueries(module)
+	setup = (
+		'CREATE TEMPORARY TABLE expiries(guild_id BIGINT NOT NULL, channel_id BIGINT PRIMARY KEY, expiry INTERVAL NOT NULL);'
+		"INSERT INTO expiries SELECT 1, i, '1 minute' FROM generate_series(1, 1000) AS i")
+
+	async def timed(name, run):
+		start = time.perf_counter()
+		for i in range(iterations):
+			await run(i % 1000 + 1)
+		return dict(benchmark=name, microseconds_per_call=per_call(time.perf_counter() - start, iterations))
+
+	results = []
+	uncached = await asyncpg.connect(dsn, statement_cache_size=0)
+	try:
+		await uncached.execute(setup)
+		results.append(await timed(
+			'render + unprepared query',
+			lambda channel_id: uncached.fetchval(str(module.get_expiry()), channel_id)))
+	finally:
+		await uncached.close()
+
+	conn = await asyncpg.connect(dsn)
+	try:
+		await conn.execute(setup)
+		results.append(await timed(
+			'render + statement cache',
+			lambda channel_id: conn.fetchval(str(module.get_expiry()), channel_id)))
+		statement = await conn.prepare(queries.get_expiry)
+		results.append(await timed('precompiled + prepared statement', statement.fetchval))
+	finally:
+		await conn.close()
+	return results
+
+async def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--iterations', type=int, default=10_000)
+	parser.add_argument('--dsn', help='a Postgres server to run queries against')
+	args = parser.parse_args()
+
+	results = bench_rendering(args.iterations)
+	if args.dsn:
+		results.extend(await bench_queries(args.dsn, args.iterations))
+	print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+	asyncio.run(main())
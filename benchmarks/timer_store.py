@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""Compare the memory use and due timer selection throughput of holding upcoming timers as a list of Timer objects,
+as a TimerHeap, and as TimerColumns (with NumPy if it's installed, and with the array module).
+
+Timers expire at random over a window. Each step, every timer due by then is removed and grouped by channel,
+as the dispatcher does, until none are left.
+
+Usage: python -m benchmarks.timer_store [--timers N] [--channels N] [--steps N]
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import random
+import time
+import tracemalloc
+
+from cogs.core.db import Timer
+from utils import timer_columns
+from utils.deletion import group_by_channel
+from utils.scheduler import TimerHeap
+from utils.timer_columns import TimerColumns, from_micros, to_micros
+
+START = datetime.datetime(2020, 1, 1)
+WINDOW = datetime.timedelta(hours=1)
+
+def timer_data(args):
+	"""yield (guild_id, channel_id, message_id, expires in microseconds) of each timer, as new objects every time"""
+	rng = random.Random(0)
+	start = to_micros(START)
+	window = WINDOW // timer_columns.MICROSECOND
+	for i in range(args.timers):
+		channel = rng.randrange(args.channels)
+		yield 10 ** 17 + channel // 10, 2 * 10 ** 17 + channel, 3 * 10 ** 17 + i, start + rng.randrange(window)
+
+class TimerList:
+	def __init__(self, args):
+		self.timers = [
+			Timer(guild_id=guild_id, channel_id=channel_id, message_id=message_id, expires=from_micros(expires))
+			for guild_id, channel_id, message_id, expires in timer_data(args)]
+
+	def pop_due(self, before):
+		due = [timer for timer in self.timers if timer.expires <= before]
+		self.timers = [timer for timer in self.timers if timer.expires > before]
+		return group_by_channel(due)
+
+class Heap:
+	def __init__(self, args):
+		self.heap = TimerHeap(timer_class=Timer, window=WINDOW, preload_size=args.timers)
+		for guild_id, channel_id, message_id, expires in timer_data(args):
+			self.heap._push(from_micros(expires), channel_id, message_id, guild_id)
+
+	def pop_due(self, before):
+		return group_by_channel(self.heap.pop_due(before, len(self.heap)))
+
+class Columns:
+	def __init__(self, args, *, use_numpy):
+		self.columns = TimerColumns(use_numpy=use_numpy)
+		for guild_id, channel_id, message_id, expires in timer_data(args):
+			self.columns.add(guild_id, channel_id, message_id, expires)
+
+	def pop_due(self, before):
+		return self.columns.take_due(to_micros(before), len(self.columns))
+
+def bench(name, make, args):
+	gc.collect()
+	tracemalloc.start()
+	baseline = tracemalloc.get_traced_memory()[0]
+	start = time.perf_counter()
+	store = make(args)
+	build_seconds = time.perf_counter() - start
+	memory = tracemalloc.get_traced_memory()[0] - baseline
+	tracemalloc.stop()
+
+	popped = 0
+	start = time.perf_counter()
+	for step in range(1, args.steps + 1):
+		for channel in store.pop_due(START + WINDOW * step / args.steps).values():
+			popped += len(channel[1]) if isinstance(channel, tuple) else len(channel)
+	pop_seconds = time.perf_counter() - start
+	assert popped == args.timers, (name, popped)
+
+	return dict(
+		store=name,
+		megabytes=round(memory / 1024 ** 2, 1),
+		bytes_per_timer=round(memory / args.timers, 1),
+		build_seconds=round(build_seconds, 3),
+		pop_seconds=round(pop_seconds, 3),
+		timers_popped_per_second=round(args.timers / pop_seconds))
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--timers', type=int, default=1_000_000)
+	parser.add_argument('--channels', type=int, default=10_000)
+	parser.add_argument('--steps', type=int, default=100)
+	args = parser.parse_args()
+
+	stores = [
+		('list of Timers', TimerList),
+		('TimerHeap', Heap),
+		('TimerColumns (array)', lambda args: Columns(args, use_numpy=False)),
+	]
+	if timer_columns.numpy is not None:
+		stores.append(('TimerColumns (NumPy)', lambda args: Columns(args, use_numpy=True)))
+	results = [bench(name, make, args) for name, make in stores]
+	print(json.dumps(results, indent=2))
+
+if __name__ == '__main__':
+	main()
@@ -22,6 +22,7 @@ import jinja2
 from bot_bin.bot import Bot
 
 import utils
+from utils.message_cache import IndexedConnectionState
 
 class Chrona(Bot):
 	def __init__(self, *args, **kwargs):
@@ -31,9 +32,31 @@ class Chrona(Bot):
 			loader=jinja2.FileSystemLoader(str(here / 'sql')),
 			line_statement_prefix='-- :')
 
+	def _get_state(self, **options):
+		# the same state that AutoShardedClient would use, so that each shard's READY doesn't clear the others
+		return IndexedConnectionState(
+			dispatch=self.dispatch, handlers=self._handlers, hooks=self._hooks, syncer=self._syncer,
+			http=self.http, loop=self.loop, **options)
+
+	def get_cached_message(self, channel_id, message_id):
+		"""return the given message if it's in the message cache, otherwise None"""
+		messages = self._connection._messages
+		if messages is None:
+			return None
+		return messages.get(channel_id, message_id)
+
 	def queries(self, template_name):
 		return self.jinja_env.get_template(template_name).module
 
+	async def close(self):
+		# let cogs write out anything they have buffered while the pool is still open
+		# in the reverse of the order they were loaded in, so that cogs shut down before the cogs they depend on
+		for cog in reversed(tuple(self.cogs.values())):
+			shutdown = getattr(cog, 'shutdown', None)
+			if shutdown is not None:
+				await shutdown()
+		await super().close()
+
 	startup_extensions = (
 		'cogs.core.db',
 		'cogs.core.commands',
@@ -41,6 +64,7 @@ class Chrona(Bot):
 		'bot_bin.misc',
 		'bot_bin.debug',
 		'bot_bin.stats',
+		'cogs.metrics',
 		'bot_bin.sql',
 		'cogs.meta',
 	)
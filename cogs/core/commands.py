@@ -14,9 +14,9 @@
 # along with Chrona. If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
-import collections
-import contextlib
 import datetime
+import json
+import logging
 import math
 import os.path
 import time
@@ -28,56 +28,231 @@ from bot_bin.sql import connection
 from discord.ext import commands
 
 from utils.converter import Message
+from utils.deletion import MessageDeleter
+from utils.ingest import IngestQueue
+from utils.keep import KeptMessages
+from utils.retry import RetryQueue
+from utils.sweeper import WatermarkSweeper
 from utils.time import ShortTime
 
+logger = logging.getLogger(__name__)
+
+# how many messages to handle at once when catching up on missed messages
+CATCH_UP_PAGE_SIZE = 100
+# the most channels timer stats will list
+MAX_STATS_CHANNELS = 25
+# how long to wait on shutdown for messages still in the ingest queue to be handled
+SHUTDOWN_INGEST_TIMEOUT = 10
+
 class DisappearingMessages(commands.Cog):
 	def __init__(self, bot):
 		self.started_at = datetime.datetime.utcnow()
 		self.bot = bot
 		self.db = bot.cogs['DisappearingMessagesDatabase']
-		# XXX use a queue or an overriden client.on_message instead of this dumb racy hack
-		self.to_keep_locks = collections.defaultdict(asyncio.Lock)
-		self.to_keep = collections.defaultdict(set)
+		# messages that on_message should not set timers for
+		self.to_keep = KeptMessages(
+			ttl=self.bot.config.get('kept_message_ttl', 60),
+			max_size=self.bot.config.get('kept_message_max_size', 10_000))
+		self.deleter = MessageDeleter(
+			bot,
+			concurrency=self.bot.config.get('deletion_concurrency', 16),
+			global_rate=self.bot.config.get('deletion_global_rate', 40),
+			guild_concurrency=self.bot.config.get('deletion_guild_concurrency', 4))
+		self.deleter.retries = RetryQueue(
+			self.deleter, self.db,
+			base_delay=self.bot.config.get('deletion_retry_base_delay', 5),
+			max_delay=self.bot.config.get('deletion_retry_max_delay', 3600),
+			max_attempts=self.bot.config.get('deletion_retry_max_attempts', 10),
+			concurrency=self.bot.config.get('deletion_retry_concurrency', 2))
+		self.db.deleter = self.deleter
+		# whether changing a channel's timer also moves the timers of messages already sent there
+		self.retime_timers = self.bot.config.get('retime_on_timer_change', False)
+		if self.bot.config.get('timer_storage', 'rows') == 'watermark':
+			self.sweeper = WatermarkSweeper(bot, self.db, self.deleter)
+		else:
+			self.sweeper = None
+
+		self.ingest = IngestQueue(
+			self.bot.loop,
+			handle=self.handle_messages,
+			catch_up=self.catch_up_dropped,
+			max_size=self.bot.config.get('ingest_queue_size', 10_000),
+			workers=self.bot.config.get('ingest_workers', 4),
+			overflow=self.bot.config.get('ingest_overflow', 'coalesce'))
 
 		self.handle_missed_task = self.bot.loop.create_task(self.handle_missed())
 
 	async def handle_missed(self):
 		await self.bot.wait_until_ready()
 
+		if self.sweeper is not None:
+			# sweeping picks up from the watermark, so it handles missed messages by itself
+			now = datetime.datetime.utcnow()
+			for channel_id, _ in await self.db.get_expiries():
+				channel = self.bot.get_channel(channel_id)
+				if channel:
+					self.sweeper.schedule(channel, now)
+			return
+
 		cutoff = discord.utils.time_snowflake(self.started_at, high=True)
-		async for channel_id, message_id, expiry in self.db.latest_message_per_channel(cutoff):
+		semaphore = asyncio.Semaphore(self.bot.config.get('catch_up_concurrency', 8))
+
+		async def catch_up(channel, message_id, expiry):
+			async with semaphore:
+				try:
+					await self.catch_up_channel(channel, message_id, cutoff, expiry)
+				except discord.HTTPException as exc:
+					logger.warning('Catching up on channel %d failed: %r', channel.id, exc)
+
+		coros = []
+		skipped = 0
+		for channel_id, message_id, expiry in await self.db.latest_message_per_channel(cutoff):
 			channel = self.bot.get_channel(channel_id)
 			if not channel:
 				continue
-
-			to_purge = []
-			async for m in channel.history(after=discord.Object(message_id), limit=None):
-				if m.created_at < datetime.datetime.utcnow() - expiry:
-					to_purge.append(m)
-				else:
-					await self.db.create_timer(m, expiry)
-
-			await channel.delete_messages(to_purge)
+			# messages handled before our last shutdown don't need to be read again
+			seen = self.db.snapshot_position(channel_id, expiry)
+			if seen is not None and seen > message_id:
+				message_id = seen
+				skipped += 1
+			coros.append(catch_up(channel, message_id, expiry))
+
+		if skipped:
+			logger.info('Catching up on %d channels, %d of them from the snapshot', len(coros), skipped)
+		await asyncio.gather(*coros)
+		self.db.snapshot = None
+
+	async def catch_up_channel(self, channel, after, before, expiry):
+		"""handle every message in channel sent between the message IDs after and before while we were offline"""
+		history = channel.history(after=discord.Object(after), before=discord.Object(before), limit=None, oldest_first=True)
+		page = []
+		checkpointing = True
+		async for m in history:
+			page.append(m)
+			if len(page) == CATCH_UP_PAGE_SIZE:
+				checkpointing = await self._catch_up_page(channel, page, expiry, checkpointing)
+				page = []
+		if page:
+			await self._catch_up_page(channel, page, expiry, checkpointing)
+
+	async def _catch_up_page(self, channel, page, expiry, checkpointing):
+		"""handle a page of missed messages. return whether later pages may still be checkpointed."""
+		expired_before = datetime.datetime.utcnow() - expiry
+		to_purge = {}
+		checkpoint = None
+		for m in page:
+			if self.to_keep.holds(channel.id, m.id):
+				# eg a timer change announcement that we've yet to receive
+				continue
+			if m.created_at < expired_before:
+				to_purge[m.id] = m.created_at + expiry
+			else:
+				timer = await self.db.create_timer(m, expiry)
+				# a timer that's only kept in memory would be lost if we're interrupted,
+				# so catch-up must not resume from after its message
+				checkpointing = checkpointing and timer.message_id not in self.db.memory_timers
+			if checkpointing:
+				checkpoint = m.id
+
+		await self.deleter.delete_messages(channel.id, to_purge, guild_id=channel.guild.id)
+		# checkpoint, so that if we're interrupted, catch-up resumes from here.
+		# the new timers must be written first, otherwise they'd be lost.
+		if checkpoint is not None and await self.db.writer.flush():
+			await self.db.set_watermark(channel, checkpoint)
+		return checkpointing
+
+	async def shutdown(self):
+		"""called by the bot before the pool is closed"""
+		try:
+			await asyncio.wait_for(self.ingest.join(), SHUTDOWN_INGEST_TIMEOUT)
+		except asyncio.TimeoutError:
+			caught_up = False
+		else:
+			# any messages not yet caught up on must not be skipped next time
+			caught_up = self.handle_missed_task.done()
+		# the timers of the messages just handled
+		await self.db.writer.flush()
+		await self.db.write_snapshot(include_last_seen=caught_up and self.sweeper is None)
+		# the timers of messages waiting to be deleted are already gone, so they have to be saved for next time
+		save = self.deleter.close()
+		if save is not None:
+			await save
 
 	def cog_unload(self):
 		self.handle_missed_task.cancel()
+		dropped = self.ingest.close()
+		if dropped:
+			logger.warning(
+				'Dropped %d new messages that were still waiting to be handled. '
+				'They will be caught up on from channel history when next loaded.', dropped)
+		if self.sweeper is not None:
+			self.sweeper.close()
+		# if we're being reloaded, this saves the messages waiting to be deleted in the background
+		self.deleter.close()
+		self.db.deleter = None
 
 	@commands.Cog.listener()
 	async def on_message(self, message):
 		if not message.guild:
 			return
 
-		async with self.to_keep_locks[message.channel.id]:
-			with contextlib.suppress(LookupError):
-				self.to_keep[message.channel.id].remove(message.id)
-				# we wanted to keep the message. it has now been kept.
-				return
+		if await self.to_keep.consume(message.channel.id, message.id):
+			# we wanted to keep the message. it has now been kept.
+			return
+
+		await self.ingest.put(message)
 
-		expiry = await self.db.get_expiry(message.channel)
+	async def handle_messages(self, channel, message_ids):
+		"""set timers for new messages in a channel, oldest first"""
+		expiry = await self.db.get_expiry(channel)
+		if expiry is None:
+			return
+
+		if self.sweeper is not None:
+			self.sweeper.schedule(channel, discord.utils.snowflake_time(message_ids[0]) + expiry)
+		else:
+			self.db.create_channel_timers(channel, message_ids, expiry)
+
+	async def catch_up_dropped(self, channel, after, before):
+		"""handle messages that were dropped because the ingest queue was full"""
+		expiry = await self.db.get_expiry(channel)
 		if expiry is None:
 			return
 
-		await self.db.create_timer(message, expiry)
+		if self.sweeper is not None:
+			# sweeps read channel history anyway
+			self.sweeper.schedule(channel, discord.utils.snowflake_time(after) + expiry)
+			return
+		# like catching up on startup, don't read back to the timer change announcement or anything before it
+		last_timer_change = await self.db.get_last_timer_change(channel.id)
+		if last_timer_change is not None:
+			after = max(after, last_timer_change)
+		try:
+			await self.catch_up_channel(channel, after, before, expiry)
+		except discord.HTTPException as exc:
+			logger.warning('Catching up on dropped messages in channel %d failed: %r', channel.id, exc)
+
+	@commands.Cog.listener()
+	async def on_raw_message_delete(self, payload):
+		self.deleter.forget(payload.channel_id, (payload.message_id,))
+
+	@commands.Cog.listener()
+	async def on_raw_bulk_message_delete(self, payload):
+		self.deleter.forget(payload.channel_id, payload.message_ids)
+
+	@commands.Cog.listener()
+	async def on_guild_channel_delete(self, channel):
+		self.forget_channel(channel.id)
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild):
+		for channel in guild.channels:
+			self.forget_channel(channel.id)
+
+	def forget_channel(self, channel_id):
+		self.deleter.forget(channel_id)
+		if self.sweeper is not None:
+			self.sweeper.forget(channel_id)
 
 	@commands.group(invoke_without_command=True)
 	async def timer(self, ctx, channel: discord.TextChannel = None):
@@ -110,21 +285,29 @@ class DisappearingMessages(commands.Cog):
 
 		# for consistency with already having a timer, also delete the invoking message
 		# even when no timer is set
-		async with self.to_keep_locks[channel.id]:
-			self.to_keep[channel.id].add(ctx.message.id)
+		async with self.to_keep.sending(channel.id):
+			self.to_keep.add(channel.id, ctx.message.id)
 			await self.db.create_timer(ctx.message, expiry)
 
-		async with self.bot.pool.acquire() as conn, conn.transaction():
-			connection.set(conn)
-			await self.db.set_expiry(channel, expiry)
-
-			emoji = self.bot.config['timer_change_emoji']
-			async with self.to_keep_locks[channel.id]:
-				m = await channel.send(
-					f'{emoji} {ctx.author.mention} set the disappearing message timer to '
-					f'**{absolute_natural_timedelta(expiry.total_seconds())}**.')
-				self.to_keep[channel.id].add(m.id)
-			await self.db.set_last_timer_change(channel, m.id)
+		try:
+			async with self.bot.pool.acquire() as conn, conn.transaction():
+				connection.set(conn)
+				await self.db.set_expiry(channel, expiry)
+
+				emoji = self.bot.config['timer_change_emoji']
+				async with self.to_keep.sending(channel.id):
+					m = await channel.send(
+						f'{emoji} {ctx.author.mention} set the disappearing message timer to '
+						f'**{absolute_natural_timedelta(expiry.total_seconds())}**.')
+					self.to_keep.add(channel.id, m.id)
+				await self.db.set_last_timer_change(channel, m.id)
+		except BaseException:
+			# the transaction was rolled back, so the cached expiry is wrong
+			self.db.expiry_cache.discard(channel.id)
+			raise
+
+		if self.retime_timers and self.sweeper is None:
+			await self.db.retime_channel_timers(channel, expiry)
 
 	@timer.command(name='delete', aliases=['rm', 'del', 'remove', 'disable'])
 	async def delete_timer(self, ctx, channel: discord.TextChannel = None):
@@ -138,19 +321,75 @@ class DisappearingMessages(commands.Cog):
 		if not channel.permissions_for(ctx.author).manage_channels:
 			raise commands.MissingPermissions(['manage_channels'])
 
-		async with self.bot.pool.acquire() as conn, conn.transaction():
-			connection.set(conn)
-			await self.db.delete_expiry(channel)
-			await self.db.delete_last_timer_change(channel.id)
-
-		async with self.to_keep_locks[channel.id]:
+		try:
+			async with self.bot.pool.acquire() as conn, conn.transaction():
+				connection.set(conn)
+				await self.db.delete_expiry(channel)
+				await self.db.delete_last_timer_change(channel.id)
+				await self.db.delete_watermark(channel.id)
+		except BaseException:
+			self.db.expiry_cache.discard(channel.id)
+			raise
+
+		async with self.to_keep.sending(channel.id):
 			emoji = self.bot.config['timer_disable_emoji']
 			m = await channel.send(f'{emoji} {ctx.author.mention} disabled disappearing messages.')
-			self.to_keep[channel.id].add(m.id)
+			self.to_keep.add(channel.id, m.id)
+
+	@timer.group(name='stats', invoke_without_command=True)
+	@commands.guild_only()
+	async def timer_stats(self, ctx, count: int = 10):
+		"""Show how many messages are waiting to disappear in this server, and the channels with the most"""
+		if ctx.invoked_subcommand is not None:
+			return
+
+		totals = await self.db.get_timer_counts(ctx.guild.id)
+		channels = await self.db.busiest_channels(max(1, min(count, MAX_STATS_CHANNELS)), guild_id=ctx.guild.id)
+		# don't tell anyone about channels they can't see
+		visible = {channel.id for channel in ctx.guild.text_channels if channel.permissions_for(ctx.author).read_messages}
+		channels = [row for row in channels if row['channel_id'] in visible]
+		await ctx.send(self.format_timer_stats(
+			'this server', totals, channels, self.db.memory_timer_counts(ctx.guild.id), lambda row: f'<#{row["channel_id"]}>'))
+
+	@timer_stats.command(name='global')
+	@commands.is_owner()
+	async def global_timer_stats(self, ctx, count: int = 10):
+		"""Show how many messages are waiting to disappear, and the channels with the most, across every server"""
+		totals = await self.db.get_timer_counts()
+		channels = await self.db.busiest_channels(max(1, min(count, MAX_STATS_CHANNELS)))
+		await ctx.send(self.format_timer_stats(
+			'every server', totals, channels, self.db.memory_timer_counts(),
+			lambda row: f'`{row["channel_id"]}` (server `{row["guild_id"]}`)'))
+
+	def format_timer_stats(self, scope, totals, channels, memory_counts, describe_channel):
+		now = datetime.datetime.utcnow()
+
+		def when(expires):
+			if expires <= now:
+				return f'overdue by {natural_timedelta(expires)}'
+			return f'in {natural_timedelta(expires)}'
+
+		def describe_timers(pending, earliest, latest):
+			if not pending:
+				return 'no messages'
+			return f'**{pending}** {"message" if pending == 1 else "messages"}, next {when(earliest)}, last {when(latest)}'
+
+		lines = [f'Waiting to disappear in {scope}: {describe_timers(*totals) if totals else "no messages"}.']
+		memory = sum(memory_counts.values())
+		if memory:
+			lines.append(f'Plus **{memory}** short-lived messages only tracked in memory.')
+		if channels:
+			lines.append('Busiest channels:')
+			lines.extend(
+				f'{i}. {describe_channel(row)}: {describe_timers(row["pending"], row["earliest"], row["latest"])}'
+				for i, row in enumerate(channels, 1))
+		return '\n'.join(lines)
 
 	@commands.command(name='time-left', aliases=['when'])
 	async def time_left(self, ctx, message: Message):
 		expires_at = await self.db.get_message_expiration(message.id)
+		if expires_at is None and self.sweeper is not None:
+			expires_at = await self.sweeper.get_message_expiration(message)
 		if expires_at is None:
 			await ctx.send(f'{self.bot.config["timer_disable_emoji"]} That message will not disappear.')
 			return
@@ -163,16 +402,22 @@ class DisappearingMessages(commands.Cog):
 		emoji = self.timer_emoji(time_elapsed, expiry)
 
 		await self.db.create_or_update_timer(ctx.message, time_left)
-		async with self.to_keep_locks[ctx.channel.id]:
+		async with self.to_keep.sending(ctx.channel.id):
 			# time left messages disappear when the message does
 			m = await ctx.send(f'{emoji} That message will disappear in **{natural_timedelta(expires_at)}**.')
-			self.to_keep[ctx.channel.id].add(m.id)
+			self.to_keep.add(ctx.channel.id, m.id)
 			await self.db.create_timer(m, time_left)
 
+	@commands.command(hidden=True)
+	@commands.is_owner()
+	async def pipeline(self, ctx):
+		"""Show how far behind handling new messages and deleting expired ones are"""
+		stats = dict(ingest=self.ingest.stats(), deletion=self.deleter.stats())
+		await ctx.send(f'```json\n{json.dumps(stats, indent=2)}```')
+
 	@commands.Cog.listener()
-	async def on_message_expiration(self, timer):
-		with contextlib.suppress(discord.HTTPException):
-			await self.bot.http.delete_message(timer.channel_id, timer.message_id)
+	async def on_message_expirations(self, timers):
+		self.deleter.submit_timers(timers)
 
 	def timer_emoji(self, time_elapsed, expiry):
 		elapsed_coeff = max(0, min(1, time_elapsed.total_seconds() / expiry.total_seconds()))
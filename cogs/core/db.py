@@ -14,9 +14,15 @@
 # along with Chrona. If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import collections
+import contextlib
 import datetime
 import logging
-import os.path
+import os
+import re
+import socket
+import time
+import uuid
 
 import asyncpg
 import discord
@@ -24,10 +30,45 @@ from bot_bin.misc import natural_timedelta
 from bot_bin.sql import connection, optional_connection
 from discord.ext import commands
 
-from utils import sleep
+from utils import metrics, sleep, snapshot as snapshots, timer_columns
+from utils.cache import MISSING, ExpiryCache
+from utils.queries import RenderedQueries
+from utils.scheduler import ColumnarTimerHeap, TimerHeap
 
 logger = logging.getLogger(__name__)
 
+POOL_WAIT = metrics.Histogram(
+	'chrona_pool_acquire_seconds', 'Time spent waiting for a database connection', ['purpose'])
+TIMER_WRITE_LATENCY = metrics.Histogram(
+	'chrona_timer_write_latency_seconds',
+	'Time between a new timer being created and it being written, for the oldest timer of each batch')
+TIMERS_WRITTEN = metrics.Counter('chrona_timers_written_total', 'Timers written to the database')
+TIMER_WRITE_FAILURES = metrics.Counter('chrona_timer_write_failures_total', 'Failed attempts to write a batch of timers')
+DISPATCH_LATENESS = metrics.Histogram(
+	'chrona_timer_dispatch_lateness_seconds', 'Time between a timer expiring and it being dispatched')
+TIMERS_DISPATCHED = metrics.Counter('chrona_timers_dispatched_total', 'Timers dispatched')
+
+# the channel that notify_timer() in functions.sql notifies of new timers on
+TIMER_NOTIFICATION_CHANNEL = 'chrona_timers'
+# how often to check that the connection listening for notifications is still alive
+LISTEN_KEEPALIVE_INTERVAL = 30
+LISTEN_RETRY_DELAY = 5
+# how long to wait before restarting timer dispatching after a connection error
+DISPATCH_RETRY_DELAY = 5
+
+# how long to collect deleted messages before deleting their timers in one query
+DELETED_MESSAGES_DELAY = 1
+
+PARTITION_MAINTENANCE_INTERVAL = 60 * 60
+PARTITION_BOUND_RE = re.compile(r"FOR VALUES FROM \('(?P<start>[^']+)'\) TO \('(?P<end>[^']+)'\)")
+
+def quote_ident(name):
+	return '"{}"'.format(name.replace('"', '""'))
+
+def floor_time(dt, width):
+	"""return the latest multiple of width since datetime.min that's no later than dt"""
+	return datetime.datetime.min + (dt - datetime.datetime.min) // width * width
+
 # Using code provided by Rapptz under the MIT License
 # © 2015 Rapptz
 # https://raw.githubusercontent.com/Rapptz/RoboDanny/rewrite/cogs/reminder.py
@@ -67,114 +108,955 @@ class Timer:
 	def __hash__(self):
 		return hash(self.id)
 
+class TimerWriter:
+	"""Buffers new timers and writes them in batches.
+
+	The buffer is written once it holds max_size timers, or delay seconds after the first timer was added to it,
+	whichever comes first.
+	"""
+	RETRY_DELAY = 5
+
+	def __init__(self, db, *, max_size, delay):
+		self.db = db
+		self.max_size = max_size
+		self.delay = delay
+		# message_id: Timer
+		self.inserts = {}
+		self.upserts = {}
+		# the batch currently being written, so that it can still be looked up
+		self.writing = {}
+		self.write_task = None
+		# when the oldest timer in the buffer was added
+		self.oldest_added = None
+		self.nonempty = asyncio.Event()
+		self.full = asyncio.Event()
+		self.task = self.db.bot.loop.create_task(self._run())
+
+	def __len__(self):
+		return len(self.inserts) + len(self.upserts)
+
+	def close(self):
+		self.task.cancel()
+
+	def add(self, timer, *, upsert=False):
+		if upsert:
+			old = self.upserts.get(timer.message_id)
+			if old is None or timer.expires < old.expires:
+				self.upserts[timer.message_id] = timer
+		else:
+			self.inserts.setdefault(timer.message_id, timer)
+
+		if not self.nonempty.is_set():
+			self.oldest_added = time.perf_counter()
+			self.nonempty.set()
+		if len(self) >= self.max_size:
+			self.full.set()
+
+	def pending(self):
+		"""return every timer that may not have been written yet"""
+		return [*self.writing.values(), *self.inserts.values(), *self.upserts.values()]
+
+	def discard(self, timers):
+		"""drop buffered timers that no longer need to be written.
+		return (timer, upsert) of each one dropped, so that they can be added back.
+		"""
+		discarded = []
+		for timer in timers:
+			for buffer, upsert in (self.inserts, False), (self.upserts, True):
+				buffered = buffer.pop(timer.message_id, None)
+				if buffered is not None:
+					discarded.append((buffered, upsert))
+		return discarded
+
+	def discard_messages(self, message_ids):
+		for message_id in message_ids:
+			self.inserts.pop(message_id, None)
+			self.upserts.pop(message_id, None)
+
+	def discard_channels(self, channel_ids):
+		for buffer in self.inserts, self.upserts:
+			for message_id in [message_id for message_id, timer in buffer.items() if timer.channel_id in channel_ids]:
+				del buffer[message_id]
+
+	async def wait_written(self):
+		"""wait for the batch currently being written, if any"""
+		while self.write_task is not None:
+			await asyncio.shield(self.write_task)
+
+	def get_expiration(self, message_id):
+		"""return the soonest expiration of any buffered timer for this message, or None"""
+		timers = [d[message_id] for d in (self.inserts, self.upserts, self.writing) if message_id in d]
+		return min((timer.expires for timer in timers), default=None)
+
+	async def _run(self):
+		while True:
+			await self.nonempty.wait()
+			with contextlib.suppress(asyncio.TimeoutError):
+				await asyncio.wait_for(self.full.wait(), self.delay)
+			if not await self.flush():
+				await asyncio.sleep(self.RETRY_DELAY)
+
+	async def flush(self):
+		"""write out all buffered timers. return whether that succeeded."""
+		# the write is shielded so that cancelling a caller (eg the dispatcher) doesn't lose the batch
+		await self.wait_written()
+		if not self:
+			return True
+
+		inserts, self.inserts = self.inserts, {}
+		upserts, self.upserts = self.upserts, {}
+		self.nonempty.clear()
+		self.full.clear()
+		self.writing = {**inserts, **upserts}
+		self.write_task = task = self.db.bot.loop.create_task(self._write(inserts, upserts, self.oldest_added))
+		task.add_done_callback(self._write_done)
+		return await asyncio.shield(task)
+
+	def _write_done(self, task):
+		self.write_task = None
+		self.writing = {}
+
+	async def _write(self, inserts, upserts, oldest_added):
+		claims = self.db.claims
+		if claims:
+			# timers that are already in our scheduler must be claimed by us, so that no one else dispatches them
+			def args(timers):
+				return [
+					(timer.guild_id, timer.channel_id, timer.message_id, timer.expires, *self.db.claim_for(timer))
+					for timer in timers]
+		else:
+			def args(timers):
+				return [(timer.guild_id, timer.channel_id, timer.message_id, timer.expires) for timer in timers]
+
+		def columns(timers):
+			# the queries take one array per column
+			return [list(column) for column in zip(*args(timers))]
+
+		guild_ids = [timer.guild_id for timers in (inserts, upserts) for timer in timers.values()]
+		channel_ids = [timer.channel_id for timers in (inserts, upserts) for timer in timers.values()]
+
+		async def write(conn):
+			async with conn.transaction():
+				# the queries are precompiled strings, so asyncpg's statement cache prepares them once per connection
+				# an upsert into a partitioned table is an update and an insert, which lock count rows separately
+				if upserts and (inserts or self.db.partitioned):
+					await conn.execute(self.db.queries.lock_channel_timer_counts, guild_ids, channel_ids)
+					await conn.execute(self.db.queries.lock_guild_timer_counts, guild_ids)
+				if inserts:
+					await conn.execute(self.db.queries.create_timers_ignore, *columns(inserts.values()))
+				if upserts:
+					await conn.execute(self.db.queries.create_timers_upsert, *columns(upserts.values()))
+
+		try:
+			async with self.db.acquire('write') as conn:
+				try:
+					await write(conn)
+				except asyncpg.CheckViolationError:
+					if not self.db.partitioned:
+						raise
+					# some of the timers are further ahead than any partition made so far
+					connection.set(conn)
+					await self.db.create_timer_partitions(timer.expires for timer in [*inserts.values(), *upserts.values()])
+					await write(conn)
+		except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+			logger.error('Writing %d timers failed, will retry: %r', len(inserts) + len(upserts), exc)
+			TIMER_WRITE_FAILURES.inc()
+			# put them back, without clobbering anything added since
+			for message_id, timer in inserts.items():
+				self.inserts.setdefault(message_id, timer)
+			for message_id, timer in upserts.items():
+				old = self.upserts.get(message_id)
+				if old is None or timer.expires < old.expires:
+					self.upserts[message_id] = timer
+			if not self.nonempty.is_set():
+				self.oldest_added = oldest_added
+				self.nonempty.set()
+			return False
+
+		TIMER_WRITE_LATENCY.observe(time.perf_counter() - oldest_added)
+		TIMERS_WRITTEN.inc(len(inserts) + len(upserts))
+		return True
+
 class DisappearingMessagesDatabase(commands.Cog):
 	def __init__(self, bot):
 		self.bot = bot
-		self.queries = self.bot.queries('queries.sql')
+		# timers expiring this soon after the current one are handled along with it,
+		# so that they can share bulk delete calls
+		self.batch_lookahead = datetime.timedelta(seconds=self.bot.config.get('timer_batch_lookahead', 1))
+		self.batch_size = self.bot.config.get('timer_batch_size', 1000)
+		self.expiry_cache = ExpiryCache(self.bot.config.get('expiry_cache_size', 100_000))
+		self.writer = TimerWriter(
+			self,
+			max_size=self.bot.config.get('timer_write_batch_size', 500),
+			delay=self.bot.config.get('timer_write_delay', 0.1))
+		# 'columns' holds upcoming timers more compactly, for large preload windows
+		scheduler_class = TimerHeap
+		if self.bot.config.get('timer_store', 'heap') == 'columns':
+			if timer_columns.numpy is None:
+				raise RuntimeError("timer_store = 'columns' requires NumPy")
+			scheduler_class = ColumnarTimerHeap
+		self.scheduler = scheduler_class(
+			timer_class=Timer,
+			window=datetime.timedelta(seconds=self.bot.config.get('timer_preload_window', 60 * 60)),
+			preload_size=self.bot.config.get('timer_preload_size', 10_000))
+		# when several processes share the timers table, each one claims the timers it's going to dispatch
+		self.claims = self.bot.config.get('timer_dispatch', 'single') == 'claim'
+		self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+		self.claim_interval = datetime.timedelta(seconds=self.bot.config.get('timer_claim_interval', 30))
+		# claims not renewed for this long are considered abandoned, and may be taken over by other processes
+		self.claim_lease = self.claim_interval * 3
+		self.next_claim = None
+		self.partitioned = self.bot.config.get('timer_partitioning', False)
+		# timers shorter than this, in channels whose expiry is shorter than this, aren't stored in the database.
+		# after a restart, catch-up finds their messages again by reading channel history.
+		threshold = self.bot.config.get('timer_memory_threshold')
+		self.memory_threshold = threshold and datetime.timedelta(seconds=threshold)
+		self.memory_timers = {}  # message_id: Timer
+		variant = self.timer_query_variant()
+		self.queries = RenderedQueries(
+			self.bot.queries('queries.sql'),
+			create_timers_ignore=('create_timers', 'ignore', *variant),
+			create_timers_upsert=('create_timers', 'upsert', *variant),
+			busiest_channels_in_guild=('busiest_channels', 'guild'))
 		self.current_timer = None
-		self.have_timer = asyncio.Event()
+		# (channel_id, message_id) of deleted messages whose timers are yet to be deleted
+		self.deleted_messages = set()
+		self.deleted_messages_task = None
+		# the MessageDeleter, once the cog that owns it has loaded
+		self.deleter = None
+		# channel_id: ID of the latest message given a timer, so that catch-up can skip it after a restart
+		self.last_seen = {}
+		# what was restored from the snapshot written when we last shut down, if anything
+		self.snapshot = None
+		self.snapshot_written = False
+		self.snapshot_path = self.bot.config.get('snapshot_path')
+		if self.snapshot_path is not None:
+			self.snapshot_max_age = datetime.timedelta(seconds=self.bot.config.get('snapshot_max_age', 60 * 60))
+			self._restore_snapshot()
+		self._register_metrics()
+		self.load_expiries_task = self.bot.loop.create_task(self._load_expiries())
 		self.task = self.bot.loop.create_task(self._dispatch_timers())
+		if self.bot.config.get('timer_notifications', True):
+			self.listen_task = self.bot.loop.create_task(self._listen_for_timers())
+		else:
+			self.listen_task = None
+		if self.partitioned:
+			self.partition_width = datetime.timedelta(hours=self.bot.config.get('timer_partition_width', 24))
+			self.partition_ahead = datetime.timedelta(days=self.bot.config.get('timer_partition_ahead', 7))
+			self.partition_far_width = datetime.timedelta(days=self.bot.config.get('timer_partition_far_width', 30))
+			self.partition_task = self.bot.loop.create_task(self._maintain_partitions())
+
+	def _register_metrics(self):
+		metrics.CallbackGauge(
+			'chrona_scheduled_timers', 'Upcoming timers held in memory by the dispatcher', lambda: len(self.scheduler))
+		metrics.CallbackGauge(
+			'chrona_memory_timers', 'Short timers that are not stored in the database', lambda: len(self.memory_timers))
+		metrics.CallbackGauge(
+			'chrona_buffered_timers', 'New timers waiting to be written to the database', lambda: len(self.writer))
+		metrics.CallbackCounter(
+			'chrona_expiry_cache_hits_total', 'Channel expiry lookups answered from memory',
+			lambda: self.expiry_cache.hits)
+		metrics.CallbackCounter(
+			'chrona_expiry_cache_misses_total', 'Channel expiry lookups that had to query the database',
+			lambda: self.expiry_cache.misses)
+		metrics.CallbackGauge(
+			'chrona_pool_connections', 'Database connections by state',
+			lambda: {
+				('idle',): self.bot.pool.get_idle_size(),
+				('in_use',): self.bot.pool.get_size() - self.bot.pool.get_idle_size()},
+			['state'])
 
-	### dispatching
+	@contextlib.asynccontextmanager
+	async def acquire(self, purpose):
+		"""acquire a connection from the pool, keeping track of how long that took"""
+		start = time.perf_counter()
+		async with self.bot.pool.acquire() as conn:
+			POOL_WAIT.labels(purpose).observe(time.perf_counter() - start)
+			yield conn
+
+	### dispatching
 
 	def cog_unload(self):
+		self.load_expiries_task.cancel()
 		self.task.cancel()
+		if self.listen_task is not None:
+			self.listen_task.cancel()
+		if self.deleted_messages_task is not None:
+			self.deleted_messages_task.cancel()
+		if self.partitioned:
+			self.partition_task.cancel()
+		self.writer.close()
+		# don't lose any buffered timers if we're being reloaded
+		self.bot.loop.create_task(self.writer.flush())
+		if self.snapshot_path is not None and not self.snapshot_written:
+			# nor any memory timers. the buffered timers may not be written yet, so catch-up can't be skipped.
+			self._write_snapshot({})
+
+	async def shutdown(self):
+		"""called by the bot before the pool is closed"""
+		await self.writer.flush()
+		if self.claims:
+			# let other processes have our timers right away
+			await self.release_claims()
+
+	### warm starts
+
+	def _restore_snapshot(self):
+		try:
+			snapshot = snapshots.read(self.snapshot_path)
+		except FileNotFoundError:
+			return
+		except (OSError, ValueError) as exc:
+			logger.warning('Ignoring unreadable snapshot %s: %r', self.snapshot_path, exc)
+			return
+		finally:
+			# the snapshot only describes the moment we last shut down, so it mustn't be used again after a crash
+			with contextlib.suppress(FileNotFoundError):
+				os.remove(self.snapshot_path)
+
+		if datetime.datetime.utcnow() - snapshot.written_at > self.snapshot_max_age:
+			logger.info('Ignoring snapshot written at %s, as it is too old', snapshot.written_at)
+			return
+
+		for expires, guild_id, channel_id, message_id in snapshot.timers:
+			timer = Timer(guild_id=guild_id, channel_id=channel_id, message_id=message_id, expires=expires)
+			self.memory_timers[message_id] = timer
+			self.scheduler.schedule(timer)
+		# checked against the expiries table once it has loaded (see _load_expiries)
+		for channel_id, expiry in snapshot.expiries.items():
+			self.expiry_cache.set(channel_id, expiry)
+		self.snapshot = snapshot
+		logger.info('Restored %r', snapshot)
+
+	def snapshot_position(self, channel_id, expiry):
+		"""return the ID of the latest message in the channel that was handled before the snapshot we started from,
+		or None if that's not known. It's only trusted if the channel's expiry hasn't changed since.
+		"""
+		if self.snapshot is None or self.snapshot.expiries.get(channel_id) != expiry:
+			return None
+		return self.snapshot.last_seen.get(channel_id)
+
+	async def write_snapshot(self, *, include_last_seen=True):
+		"""write a snapshot of the memory timers, channel expiries and, if include_last_seen,
+		the latest message handled in each channel, for the next start to pick up from.
+		"""
+		if self.snapshot_path is None:
+			return
+		last_seen = self.last_seen if include_last_seen else {}
+		# messages in the snapshot won't be caught up on, so their timers must be written first
+		if last_seen and not await self.writer.flush():
+			logger.warning('Not recording handled messages in the snapshot, as writing timers failed')
+			last_seen = {}
+		self._write_snapshot(last_seen)
+
+	def _write_snapshot(self, last_seen):
+		expiries = {channel_id: expiry for channel_id, expiry in self.expiry_cache.entries.items() if expiry is not None}
+		try:
+			snapshots.write(self.snapshot_path, timers=self.memory_timers.values(), expiries=expiries, last_seen=last_seen)
+		except OSError as exc:
+			logger.error('Writing snapshot %s failed: %r', self.snapshot_path, exc)
+		else:
+			self.snapshot_written = True
+			logger.info(
+				'Wrote snapshot of %d memory timers, %d expiries and %d channel positions',
+				len(self.memory_timers), len(expiries), len(last_seen))
 
 	async def _dispatch_timers(self):
 		try:
 			while not self.bot.is_closed():
-				# for some reason this is necessary, even with @optional_connection
-				async with self.bot.pool.acquire() as conn:
-					connection.set(conn)
-					timer = self.current_timer = await self._wait_for_active_timer()
+				now = datetime.datetime.utcnow()
+				if self.scheduler.needs_refill(now) or self.next_claim is not None and now >= self.next_claim:
+					await self._refill_scheduler(now)
+
+				timer = self.current_timer = self.scheduler.peek()
+				wake_at = min(
+					filter(None, (timer and timer.expires, self.scheduler.next_refill(), self.next_claim)),
+					default=None)
+				if wake_at is None or wake_at > now:
+					await self._wait_for_change(wake_at and (wake_at - now).total_seconds())
+					continue
 
-				await timer.sleep_until_complete()
-				await self._handle_timer(timer)
-		except (OSError, discord.ConnectionClosed, asyncpg.PostgresConnectionError, asyncpg.InterfaceError) as exc:
-			logger.warning('Timer dispatching restarting due to %r', exc)
+				await self._handle_expired_timers()
+		except (OSError, discord.ConnectionClosed, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+			logger.warning('Timer dispatching restarting in %d seconds due to %r', DISPATCH_RETRY_DELAY, exc)
+			await asyncio.sleep(DISPATCH_RETRY_DELAY)
 			self.task.cancel()
 			self.task = self.bot.loop.create_task(self._dispatch_timers())
 
-	async def _wait_for_active_timer(self):
-		timer = await self.get_active_timer()
-		if timer is not None:
-			self.have_timer.set()
-			return timer
+	async def _wait_for_change(self, timeout):
+		"""wait until the soonest timer changes, or timeout seconds pass"""
+		changed = self.scheduler.changed
+		changed.clear()
+		with contextlib.suppress(asyncio.TimeoutError):
+			await asyncio.wait_for(changed.wait(), timeout)
 
-		# no timers found in the DB
-		self.have_timer.clear()
-		self.current_timer = None
-		await self.have_timer.wait()
-		return await self.get_active_timer()
+	async def _listen_for_timers(self):
+		"""keep a connection listening for timers created outside of this process, reconnecting whenever it drops"""
+		while True:
+			try:
+				async with self.bot.pool.acquire() as conn:
+					await self._listen(conn)
+			except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+				logger.warning('Listening for timer notifications failed, reconnecting: %r', exc)
+			await asyncio.sleep(LISTEN_RETRY_DELAY)
+
+	async def _listen(self, conn):
+		await conn.add_listener(TIMER_NOTIFICATION_CHANNEL, self._on_timer_notification)
+		try:
+			if self.scheduler.loaded_until is not None:
+				# anything created while we weren't listening was missed
+				self.scheduler.invalidate()
+			while True:
+				await asyncio.sleep(LISTEN_KEEPALIVE_INTERVAL)
+				# notifications can't be received on a dead connection, and nothing else would notice it's dead
+				await conn.execute('SELECT 1', timeout=LISTEN_KEEPALIVE_INTERVAL)
+		finally:
+			if not conn.is_closed():
+				await conn.remove_listener(TIMER_NOTIFICATION_CHANNEL, self._on_timer_notification)
+
+	def _on_timer_notification(self, conn, pid, channel, payload):
+		if payload.startswith('retime '):
+			self._on_channel_retimed(int(payload.split()[1]))
+			return
+
+		expires, channel_id, message_id, guild_id = payload.split()
+		timer = Timer(
+			guild_id=int(guild_id), channel_id=int(channel_id), message_id=int(message_id),
+			expires=datetime.datetime.fromisoformat(expires))
 
-	async def _handle_timer(self, timer):
-		await self.delete_timer(timer)
-		self.bot.dispatch('message_expiration', timer)
+		# our own timers are notified too, but they're already known, so they won't change anything
+		if self.claims:
+			# the timer may be someone else's, so it has to be claimed before it can be dispatched
+			current = self.current_timer
+			if self.scheduler.covers(timer.expires, timer.channel_id, timer.message_id) and (
+				current is None or timer.expires < current.expires
+			) and (timer.channel_id, timer.message_id) not in self.scheduler:
+				self.next_claim = datetime.datetime.utcnow()
+				self.scheduler.changed.set()
+		else:
+			# this wakes the dispatcher only if the timer is now the soonest
+			self.scheduler.add(timer)
+
+	async def _refill_scheduler(self, now):
+		lower, upper = self.scheduler.refill_bounds(now)
+		if self.claims:
+			async with self.acquire('refill') as conn, conn.transaction():
+				connection.set(conn)
+				await self.renew_claims(now + self.claim_lease)
+				rows = await self.claim_timers(upper, now, now + self.claim_lease, self.scheduler.preload_size)
+			# UPDATE ... RETURNING doesn't keep the order the timers were claimed in, but extend needs it
+			rows.sort(key=lambda row: (row['expires'], row['channel_id'], row['message_id']))
+			self.next_claim = now + self.claim_interval
+		else:
+			async with self.acquire('refill') as conn:
+				connection.set(conn)
+				rows = await self.get_timers_after(lower, upper, self.scheduler.preload_size)
+		# timers still in the write buffer weren't visible to the query
+		self.scheduler.extend(rows, upper, self.writer.pending())
+
+	async def _handle_expired_timers(self):
+		now = datetime.datetime.utcnow()
+		timers = self.scheduler.pop_due(now + self.batch_lookahead, self.batch_size)
+		# timers that expire before they're written never need to touch the DB
+		unwritten = self.writer.discard(timers)
+		memory = {timer.message_id: timer for timer in timers if self.memory_timers.pop(timer.message_id, None) is not None}
+		stored = [timer for timer in timers if timer.message_id not in memory]
+		if stored:
+			try:
+				await self.writer.wait_written()
+				async with self.acquire('dispatch') as conn:
+					connection.set(conn)
+					if self.claims:
+						deleted = await self.delete_claimed_timers(stored)
+					else:
+						await self.delete_timers(stored)
+			except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+				# the scheduler's window already covers these timers, so a refill wouldn't load them again
+				self._put_back(timers, memory, unwritten)
+				raise
+			if self.claims:
+				# only dispatch the timers that were still ours, and those that never made it to the database
+				unwritten_ids = {timer.message_id for timer, _ in unwritten}
+				timers = [
+					timer for timer in timers
+					if timer.message_id in memory or timer.message_id in unwritten_ids or timer.id in deleted]
+
+		for timer in timers:
+			# timers dispatched early because of batch_lookahead count as on time
+			DISPATCH_LATENESS.observe(max(0, (now - timer.expires).total_seconds()))
+		TIMERS_DISPATCHED.inc(len(timers))
+		if timers:
+			self.bot.dispatch('message_expirations', timers)
+
+	def _put_back(self, timers, memory, unwritten):
+		"""undo taking timers for dispatch, after failing to dispatch them"""
+		for message_id, timer in memory.items():
+			self.memory_timers.setdefault(message_id, timer)
+		for timer, upsert in unwritten:
+			self.writer.add(timer, upsert=upsert)
+		for timer in timers:
+			self.scheduler.schedule(timer)
 
 	async def create_timer(self, message, expiry):
-		return await self._create_timer(self.queries.create_timer(), message, expiry)
+		return await self._create_timer(message, expiry)
 
 	async def create_or_update_timer(self, message, expiry):
 		"""create a timer. if one already exists for this message, and the new expiration is sooner than the old
 		expiration, update the existing timer.
 		"""
-		return await self._create_timer(self.queries.create_timer('upsert'), message, expiry)
+		return await self._create_timer(message, expiry, upsert=True)
 
-	@optional_connection
-	async def _create_timer(self, query, message, expiry):
-		expires = message.created_at + expiry
-		timer = Timer(guild_id=message.guild.id, channel_id=message.channel.id, message_id=message.id, expires=expires)
+	def create_channel_timers(self, channel, message_ids, expiry):
+		"""create timers for several messages in the same channel, given only their IDs"""
+		for message_id in message_ids:
+			self._add_timer(channel, message_id, expiry)
 
-		await connection().execute(query, message.guild.id, message.channel.id, message.id, expires)
-		self.have_timer.set()
+	async def _create_timer(self, message, expiry, *, upsert=False):
+		return self._add_timer(message.channel, message.id, expiry, upsert=upsert)
 
-		if self.current_timer and timer.expires < self.current_timer.expires:
-			self.current_timer = timer
-			self.task.cancel()
-			self.bot.loop.create_task(self._dispatch_timers())
+	def _add_timer(self, channel, message_id, expiry, *, upsert=False):
+		expires = discord.utils.snowflake_time(message_id) + expiry
+		timer = Timer(guild_id=channel.guild.id, channel_id=channel.id, message_id=message_id, expires=expires)
+		if message_id > self.last_seen.get(channel.id, 0):
+			self.last_seen[channel.id] = message_id
+
+		if not upsert and self._memory_only(channel, expiry):
+			self.memory_timers[timer.message_id] = timer
+			self.scheduler.schedule(timer)
+			return timer
 
+		# a stored timer supersedes any in-memory one, whichever is sooner gets dispatched
+		self.memory_timers.pop(timer.message_id, None)
+		self.writer.add(timer, upsert=upsert)
+		# if this timer is sooner than the one the dispatcher is waiting on, this wakes it up
+		self.scheduler.add(timer, upsert=upsert)
 		return timer
 
-	### Database calls
+	def _memory_only(self, channel, expiry):
+		"""return whether a new timer can be kept in memory only.
+		That's only safe in channels whose own expiry is short too, since those are the channels that catch-up
+		reads the whole history of (see latest_message_per_channel in queries.sql).
+		"""
+		if self.memory_threshold is None or expiry >= self.memory_threshold:
+			return False
+		channel_expiry = self.expiry_cache.get(channel.id)
+		return channel_expiry is not MISSING and channel_expiry is not None and channel_expiry < self.memory_threshold
+
+	def timer_query_variant(self):
+		"""return the arguments to pass to the create_timers query macro to suit the timers table"""
+		return (('claimed',) if self.claims else ()) + (('partitioned',) if self.partitioned else ())
+
+	def claim_for(self, timer):
+		"""return the (claimed_by, claimed_until) a new timer should be written with"""
+		if self.scheduler.covers(timer.expires, timer.channel_id, timer.message_id):
+			return self.worker_id, datetime.datetime.utcnow() + self.claim_lease
+		return None, None
+
+	### re-timing
+
+	async def retime_channel_timers(self, channel, expiry):
+		"""move every pending timer in channel to expire expiry after its message was sent.
+		Timers that have thereby already expired are dispatched right away.
+		"""
+		# buffered timers would otherwise be written after the update, with their old expiry
+		await self.writer.flush()
+		now = datetime.datetime.utcnow()
+		async with self.acquire('retime') as conn:
+			connection.set(conn)
+			if self.partitioned:
+				# the timers may be moved further ahead than any partition made so far
+				await self.create_timer_partitions(
+					row['expires'] for row in await conn.fetch(self.queries.get_retimed_expirations, channel.id, expiry, now))
+			async with conn.transaction():
+				# one notification for the whole channel, rather than one per timer
+				await conn.execute(self.queries.suppress_timer_notifications)
+				rows = await conn.fetch(self.queries.retime_channel_timers, channel.id, expiry, now)
+				await conn.execute(self.queries.notify_channel_retimed, channel.id)
+		overdue = [Timer(**row) for row in rows]
+
+		for message_id, timer in list(self.memory_timers.items()):
+			if timer.channel_id != channel.id:
+				continue
+			timer.expires = timer.created_at + expiry
+			if timer.expires <= now:
+				del self.memory_timers[message_id]
+				overdue.append(timer)
+
+		self._on_channel_retimed(channel.id)
+		if overdue:
+			TIMERS_DISPATCHED.inc(len(overdue))
+			self.bot.dispatch('message_expirations', overdue)
+		logger.info('Re-timed channel %d, dispatching %d overdue timers', channel.id, len(overdue))
+		return overdue
+
+	def _on_channel_retimed(self, channel_id):
+		"""reload the timers of a channel whose timers were all moved, waking the dispatcher once"""
+		self.scheduler.discard_channels({channel_id})
+		for timer in self.memory_timers.values():
+			if timer.channel_id == channel_id:
+				self.scheduler.schedule(timer)
+		if self.claims:
+			# the update released the channel's claims, so they have to be claimed again
+			self.next_claim = datetime.datetime.utcnow()
+			self.scheduler.changed.set()
+		else:
+			self.scheduler.invalidate()
+
+	### cleaning up after deletions
+
+	@commands.Cog.listener()
+	async def on_raw_message_delete(self, payload):
+		self.forget_messages(payload.channel_id, (payload.message_id,))
+
+	@commands.Cog.listener()
+	async def on_raw_bulk_message_delete(self, payload):
+		self.forget_messages(payload.channel_id, payload.message_ids)
+
+	@commands.Cog.listener()
+	async def on_guild_channel_delete(self, channel):
+		await self.forget_channels({channel.id})
+
+	@commands.Cog.listener()
+	async def on_guild_remove(self, guild):
+		await self.forget_channels({channel.id for channel in guild.channels}, guild_id=guild.id)
+
+	def _wake_if_current_removed(self, is_removed):
+		"""wake the dispatcher if the timer it's waiting for was removed, so that it moves on to the next one"""
+		current = self.current_timer
+		if current is not None and is_removed(current):
+			self.scheduler.changed.set()
+
+	def forget_messages(self, channel_id, message_ids):
+		"""drop the timers of messages that no longer exist.
+		They're deleted from the database shortly after, together with those of other deleted messages.
+		"""
+		if self.deleter is not None:
+			# messages we deleted ourselves had their timers dispatched, so they're already gone
+			message_ids = {message_id for message_id in message_ids if not self.deleter.deleted_by_us(channel_id, message_id)}
+		else:
+			message_ids = set(message_ids)
+		if not message_ids:
+			return
+		for message_id in message_ids:
+			self.scheduler.discard(channel_id, message_id)
+		self.writer.discard_messages(message_ids)
+		self._wake_if_current_removed(
+			lambda timer: timer.channel_id == channel_id and timer.message_id in message_ids)
+
+		stored = [message_id for message_id in message_ids if self.memory_timers.pop(message_id, None) is None]
+		if not stored:
+			return
+		self.deleted_messages.update((channel_id, message_id) for message_id in stored)
+		if self.deleted_messages_task is None:
+			self.deleted_messages_task = self.bot.loop.create_task(self._delete_forgotten_timers())
+
+	async def _delete_forgotten_timers(self):
+		try:
+			await asyncio.sleep(DELETED_MESSAGES_DELAY)
+			# a batch being written may include timers of deleted messages
+			await self.writer.wait_written()
+			keys, self.deleted_messages = self.deleted_messages, set()
+			await self.delete_message_timers(keys)
+		except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+			# not a big deal: dispatching them will merely fail to delete their messages
+			logger.warning('Deleting the timers of deleted messages failed: %r', exc)
+		finally:
+			self.deleted_messages_task = None
+
+	async def forget_channels(self, channel_ids, *, guild_id=None):
+		"""drop everything stored about channels that no longer exist (or that we no longer have access to).
+		If guild_id is given, everything stored about that guild is dropped too.
+		"""
+		self.scheduler.discard_channels(channel_ids)
+		self.writer.discard_channels(channel_ids)
+		for message_id in [
+			message_id for message_id, timer in self.memory_timers.items() if timer.channel_id in channel_ids
+		]:
+			del self.memory_timers[message_id]
+		self._wake_if_current_removed(
+			lambda timer: timer.channel_id in channel_ids or guild_id is not None and timer.guild_id == guild_id)
+		for channel_id in channel_ids:
+			self.expiry_cache.set(channel_id, None)
+			self.last_seen.pop(channel_id, None)
+
+		await self.writer.wait_written()
+		if guild_id is None:
+			await self.delete_channel_data(list(channel_ids))
+		else:
+			await self.delete_guild_data(guild_id, list(channel_ids))
+
+	### partition maintenance
+
+	async def _maintain_partitions(self):
+		while True:
+			try:
+				await self.maintain_partitions()
+			except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+				logger.error('Timer partition maintenance failed: %r', exc)
+			await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+
+	@optional_connection
+	async def maintain_partitions(self):
+		"""create partitions of the timers table up to partition_ahead from now, and drop empty past partitions"""
+		now = datetime.datetime.utcnow()
+		horizon = self._partition_horizon(now)
+		ahead = []
+		at = floor_time(now, self.partition_width)
+		while at < horizon:
+			ahead.append(at)
+			at += self.partition_width
+		await self.create_timer_partitions(ahead)
+
+		for name, start, end, detach_pending in await self.get_timer_partitions():
+			if detach_pending:
+				# a concurrent detach was interrupted
+				await connection().execute(f'ALTER TABLE timers DETACH PARTITION {quote_ident(name)} FINALIZE')
+				await self._drop_detached_partition(name, start, end)
+			# only partitions that are entirely in the past can be done with.
+			# they can still have overdue timers (eg if we were offline), so they're only dropped once empty.
+			elif end <= now and not await self._partition_has_timers(name):
+				# unlike DROP TABLE, this doesn't take an ACCESS EXCLUSIVE lock on timers. it can't run in a transaction.
+				await connection().execute(f'ALTER TABLE timers DETACH PARTITION {quote_ident(name)} CONCURRENTLY')
+				await self._drop_detached_partition(name, start, end)
+
+	async def _partition_has_timers(self, name):
+		return await connection().fetchval(f'SELECT EXISTS (SELECT FROM {quote_ident(name)})')
+
+	async def _drop_detached_partition(self, name, start, end):
+		async with connection().transaction():
+			await connection().execute(f'LOCK TABLE {quote_ident(name)} IN ACCESS EXCLUSIVE MODE')
+			# timers may have been added between checking and detaching
+			if await self._partition_has_timers(name):
+				await connection().execute(
+					f"ALTER TABLE timers ATTACH PARTITION {quote_ident(name)} FOR VALUES FROM ('{start}') TO ('{end}')")
+				logger.warning('Not dropping timer partition %s, as it still has timers', name)
+				return
+			await connection().execute(f'DROP TABLE {quote_ident(name)}')
+		logger.info('Dropped timer partition %s', name)
+
+	def _partition_horizon(self, now):
+		"""return how far ahead partitions are made partition_width wide"""
+		horizon = floor_time(now + self.partition_ahead, self.partition_width)
+		if horizon < now + self.partition_ahead:
+			horizon += self.partition_width
+		return horizon
+
+	@optional_connection
+	async def create_timer_partitions(self, expirations):
+		"""make sure the timers table has partitions for timers expiring at the given times.
+		Partitions within partition_ahead from now are partition_width wide, and those after that
+		up to partition_far_width wide. Either way, they're trimmed so as not to overlap existing partitions.
+		"""
+		horizon = self._partition_horizon(datetime.datetime.utcnow())
+		partitions = [(start, end) for _, start, end, _ in await self.get_timer_partitions()]
+		for expires in sorted(set(expirations)):
+			if any(start <= expires < end for start, end in partitions):
+				continue
+			if expires < horizon:
+				start = floor_time(expires, self.partition_width)
+				end = start + self.partition_width
+			else:
+				# leave the time before the horizon to partition_width wide partitions made later on
+				start = floor_time(expires, self.partition_far_width)
+				end = start + self.partition_far_width
+				start = max(start, horizon)
+			start = max([start] + [end_ for _, end_ in partitions if end_ <= expires])
+			end = min([end] + [start_ for start_, _ in partitions if start_ > expires])
+			if await connection().fetchval(self.queries.create_timer_partition, start, end):
+				logger.info('Created timer partition for %s to %s', start, end)
+			partitions.append((start, end))
+
+	@optional_connection
+	async def get_timer_partitions(self):
+		"""return (name, start, end, detach_pending) for each partition of the timers table"""
+		partitions = []
+		for name, bound, detach_pending in await connection().fetch(self.queries.get_timer_partitions):
+			match = PARTITION_BOUND_RE.fullmatch(bound)
+			if match:  # not a default partition, from an older version of 002_partition_timers.sql
+				start, end = (datetime.datetime.fromisoformat(match[x]) for x in ('start', 'end'))
+				partitions.append((name, start, end, detach_pending))
+		return partitions
+
+	### Database calls
 
 	@optional_connection
 	async def delete_timer(self, timer):
-		await connection().execute(self.queries.delete_timer(), timer.channel_id, timer.message_id)
+		await connection().execute(self.queries.delete_timer, timer.channel_id, timer.message_id)
 
 	@optional_connection
-	async def get_active_timer(self):
-		record = await connection().fetchrow(self.queries.get_active_timer())
-		return record and Timer(**record)
+	async def claim_timers(self, before: datetime.datetime, now: datetime.datetime, until: datetime.datetime, limit):
+		"""claim up to limit unclaimed (or abandoned) timers expiring no later than before, and return them"""
+		return await connection().fetch(self.queries.claim_timers, self.worker_id, before, now, until, limit)
 
 	@optional_connection
+	async def renew_claims(self, until: datetime.datetime):
+		await connection().execute(self.queries.renew_claims, self.worker_id, until)
+
+	@optional_connection
+	async def release_claims(self):
+		await connection().execute(self.queries.release_claims, self.worker_id)
+
+	@optional_connection
+	async def delete_timers(self, timers):
+		await self.delete_message_timers([timer.id for timer in timers])
+
+	@optional_connection
+	async def delete_claimed_timers(self, timers):
+		"""delete the given timers if they're still claimed by us. return the (channel_id, message_id) of those deleted."""
+		rows = await connection().fetch(
+			self.queries.delete_claimed_timers,
+			[timer.channel_id for timer in timers],
+			[timer.message_id for timer in timers],
+			self.worker_id)
+		return {(row['channel_id'], row['message_id']) for row in rows}
+
+	@optional_connection
+	async def delete_message_timers(self, keys):
+		"""delete the timers of the given (channel_id, message_id) pairs"""
+		await connection().execute(
+			self.queries.delete_timers,
+			[channel_id for channel_id, _ in keys],
+			[message_id for _, message_id in keys])
+
+	@optional_connection
+	async def delete_channel_data(self, channel_ids):
+		"""delete the timers, expiries, watermarks, last timer changes and failed deletions of the given channels"""
+		await connection().execute(self.queries.delete_channels, channel_ids)
+
+	@optional_connection
+	async def delete_guild_data(self, guild_id, channel_ids):
+		"""delete the timers, expiries, watermarks, last timer changes and failed deletions of a guild.
+		channel_ids are the guild's channels, which may have timers without having an expiry.
+		"""
+		await connection().execute(self.queries.delete_guild, guild_id, channel_ids)
+
+	@optional_connection
+	async def save_failed_deletions(self, guild_id, channel_id, messages, retry_at):
+		"""remember that the deletion of messages, given as (message_id, expires, attempts), failed.
+		They'll be retried at retry_at.
+		"""
+		message_ids, expirations, attempts = zip(*messages) if messages else ((), (), ())
+		await connection().execute(
+			self.queries.save_failed_deletions,
+			guild_id, channel_id, list(message_ids), list(expirations), list(attempts), retry_at)
+
+	@optional_connection
+	async def get_failed_deletions(self):
+		"""return (guild_id, channel_id, message_id, expires, attempts, retry_at) of every failed deletion"""
+		return await connection().fetch(self.queries.get_failed_deletions)
+
+	@optional_connection
+	async def delete_failed_deletions(self, keys):
+		"""forget the failed deletions of the given (channel_id, message_id) pairs"""
+		await connection().execute(
+			self.queries.delete_failed_deletions,
+			[channel_id for channel_id, _ in keys],
+			[message_id for _, message_id in keys])
+
+	@optional_connection
+	async def get_timers_after(self, after: tuple, before: datetime.datetime, limit: int):
+		"""return up to limit timers whose (expires, channel_id, message_id) is after `after`
+		and which expire no later than `before`, in that order.
+		"""
+		return await connection().fetch(self.queries.get_timers_after, *after, before, limit)
+
 	async def get_expiry(self, channel: discord.TextChannel):
-		return await connection().fetchval(self.queries.get_expiry(), channel.id)
+		# not decorated with @optional_connection so that cache hits don't have to acquire a connection
+		expiry = self.expiry_cache.get(channel.id)
+		if expiry is MISSING:
+			expiry = await self._fetch_expiry(channel.id)
+			self.expiry_cache.set(channel.id, expiry)
+		return expiry
+
+	@optional_connection
+	async def _fetch_expiry(self, channel_id):
+		return await connection().fetchval(self.queries.get_expiry, channel_id)
+
+	async def _load_expiries(self):
+		self.expiry_cache.begin_load()
+		rows = await self.get_expiries()
+		# expiries restored from a snapshot may have been deleted since
+		self.expiry_cache.finish_load(rows, stale=self.snapshot.expiries if self.snapshot is not None else ())
+		logger.info('Loaded %d channel expiries', len(rows))
 
 	@optional_connection
 	async def set_expiry(self, channel: discord.TextChannel, expiry: datetime.timedelta):
-		await connection().execute(self.queries.set_expiry(), channel.guild.id, channel.id, expiry)
+		await connection().execute(self.queries.set_expiry, channel.guild.id, channel.id, expiry)
+		self.expiry_cache.set(channel.id, expiry)
 
 	@optional_connection
 	async def set_last_timer_change(self, channel: discord.TextChannel, message_id):
-		await connection().execute(self.queries.set_last_timer_change(), channel.guild.id, channel.id, message_id)
+		await connection().execute(self.queries.set_last_timer_change, channel.guild.id, channel.id, message_id)
+
+	@optional_connection
+	async def get_last_timer_change(self, channel_id):
+		return await connection().fetchval(self.queries.get_last_timer_change, channel_id)
 
 	@optional_connection
 	async def delete_expiry(self, channel: discord.TextChannel):
-		await connection().execute(self.queries.delete_expiry(), channel.id)
+		await connection().execute(self.queries.delete_expiry, channel.id)
+		self.expiry_cache.set(channel.id, None)
 
 	@optional_connection
 	async def delete_last_timer_change(self, channel_id):
-		await connection().execute(self.queries.delete_last_timer_change(), channel_id)
+		await connection().execute(self.queries.delete_last_timer_change, channel_id)
+
+	@optional_connection
+	async def get_watermark(self, channel_id):
+		return await connection().fetchval(self.queries.get_watermark, channel_id)
+
+	@optional_connection
+	async def set_watermark(self, channel: discord.TextChannel, message_id):
+		await connection().execute(self.queries.set_watermark, channel.guild.id, channel.id, message_id)
+
+	@optional_connection
+	async def delete_watermark(self, channel_id):
+		await connection().execute(self.queries.delete_watermark, channel_id)
+
+	@optional_connection
+	async def get_kept_message_ids(self, channel_id, after, before) -> set:
+		"""return the IDs of messages in (after, before] that have explicit timers or must otherwise not be swept"""
+		return {row[0] for row in await connection().fetch(self.queries.get_kept_message_ids, channel_id, after, before)}
 
 	@optional_connection
 	async def get_message_expiration(self, message_id) -> datetime.datetime:
-		return await connection().fetchval(self.queries.get_message_expiration(), message_id)
+		memory = self.memory_timers.get(message_id)
+		if memory is not None:
+			# creating a stored timer for the message would have replaced this one
+			return memory.expires
+		buffered = self.writer.get_expiration(message_id)
+		stored = await connection().fetchval(self.queries.get_message_expiration, message_id)
+		return min(filter(None, (buffered, stored)), default=None)
+
+	@optional_connection
+	async def get_expiries(self):
+		return await connection().fetch(self.queries.get_all_expiries)
+
+	@optional_connection
+	async def get_timer_counts(self, guild_id=None):
+		"""return (pending, earliest, latest) of the stored timers of a guild, or of every guild"""
+		if guild_id is None:
+			return await connection().fetchrow(self.queries.get_total_timer_counts)
+		return await connection().fetchrow(self.queries.get_guild_timer_counts, guild_id)
+
+	@optional_connection
+	async def busiest_channels(self, limit, *, guild_id=None):
+		"""return (guild_id, channel_id, pending, earliest, latest) of the limit channels with the most stored timers,
+		in a guild or in every guild
+		"""
+		if guild_id is None:
+			return await connection().fetch(self.queries.busiest_channels, limit)
+		return await connection().fetch(self.queries.busiest_channels_in_guild, limit, guild_id)
+
+	def memory_timer_counts(self, guild_id=None):
+		"""return a Counter of channel ID to the number of timers only held in memory, in a guild or in every guild"""
+		return collections.Counter(
+			timer.channel_id for timer in self.memory_timers.values() if guild_id is None or timer.guild_id == guild_id)
 
 	@optional_connection
 	async def latest_message_per_channel(self, cutoff: int):
-		async with connection().transaction():
-			async for row in connection().cursor(self.queries.latest_message_per_channel(), cutoff):
-				yield row
+		# fetched all at once rather than with a cursor so that no transaction is held open during catch-up
+		return await connection().fetch(self.queries.latest_message_per_channel, cutoff, self.memory_threshold)
 
 def setup(bot):
 	bot.add_cog(DisappearingMessagesDatabase(bot))
@@ -0,0 +1,67 @@
+# © 2019 lambda#0987
+#
+# Chrona is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# Chrona is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+import io
+import logging
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+class Metrics(commands.Cog):
+	"""Exposes the bot's internal metrics in the Prometheus text format."""
+
+	def __init__(self, bot):
+		self.bot = bot
+		self.runner = None
+		self.start_task = None
+		port = self.bot.config.get('metrics_port')
+		if port is not None:
+			self.start_task = self.bot.loop.create_task(
+				self.start_server(self.bot.config.get('metrics_host', '127.0.0.1'), port))
+
+	def cog_unload(self):
+		if self.runner is not None:
+			self.bot.loop.create_task(self.runner.cleanup())
+		elif self.start_task is not None:
+			self.start_task.cancel()
+
+	async def start_server(self, host, port):
+		app = web.Application()
+		app.router.add_get('/metrics', self.serve_metrics)
+		runner = web.AppRunner(app)
+		await runner.setup()
+		await web.TCPSite(runner, host, port).start()
+		self.runner = runner
+		logger.info('Serving metrics on %s:%d', host, port)
+
+	async def serve_metrics(self, request):
+		return web.Response(text=REGISTRY.render(), content_type='text/plain', charset='utf-8')
+
+	@commands.command(hidden=True)
+	@commands.is_owner()
+	async def metrics(self, ctx):
+		text = REGISTRY.render()
+		if len(text) < 1900:
+			await ctx.send(f'```\n{text}```')
+		else:
+			await ctx.send(file=discord.File(io.BytesIO(text.encode()), 'metrics.txt'))
+
+def setup(bot):
+	bot.add_cog(Metrics(bot))
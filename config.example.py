@@ -30,6 +30,117 @@
 	'timer_change_emoji': '⏳',
 	'timer_disable_emoji': '',
 
+	# when a timer fires, other timers expiring within this many seconds are handled along with it
+	# so that their messages can be deleted using fewer API calls
+	'timer_batch_lookahead': 1,
+	# the maximum number of timers to handle at once
+	'timer_batch_size': 1000,
+
+	# new timers are written to the database in batches of up to this many
+	'timer_write_batch_size': 500,
+	# or after they've been waiting this many seconds, whichever comes first
+	'timer_write_delay': 0.1,
+
+	# upcoming timers are kept in memory, up to this many seconds ahead
+	'timer_preload_window': 60 * 60,
+	# or this many timers, whichever is fewer
+	'timer_preload_size': 10_000,
+
+	# where to write a snapshot of in-memory state on shutdown, so that the next start doesn't have to read the history
+	# of channels for messages that were already handled. None to start from scratch every time.
+	'snapshot_path': None,
+	# snapshots older than this many seconds are ignored
+	'snapshot_max_age': 60 * 60,
+
+	# how to hold preloaded timers in memory. 'heap' keeps a tuple per timer.
+	# 'columns' keeps them in parallel arrays of 64 bit integers, which takes much less memory for large windows.
+	# 'columns' requires NumPy (pip install numpy).
+	'timer_store': 'heap',
+
+	# how to keep track of which messages to delete.
+	# 'rows' stores one timer per message.
+	# 'watermark' only stores the last deleted message per channel, and finds expired messages from channel history.
+	# this writes much less to the database, at the cost of history API calls.
+	'timer_storage': 'rows',
+
+	# the maximum number of deletion API calls in flight at once
+	'deletion_concurrency': 16,
+	# the maximum number of deletion API calls per second, to stay under Discord's global rate limit
+	'deletion_global_rate': 40,
+	# the maximum number of those API calls that may be for any one guild.
+	# once calls have to wait, each guild takes its turn, so that a burst of expirations in one guild
+	# doesn't hold up deletions in every other guild.
+	'deletion_guild_concurrency': 4,
+
+	# deletions that fail for reasons that may be temporary (eg a Discord outage, but not missing permissions)
+	# are saved and retried after deletion_retry_base_delay seconds, doubling with every attempt up to
+	# deletion_retry_max_delay seconds, and given up on after deletion_retry_max_attempts attempts.
+	# every failed message in a channel is retried at once, using bulk deletes where possible.
+	# at most deletion_retry_concurrency channels are retried at once, and retries share one turn among guilds
+	# (see deletion_guild_concurrency), so that they don't hold up new deletions.
+	'deletion_retry_base_delay': 5,
+	'deletion_retry_max_delay': 3600,
+	'deletion_retry_max_attempts': 10,
+	'deletion_retry_concurrency': 2,
+
+	# new messages wait in a queue of at most this many messages to have their timers set,
+	# and this many workers take messages from it (each using at most one database connection at a time)
+	'ingest_queue_size': 10_000,
+	'ingest_workers': 4,
+	# what to do with new messages while the queue is full:
+	# 'block' waits for room in the queue. 'coalesce' merges them into one range of messages per channel,
+	# which is read back from channel history when its turn in the queue comes.
+	# 'catch_up' drops them, then reads them back from channel history once the queue is empty.
+	'ingest_overflow': 'coalesce',
+
+	# how many channels to catch up on at once after being offline
+	'catch_up_concurrency': 8,
+
+	# when a channel's disappearing message timer is changed, also change the timers of messages already sent there,
+	# so that each one expires the new amount of time after it was sent. messages that would thereby have already
+	# expired are deleted right away. requires sql/migrations/005_bulk_retiming.sql on older databases.
+	'retime_on_timer_change': False,
+
+	# listen for notifications of timers created outside of this process (by other processes, or by hand),
+	# so that they're dispatched on time. requires sql/migrations/004_timer_notifications.sql on older databases.
+	'timer_notifications': True,
+
+	# timers shorter than this many seconds, in channels whose disappearing message timer is also shorter than this,
+	# are only kept in memory rather than being written to the database. if the bot restarts, it finds their messages
+	# again by reading the history of those channels. None to store every timer.
+	'timer_memory_threshold': None,
+
+	# 'single' if only one process dispatches timers.
+	# 'claim' lets several processes share the timers table: each one claims the timers it's about to dispatch.
+	'timer_dispatch': 'single',
+	# how often, in seconds, to claim new timers and renew existing claims.
+	# claims not renewed for three times this long are taken over by other processes.
+	'timer_claim_interval': 30,
+
+	# set to True after running sql/migrations/002_partition_timers.sql (requires PostgreSQL 14 or later).
+	# the timers table will then be kept partitioned by expiry. timer rows are still deleted as they're dispatched,
+	# but each partition is detached and dropped once it's in the past and empty, which clears out the dead rows
+	# those deletes leave behind without waiting for them to be vacuumed.
+	'timer_partitioning': False,
+	# how many hours of timers each partition holds
+	'timer_partition_width': 24,
+	# how many days ahead to create partitions
+	'timer_partition_ahead': 7,
+	# timers further ahead than that get partitions up to this many days wide, made when they're first written
+	'timer_partition_far_width': 30,
+
+	# how long, in seconds, to wait for the bot's own messages (eg timer change announcements) to be received,
+	# so that they can be exempted from the timer, and how many to wait for at most
+	'kept_message_ttl': 60,
+	'kept_message_max_size': 10_000,
+
+	# the maximum number of channels to remember the disappearing message timer (or lack thereof) of
+	'expiry_cache_size': 100_000,
+
+	# serve metrics in the Prometheus text format at http://metrics_host:metrics_port/metrics. None to disable.
+	'metrics_port': None,
+	'metrics_host': '127.0.0.1',
+
 	# the contents of this file will be shown by the copyright command
 	'copyright_license_file': '',
 }
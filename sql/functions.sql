@@ -17,3 +17,122 @@ CREATE FUNCTION coalesce_max(x anyelement, y anyelement) RETURNS anyelement AS $
 	IF x IS NULL OR x < y THEN
 		RETURN y; END IF;
 	RETURN x; END $$ LANGUAGE 'plpgsql';
+
+-- used when the timers table is partitioned (see migrations/002_partition_timers.sql, which also defines this)
+-- creates a partition of timers for [start_, end_), unless there's one of the same name already
+CREATE FUNCTION create_timer_partition(start_ TIMESTAMP, end_ TIMESTAMP) RETURNS BOOLEAN AS $$
+DECLARE
+	partition_name TEXT := 'timers_p' || to_char(start_, 'YYYYMMDDHH24MISS');
+BEGIN
+	IF to_regclass(partition_name) IS NOT NULL THEN
+		RETURN FALSE; END IF;
+
+	-- creating the table separately and then attaching it only takes a SHARE UPDATE EXCLUSIVE lock on timers,
+	-- where CREATE TABLE ... PARTITION OF would take an ACCESS EXCLUSIVE lock
+	EXECUTE format('CREATE TABLE %I (LIKE timers INCLUDING DEFAULTS)', partition_name);
+	EXECUTE format('ALTER TABLE timers ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, start_, end_);
+	RETURN TRUE; END $$ LANGUAGE 'plpgsql';
+
+-- the time at which the given Discord ID was created
+CREATE FUNCTION snowflake_time(snowflake BIGINT) RETURNS TIMESTAMP AS $$
+	SELECT TIMESTAMP 'epoch' + ((snowflake >> 22) + 1420070400000) * INTERVAL '1 millisecond'
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- tells listening dispatchers about new timers, and timers moved sooner, including those not created by the bot itself
+-- payload: expires channel_id message_id guild_id
+-- statements that change many timers at once set chrona.notify_timers to off and send one notification instead
+CREATE FUNCTION notify_timer() RETURNS TRIGGER AS $$ BEGIN
+	IF current_setting('chrona.notify_timers', TRUE) = 'off' THEN
+		RETURN NULL; END IF;
+	PERFORM pg_notify('chrona_timers', concat_ws(
+		' ', to_char(NEW.expires, 'YYYY-MM-DD"T"HH24:MI:SS.US'), NEW.channel_id, NEW.message_id, NEW.guild_id));
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER timers_notify AFTER INSERT OR UPDATE OF expires ON timers FOR EACH ROW EXECUTE PROCEDURE notify_timer();
+
+-- keep timer_counts and guild_timer_counts up to date (see schema.sql).
+-- rows are locked in ID order, channels before guilds, so that concurrent writers can't deadlock.
+-- that only holds within a statement, so timers are written a batch per statement (see create_timers in queries.sql),
+-- and a transaction that runs several such statements locks all of their rows in the same order first.
+
+CREATE FUNCTION count_inserted_timers() RETURNS TRIGGER AS $$ BEGIN
+	INSERT INTO timer_counts AS c (guild_id, channel_id, pending, earliest, latest)
+	SELECT guild_id, channel_id, count(*), min(expires), max(expires)
+	FROM new_timers
+	GROUP BY guild_id, channel_id
+	ORDER BY channel_id
+	ON CONFLICT (channel_id) DO UPDATE SET
+		pending = c.pending + EXCLUDED.pending,
+		earliest = least(c.earliest, EXCLUDED.earliest),
+		latest = greatest(c.latest, EXCLUDED.latest);
+
+	INSERT INTO guild_timer_counts AS g (guild_id, pending, earliest, latest)
+	SELECT guild_id, count(*), min(expires), max(expires)
+	FROM new_timers
+	GROUP BY guild_id
+	ORDER BY guild_id
+	ON CONFLICT (guild_id) DO UPDATE SET
+		pending = g.pending + EXCLUDED.pending,
+		earliest = least(g.earliest, EXCLUDED.earliest),
+		latest = greatest(g.latest, EXCLUDED.latest);
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+-- the soonest or latest timer may be among those deleted or moved, so those are looked up again.
+-- that's cheap, using timers_channel_id_idx for channels and timer_counts_guild_id_idx for guilds.
+CREATE FUNCTION recount_timer_bounds(channel_ids BIGINT[], guild_ids BIGINT[]) RETURNS VOID AS $$ BEGIN
+	UPDATE timer_counts AS c SET
+		earliest = (SELECT min(expires) FROM timers WHERE channel_id = c.channel_id),
+		latest = (SELECT max(expires) FROM timers WHERE channel_id = c.channel_id)
+	WHERE channel_id = ANY (channel_ids);
+	DELETE FROM timer_counts WHERE channel_id = ANY (channel_ids) AND pending <= 0;
+
+	UPDATE guild_timer_counts AS g SET
+		earliest = (SELECT min(earliest) FROM timer_counts WHERE guild_id = g.guild_id),
+		latest = (SELECT max(latest) FROM timer_counts WHERE guild_id = g.guild_id)
+	WHERE guild_id = ANY (guild_ids);
+	DELETE FROM guild_timer_counts WHERE guild_id = ANY (guild_ids) AND pending <= 0;
+	END $$ LANGUAGE 'plpgsql';
+
+CREATE FUNCTION count_deleted_timers() RETURNS TRIGGER AS $$
+DECLARE
+	channel_ids BIGINT[] := ARRAY(SELECT DISTINCT channel_id FROM old_timers ORDER BY channel_id);
+	guild_ids BIGINT[] := ARRAY(SELECT DISTINCT guild_id FROM old_timers ORDER BY guild_id);
+BEGIN
+	PERFORM FROM timer_counts WHERE channel_id = ANY (channel_ids) ORDER BY channel_id FOR UPDATE;
+	PERFORM FROM guild_timer_counts WHERE guild_id = ANY (guild_ids) ORDER BY guild_id FOR UPDATE;
+
+	UPDATE timer_counts AS c SET pending = c.pending - deleted.pending
+	FROM (SELECT channel_id, count(*) AS pending FROM old_timers GROUP BY channel_id) AS deleted
+	WHERE c.channel_id = deleted.channel_id;
+	UPDATE guild_timer_counts AS g SET pending = g.pending - deleted.pending
+	FROM (SELECT guild_id, count(*) AS pending FROM old_timers GROUP BY guild_id) AS deleted
+	WHERE g.guild_id = deleted.guild_id;
+
+	PERFORM recount_timer_bounds(channel_ids, guild_ids);
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+CREATE FUNCTION count_updated_timers() RETURNS TRIGGER AS $$
+DECLARE
+	-- claiming timers updates them too, without moving them
+	channel_ids BIGINT[] := ARRAY(
+		SELECT DISTINCT channel_id
+		FROM new_timers JOIN old_timers USING (channel_id, message_id)
+		WHERE new_timers.expires <> old_timers.expires
+		ORDER BY channel_id);
+	guild_ids BIGINT[];
+BEGIN
+	IF cardinality(channel_ids) = 0 THEN
+		RETURN NULL; END IF;
+	guild_ids := ARRAY(SELECT DISTINCT guild_id FROM new_timers WHERE channel_id = ANY (channel_ids) ORDER BY guild_id);
+
+	PERFORM FROM timer_counts WHERE channel_id = ANY (channel_ids) ORDER BY channel_id FOR UPDATE;
+	PERFORM FROM guild_timer_counts WHERE guild_id = ANY (guild_ids) ORDER BY guild_id FOR UPDATE;
+	PERFORM recount_timer_bounds(channel_ids, guild_ids);
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER timers_count_insert AFTER INSERT ON timers
+	REFERENCING NEW TABLE AS new_timers FOR EACH STATEMENT EXECUTE PROCEDURE count_inserted_timers();
+CREATE TRIGGER timers_count_delete AFTER DELETE ON timers
+	REFERENCING OLD TABLE AS old_timers FOR EACH STATEMENT EXECUTE PROCEDURE count_deleted_timers();
+CREATE TRIGGER timers_count_update AFTER UPDATE ON timers
+	REFERENCING OLD TABLE AS old_timers NEW TABLE AS new_timers FOR EACH STATEMENT EXECUTE PROCEDURE count_updated_timers();
@@ -0,0 +1,27 @@
+-- © 2019 lambda#0987
+--
+-- Chrona is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as
+-- published by the Free Software Foundation, either version 3 of the
+-- License, or (at your option) any later version.
+--
+-- Chrona is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+-- brings a database created before watermarks and timer claims up to date with schema.sql
+
+CREATE TABLE IF NOT EXISTS watermarks(
+	guild_id BIGINT NOT NULL,
+	channel_id BIGINT PRIMARY KEY,
+	message_id BIGINT NOT NULL);
+
+ALTER TABLE timers
+	ADD COLUMN IF NOT EXISTS claimed_by TEXT,
+	ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP WITHOUT TIME ZONE;
+
+CREATE INDEX IF NOT EXISTS "timers_claimed_by_idx" ON timers (claimed_by) WHERE claimed_by IS NOT NULL;
@@ -0,0 +1,69 @@
+-- © 2019 lambda#0987
+--
+-- Chrona is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as
+-- published by the Free Software Foundation, either version 3 of the
+-- License, or (at your option) any later version.
+--
+-- Chrona is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+-- optional: converts the timers table into one partitioned by expiry (requires PostgreSQL 14 or later).
+-- run this with the bot stopped, after 001_timer_claims.sql, then set timer_partitioning to True in the config.
+-- the bot will create partitions ahead of time, create partitions on demand for timers further ahead than that,
+-- and detach and drop partitions once they're in the past and empty.
+-- there's no default partition, as that would keep partitions from being detached concurrently.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION create_timer_partition(start_ TIMESTAMP, end_ TIMESTAMP) RETURNS BOOLEAN AS $$
+DECLARE
+	partition_name TEXT := 'timers_p' || to_char(start_, 'YYYYMMDDHH24MISS');
+BEGIN
+	IF to_regclass(partition_name) IS NOT NULL THEN
+		RETURN FALSE; END IF;
+
+	-- creating the table separately and then attaching it only takes a SHARE UPDATE EXCLUSIVE lock on timers,
+	-- where CREATE TABLE ... PARTITION OF would take an ACCESS EXCLUSIVE lock
+	EXECUTE format('CREATE TABLE %I (LIKE timers INCLUDING DEFAULTS)', partition_name);
+	EXECUTE format('ALTER TABLE timers ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, start_, end_);
+	RETURN TRUE; END $$ LANGUAGE 'plpgsql';
+
+-- no longer used, since partitions are now detached concurrently, which can't be done from a function
+DROP FUNCTION IF EXISTS drop_timer_partition_if_empty(TEXT);
+
+ALTER TABLE timers RENAME TO timers_unpartitioned;
+ALTER INDEX timers_expires_idx RENAME TO timers_unpartitioned_expires_idx;
+ALTER INDEX timers_claimed_by_idx RENAME TO timers_unpartitioned_claimed_by_idx;
+
+CREATE TABLE timers(
+	guild_id BIGINT NOT NULL,
+	channel_id BIGINT NOT NULL,
+	message_id BIGINT NOT NULL,
+	expires TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	claimed_by TEXT,
+	claimed_until TIMESTAMP WITHOUT TIME ZONE,
+
+	-- the partition key must be part of the primary key
+	PRIMARY KEY (message_id, channel_id, expires)
+) PARTITION BY RANGE (expires);
+
+CREATE INDEX "timers_expires_idx" ON timers (expires);
+CREATE INDEX "timers_claimed_by_idx" ON timers (claimed_by) WHERE claimed_by IS NOT NULL;
+
+-- a day wide partition for each day that existing timers expire on. the bot makes the rest.
+SELECT create_timer_partition(day, day + INTERVAL '1 day')
+FROM (SELECT DISTINCT date_bin(INTERVAL '1 day', expires, TIMESTAMP 'epoch') AS day FROM timers_unpartitioned) AS days;
+
+INSERT INTO timers (guild_id, channel_id, message_id, expires, claimed_by, claimed_until)
+SELECT guild_id, channel_id, message_id, expires, claimed_by, claimed_until
+FROM timers_unpartitioned;
+
+DROP TABLE timers_unpartitioned;
+
+COMMIT;
@@ -0,0 +1,25 @@
+-- © 2019 lambda#0987
+--
+-- Chrona is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as
+-- published by the Free Software Foundation, either version 3 of the
+-- License, or (at your option) any later version.
+--
+-- Chrona is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+-- lets dispatchers find out about timers created by other processes (see notify_timer in functions.sql).
+-- 002_partition_timers.sql recreates the timers table, so run this again after it.
+
+CREATE OR REPLACE FUNCTION notify_timer() RETURNS TRIGGER AS $$ BEGIN
+	PERFORM pg_notify('chrona_timers', concat_ws(
+		' ', to_char(NEW.expires, 'YYYY-MM-DD"T"HH24:MI:SS.US'), NEW.channel_id, NEW.message_id, NEW.guild_id));
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+DROP TRIGGER IF EXISTS timers_notify ON timers;
+CREATE TRIGGER timers_notify AFTER INSERT OR UPDATE OF expires ON timers FOR EACH ROW EXECUTE PROCEDURE notify_timer();
@@ -0,0 +1,27 @@
+-- © 2019 lambda#0987
+--
+-- Chrona is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as
+-- published by the Free Software Foundation, either version 3 of the
+-- License, or (at your option) any later version.
+--
+-- Chrona is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+-- lets timer set move every timer in a channel at once (see retime_channel_timers in queries.sql)
+
+CREATE OR REPLACE FUNCTION snowflake_time(snowflake BIGINT) RETURNS TIMESTAMP AS $$
+	SELECT TIMESTAMP 'epoch' + ((snowflake >> 22) + 1420070400000) * INTERVAL '1 millisecond'
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION notify_timer() RETURNS TRIGGER AS $$ BEGIN
+	IF current_setting('chrona.notify_timers', TRUE) = 'off' THEN
+		RETURN NULL; END IF;
+	PERFORM pg_notify('chrona_timers', concat_ws(
+		' ', to_char(NEW.expires, 'YYYY-MM-DD"T"HH24:MI:SS.US'), NEW.channel_id, NEW.message_id, NEW.guild_id));
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
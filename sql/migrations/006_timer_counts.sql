@@ -0,0 +1,139 @@
+-- © 2019 lambda#0987
+--
+-- Chrona is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as
+-- published by the Free Software Foundation, either version 3 of the
+-- License, or (at your option) any later version.
+--
+-- Chrona is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+-- counts pending timers per channel and per guild (see timer_counts in schema.sql and count_*_timers in functions.sql).
+-- 002_partition_timers.sql recreates the timers table, so run this again after it.
+
+DROP INDEX IF EXISTS timers_channel_id_idx;
+CREATE INDEX timers_channel_id_idx ON timers (channel_id, expires);
+
+CREATE TABLE IF NOT EXISTS timer_counts(
+	guild_id BIGINT NOT NULL,
+	channel_id BIGINT PRIMARY KEY,
+	pending BIGINT NOT NULL,
+	earliest TIMESTAMP WITHOUT TIME ZONE,
+	latest TIMESTAMP WITHOUT TIME ZONE);
+
+CREATE INDEX IF NOT EXISTS timer_counts_guild_id_idx ON timer_counts (guild_id);
+
+CREATE TABLE IF NOT EXISTS guild_timer_counts(
+	guild_id BIGINT PRIMARY KEY,
+	pending BIGINT NOT NULL,
+	earliest TIMESTAMP WITHOUT TIME ZONE,
+	latest TIMESTAMP WITHOUT TIME ZONE);
+
+-- keep timer_counts and guild_timer_counts up to date (see schema.sql).
+-- rows are locked in ID order, channels before guilds, so that concurrent writers can't deadlock.
+-- that only holds within a statement, so timers are written a batch per statement (see create_timers in queries.sql),
+-- and a transaction that runs several such statements locks all of their rows in the same order first.
+
+CREATE OR REPLACE FUNCTION count_inserted_timers() RETURNS TRIGGER AS $$ BEGIN
+	INSERT INTO timer_counts AS c (guild_id, channel_id, pending, earliest, latest)
+	SELECT guild_id, channel_id, count(*), min(expires), max(expires)
+	FROM new_timers
+	GROUP BY guild_id, channel_id
+	ORDER BY channel_id
+	ON CONFLICT (channel_id) DO UPDATE SET
+		pending = c.pending + EXCLUDED.pending,
+		earliest = least(c.earliest, EXCLUDED.earliest),
+		latest = greatest(c.latest, EXCLUDED.latest);
+
+	INSERT INTO guild_timer_counts AS g (guild_id, pending, earliest, latest)
+	SELECT guild_id, count(*), min(expires), max(expires)
+	FROM new_timers
+	GROUP BY guild_id
+	ORDER BY guild_id
+	ON CONFLICT (guild_id) DO UPDATE SET
+		pending = g.pending + EXCLUDED.pending,
+		earliest = least(g.earliest, EXCLUDED.earliest),
+		latest = greatest(g.latest, EXCLUDED.latest);
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+-- the soonest or latest timer may be among those deleted or moved, so those are looked up again.
+-- that's cheap, using timers_channel_id_idx for channels and timer_counts_guild_id_idx for guilds.
+CREATE OR REPLACE FUNCTION recount_timer_bounds(channel_ids BIGINT[], guild_ids BIGINT[]) RETURNS VOID AS $$ BEGIN
+	UPDATE timer_counts AS c SET
+		earliest = (SELECT min(expires) FROM timers WHERE channel_id = c.channel_id),
+		latest = (SELECT max(expires) FROM timers WHERE channel_id = c.channel_id)
+	WHERE channel_id = ANY (channel_ids);
+	DELETE FROM timer_counts WHERE channel_id = ANY (channel_ids) AND pending <= 0;
+
+	UPDATE guild_timer_counts AS g SET
+		earliest = (SELECT min(earliest) FROM timer_counts WHERE guild_id = g.guild_id),
+		latest = (SELECT max(latest) FROM timer_counts WHERE guild_id = g.guild_id)
+	WHERE guild_id = ANY (guild_ids);
+	DELETE FROM guild_timer_counts WHERE guild_id = ANY (guild_ids) AND pending <= 0;
+	END $$ LANGUAGE 'plpgsql';
+
+CREATE OR REPLACE FUNCTION count_deleted_timers() RETURNS TRIGGER AS $$
+DECLARE
+	channel_ids BIGINT[] := ARRAY(SELECT DISTINCT channel_id FROM old_timers ORDER BY channel_id);
+	guild_ids BIGINT[] := ARRAY(SELECT DISTINCT guild_id FROM old_timers ORDER BY guild_id);
+BEGIN
+	PERFORM FROM timer_counts WHERE channel_id = ANY (channel_ids) ORDER BY channel_id FOR UPDATE;
+	PERFORM FROM guild_timer_counts WHERE guild_id = ANY (guild_ids) ORDER BY guild_id FOR UPDATE;
+
+	UPDATE timer_counts AS c SET pending = c.pending - deleted.pending
+	FROM (SELECT channel_id, count(*) AS pending FROM old_timers GROUP BY channel_id) AS deleted
+	WHERE c.channel_id = deleted.channel_id;
+	UPDATE guild_timer_counts AS g SET pending = g.pending - deleted.pending
+	FROM (SELECT guild_id, count(*) AS pending FROM old_timers GROUP BY guild_id) AS deleted
+	WHERE g.guild_id = deleted.guild_id;
+
+	PERFORM recount_timer_bounds(channel_ids, guild_ids);
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+CREATE OR REPLACE FUNCTION count_updated_timers() RETURNS TRIGGER AS $$
+DECLARE
+	-- claiming timers updates them too, without moving them
+	channel_ids BIGINT[] := ARRAY(
+		SELECT DISTINCT channel_id
+		FROM new_timers JOIN old_timers USING (channel_id, message_id)
+		WHERE new_timers.expires <> old_timers.expires
+		ORDER BY channel_id);
+	guild_ids BIGINT[];
+BEGIN
+	IF cardinality(channel_ids) = 0 THEN
+		RETURN NULL; END IF;
+	guild_ids := ARRAY(SELECT DISTINCT guild_id FROM new_timers WHERE channel_id = ANY (channel_ids) ORDER BY guild_id);
+
+	PERFORM FROM timer_counts WHERE channel_id = ANY (channel_ids) ORDER BY channel_id FOR UPDATE;
+	PERFORM FROM guild_timer_counts WHERE guild_id = ANY (guild_ids) ORDER BY guild_id FOR UPDATE;
+	PERFORM recount_timer_bounds(channel_ids, guild_ids);
+	RETURN NULL; END $$ LANGUAGE 'plpgsql';
+
+-- nothing may change the timers between counting them and the triggers taking over.
+-- run this file in a single transaction (eg psql --single-transaction), so that the lock is held until the end.
+LOCK TABLE timers IN SHARE MODE;
+
+TRUNCATE timer_counts, guild_timer_counts;
+INSERT INTO timer_counts (guild_id, channel_id, pending, earliest, latest)
+SELECT guild_id, channel_id, count(*), min(expires), max(expires)
+FROM timers
+GROUP BY guild_id, channel_id;
+INSERT INTO guild_timer_counts (guild_id, pending, earliest, latest)
+SELECT guild_id, sum(pending), min(earliest), max(latest)
+FROM timer_counts
+GROUP BY guild_id;
+
+DROP TRIGGER IF EXISTS timers_count_insert ON timers;
+DROP TRIGGER IF EXISTS timers_count_delete ON timers;
+DROP TRIGGER IF EXISTS timers_count_update ON timers;
+CREATE TRIGGER timers_count_insert AFTER INSERT ON timers
+	REFERENCING NEW TABLE AS new_timers FOR EACH STATEMENT EXECUTE PROCEDURE count_inserted_timers();
+CREATE TRIGGER timers_count_delete AFTER DELETE ON timers
+	REFERENCING OLD TABLE AS old_timers FOR EACH STATEMENT EXECUTE PROCEDURE count_deleted_timers();
+CREATE TRIGGER timers_count_update AFTER UPDATE ON timers
+	REFERENCING OLD TABLE AS old_timers NEW TABLE AS new_timers FOR EACH STATEMENT EXECUTE PROCEDURE count_updated_timers();
@@ -0,0 +1,30 @@
+-- © 2019 lambda#0987
+--
+-- Chrona is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU Affero General Public License as
+-- published by the Free Software Foundation, either version 3 of the
+-- License, or (at your option) any later version.
+--
+-- Chrona is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+-- GNU Affero General Public License for more details.
+--
+-- You should have received a copy of the GNU Affero General Public License
+-- along with Chrona. If not, see <https://www.gnu.org/licenses/>.
+
+-- remembers failed deletions so that they can be retried, including after a restart (see utils/retry.py)
+
+CREATE TABLE IF NOT EXISTS failed_deletions(
+	-- NULL if the guild of the channel wasn't known
+	guild_id BIGINT,
+	channel_id BIGINT NOT NULL,
+	message_id BIGINT NOT NULL,
+	-- NULL if the message had no timer, eg if it was deleted by timer sweep
+	expires TIMESTAMP WITHOUT TIME ZONE,
+	attempts INTEGER NOT NULL,
+	retry_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+
+	PRIMARY KEY (channel_id, message_id));
+
+CREATE INDEX IF NOT EXISTS failed_deletions_guild_id_idx ON failed_deletions (guild_id);
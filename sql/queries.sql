@@ -20,6 +20,11 @@ FROM expiries
 WHERE channel_id = $1
 -- :endmacro
 
+-- :macro get_all_expiries()
+SELECT channel_id, expiry
+FROM expiries
+-- :endmacro
+
 -- :macro set_expiry()
 -- params: guild_id, channel_id, expiry
 INSERT INTO expiries(guild_id, channel_id, expiry)
@@ -42,8 +47,18 @@ WHERE message_id = $1
 -- :endmacro
 
 -- :macro latest_message_per_channel()
--- params: cutoff_time (as snowflake, upper bound)
-SELECT channel_id, coalesce_max(max_per_channel.message_id, last_timer_changes.message_id), expiry
+-- params: cutoff_time (as snowflake, upper bound), memory threshold (may be null)
+SELECT
+	channel_id,
+	coalesce_max(
+		coalesce_max(
+			-- channels with short enough expiries don't store timers for most of their messages,
+			-- so their stored timers don't say how far their messages have been handled
+			CASE WHEN $2::INTERVAL IS NULL OR expiry >= $2::INTERVAL THEN max_per_channel.message_id END,
+			last_timer_changes.message_id),
+		-- catch-up progress, in case it was interrupted
+		watermarks.message_id),
+	expiry
 FROM (
 		SELECT channel_id, max(message_id) AS message_id
 		FROM timers
@@ -52,6 +67,7 @@ FROM (
 	) AS max_per_channel
 	FULL OUTER JOIN last_timer_changes USING (channel_id)
 	INNER JOIN expiries USING (channel_id)
+	LEFT JOIN watermarks USING (channel_id)
 -- :endmacro
 
 -- :macro set_last_timer_change()
@@ -62,31 +78,311 @@ ON CONFLICT (channel_id) DO UPDATE
 	SET message_id = EXCLUDED.message_id
 -- :endmacro
 
+-- :macro get_last_timer_change()
+-- params: channel_id
+SELECT message_id
+FROM last_timer_changes
+WHERE channel_id = $1
+-- :endmacro
+
 -- :macro delete_last_timer_change()
 -- params: channel_id
 DELETE FROM last_timer_changes
 WHERE channel_id = $1
 -- :endmacro
 
--- :macro get_active_timer()
+-- :macro get_timers_after()
+-- params: expires, channel_id, message_id (exclusive lower bound), expires (inclusive upper bound), limit
 SELECT *
 FROM timers
-ORDER BY expires
-LIMIT 1
+WHERE
+	-- redundant, but lets the planner use timers_expires_idx
+	expires >= $1
+	AND (expires, channel_id, message_id) > ($1, $2, $3)
+	AND expires <= $4
+ORDER BY expires, channel_id, message_id
+LIMIT $5
 -- :endmacro
 
--- :macro create_timer()
+-- :macro create_timers()
+-- :if 'claimed' in varargs
+-- params: guild_ids, channel_ids, message_ids, expires, claimed_by, claimed_until (one element per timer)
+-- :else
+-- params: guild_ids, channel_ids, message_ids, expires (one element per timer)
+-- :endif
+-- a whole batch is one statement, so that the count triggers (see functions.sql) fire once for it,
+-- locking each count row once and in order
+WITH new AS (
+-- :if 'claimed' in varargs
+	SELECT *
+	FROM unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[], $4::TIMESTAMP[], $5::TEXT[], $6::TIMESTAMP[])
+		AS t (guild_id, channel_id, message_id, expires, claimed_by, claimed_until))
+-- :else
+	SELECT *
+	FROM unnest($1::BIGINT[], $2::BIGINT[], $3::BIGINT[], $4::TIMESTAMP[])
+		AS t (guild_id, channel_id, message_id, expires))
+-- :endif
+-- :if 'upsert' in varargs and 'partitioned' in varargs
+-- partitioned tables can't have a unique index on (channel_id, message_id), so ON CONFLICT can't be used
+, updated AS (
+	UPDATE timers
+	SET
+		expires = new.expires
+-- :if 'claimed' in varargs
+		, claimed_by = coalesce(new.claimed_by, timers.claimed_by)
+		, claimed_until = coalesce(new.claimed_until, timers.claimed_until)
+-- :endif
+	FROM new
+	WHERE timers.channel_id = new.channel_id AND timers.message_id = new.message_id AND timers.expires > new.expires)
+-- :endif
+-- :if 'claimed' in varargs
+INSERT INTO timers (guild_id, channel_id, message_id, expires, claimed_by, claimed_until)
+SELECT guild_id, channel_id, message_id, expires, claimed_by, claimed_until
+-- :else
 INSERT INTO timers (guild_id, channel_id, message_id, expires)
-VALUES ($1, $2, $3, $4)
--- :if 'upsert' in varargs
+SELECT guild_id, channel_id, message_id, expires
+-- :endif
+FROM new
+-- :if 'upsert' in varargs and 'partitioned' in varargs
+WHERE NOT EXISTS (SELECT FROM timers WHERE channel_id = new.channel_id AND message_id = new.message_id)
+-- :elif 'upsert' in varargs
 ON CONFLICT (channel_id, message_id) DO UPDATE
-	SET expires = EXCLUDED.expires
+	SET
+		expires = EXCLUDED.expires
+-- :if 'claimed' in varargs
+		, claimed_by = coalesce(EXCLUDED.claimed_by, timers.claimed_by)
+		, claimed_until = coalesce(EXCLUDED.claimed_until, timers.claimed_until)
+-- :endif
 	WHERE EXCLUDED.expires < timers.expires
+-- :elif 'ignore' in varargs
+ON CONFLICT DO NOTHING
+-- :endif
+-- :endmacro
+
+-- :macro lock_channel_timer_counts()
+-- params: guild_ids, channel_ids (one element per timer about to be written)
+-- writing both inserts and upserts (or upserts into a partitioned table) takes two statements,
+-- each of which locks count rows in order by itself.
+-- locking all of them in order first keeps the writer from deadlocking with timers being deleted.
+-- rows are made for channels that have none yet, so that those are locked too. they can't be left empty,
+-- since a channel without a row has no timers, so none of its timers can conflict with existing ones.
+INSERT INTO timer_counts AS c (guild_id, channel_id, pending)
+SELECT DISTINCT guild_id, channel_id, 0
+FROM unnest($1::BIGINT[], $2::BIGINT[]) AS t (guild_id, channel_id)
+ORDER BY channel_id
+ON CONFLICT (channel_id) DO UPDATE SET pending = c.pending
+-- :endmacro
+
+-- :macro lock_guild_timer_counts()
+-- params: guild_ids
+-- like lock_channel_timer_counts, run after it, since the count triggers lock channels before guilds
+INSERT INTO guild_timer_counts AS g (guild_id, pending)
+SELECT DISTINCT guild_id, 0
+FROM unnest($1::BIGINT[]) AS t (guild_id)
+ORDER BY guild_id
+ON CONFLICT (guild_id) DO UPDATE SET pending = g.pending
+-- :endmacro
+
+-- :macro retime_channel_timers()
+-- params: channel_id, expiry, now
+-- moves every timer in the channel to expire expiry after its message was sent.
+-- timers that would thereby have already expired are deleted instead, and returned so that they're dispatched now.
+WITH
+	-- both statements see the timers as they were before either of them ran
+	retimed AS (
+		UPDATE timers
+		SET expires = snowflake_time(message_id) + $2, claimed_by = NULL, claimed_until = NULL
+		WHERE channel_id = $1 AND snowflake_time(message_id) + $2 > $3)
+DELETE FROM timers
+WHERE channel_id = $1 AND snowflake_time(message_id) + $2 <= $3
+RETURNING guild_id, channel_id, message_id, snowflake_time(message_id) + $2 AS expires
+-- :endmacro
+
+-- :macro suppress_timer_notifications()
+-- until the end of the transaction (see notify_timer in functions.sql)
+SELECT set_config('chrona.notify_timers', 'off', TRUE)
+-- :endmacro
+
+-- :macro notify_channel_retimed()
+-- params: channel_id
+SELECT pg_notify('chrona_timers', 'retime ' || $1::BIGINT)
+-- :endmacro
+
+-- :macro get_guild_timer_counts()
+-- params: guild_id
+SELECT pending, earliest, latest
+FROM guild_timer_counts
+WHERE guild_id = $1
+-- :endmacro
+
+-- :macro get_total_timer_counts()
+SELECT coalesce(sum(pending), 0) AS pending, min(earliest) AS earliest, max(latest) AS latest
+FROM guild_timer_counts
+-- :endmacro
+
+-- :macro busiest_channels()
+-- params: limit[, guild_id]
+-- :if 'guild' in varargs
+SELECT guild_id, channel_id, pending, earliest, latest
+FROM timer_counts
+WHERE guild_id = $2
+ORDER BY pending DESC
+LIMIT $1
+-- :else
+SELECT guild_id, channel_id, pending, earliest, latest
+FROM timer_counts
+ORDER BY pending DESC
+LIMIT $1
 -- :endif
 -- :endmacro
 
+-- :macro claim_timers()
+-- params: worker, expires (upper bound), now, claimed_until, limit
+UPDATE timers
+SET claimed_by = $1, claimed_until = $4
+WHERE (channel_id, message_id) IN (
+	SELECT channel_id, message_id
+	FROM timers
+	WHERE expires <= $2 AND (claimed_by IS NULL OR claimed_until < $3)
+	ORDER BY expires, channel_id, message_id
+	LIMIT $5
+	FOR UPDATE SKIP LOCKED)
+RETURNING guild_id, channel_id, message_id, expires
+-- :endmacro
+
+-- :macro renew_claims()
+-- params: worker, claimed_until
+UPDATE timers
+SET claimed_until = $2
+WHERE claimed_by = $1
+-- :endmacro
+
+-- :macro release_claims()
+-- params: worker
+UPDATE timers
+SET claimed_by = NULL, claimed_until = NULL
+WHERE claimed_by = $1
+-- :endmacro
+
 -- :macro delete_timer()
 -- params: channel_id, message_id
 DELETE FROM timers
 WHERE channel_id = $1 AND message_id = $2
 -- :endmacro
+
+-- :macro delete_timers()
+-- params: channel_ids, message_ids
+DELETE FROM timers
+WHERE (channel_id, message_id) IN (SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[]))
+-- :endmacro
+
+-- :macro delete_claimed_timers()
+-- params: channel_ids, message_ids, worker
+-- timers whose claim lapsed and was taken over by another process are left for that process to dispatch
+DELETE FROM timers
+WHERE (channel_id, message_id) IN (SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[])) AND claimed_by = $3
+RETURNING channel_id, message_id
+-- :endmacro
+
+-- :macro delete_channels()
+-- params: channel_ids
+WITH
+	deleted_timers AS (DELETE FROM timers WHERE channel_id = ANY ($1::BIGINT[])),
+	deleted_expiries AS (DELETE FROM expiries WHERE channel_id = ANY ($1::BIGINT[])),
+	deleted_last_timer_changes AS (DELETE FROM last_timer_changes WHERE channel_id = ANY ($1::BIGINT[])),
+	deleted_failed_deletions AS (DELETE FROM failed_deletions WHERE channel_id = ANY ($1::BIGINT[]))
+DELETE FROM watermarks WHERE channel_id = ANY ($1::BIGINT[])
+-- :endmacro
+
+-- :macro delete_guild()
+-- params: guild_id, channel_ids
+WITH
+	-- every statement here sees the tables as they were before any of them ran
+	channels AS (
+		SELECT unnest($2::BIGINT[]) AS channel_id
+		UNION SELECT channel_id FROM expiries WHERE guild_id = $1),
+	deleted_timers AS (DELETE FROM timers WHERE channel_id IN (SELECT channel_id FROM channels)),
+	deleted_expiries AS (DELETE FROM expiries WHERE guild_id = $1),
+	deleted_last_timer_changes AS (DELETE FROM last_timer_changes WHERE guild_id = $1),
+	deleted_failed_deletions AS (
+		DELETE FROM failed_deletions WHERE guild_id = $1 OR channel_id IN (SELECT channel_id FROM channels))
+DELETE FROM watermarks WHERE guild_id = $1
+-- :endmacro
+
+-- :macro save_failed_deletions()
+-- params: guild_id, channel_id, message_ids, expirations, attempts, retry_at
+INSERT INTO failed_deletions (guild_id, channel_id, message_id, expires, attempts, retry_at)
+SELECT $1, $2, message_id, expires, attempts, $6
+FROM unnest($3::BIGINT[], $4::TIMESTAMP WITHOUT TIME ZONE[], $5::INTEGER[]) AS t (message_id, expires, attempts)
+ON CONFLICT (channel_id, message_id) DO UPDATE SET
+	attempts = EXCLUDED.attempts,
+	retry_at = EXCLUDED.retry_at
+-- :endmacro
+
+-- :macro get_failed_deletions()
+SELECT guild_id, channel_id, message_id, expires, attempts, retry_at
+FROM failed_deletions
+-- :endmacro
+
+-- :macro delete_failed_deletions()
+-- params: channel_ids, message_ids
+DELETE FROM failed_deletions
+WHERE (channel_id, message_id) IN (SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[]))
+-- :endmacro
+
+-- :macro get_watermark()
+-- params: channel_id
+-- the watermark never goes behind the latest timer change, as messages before that may have been sent without a timer
+SELECT coalesce_max(watermarks.message_id, last_timer_changes.message_id)
+FROM (SELECT $1::BIGINT AS channel_id) AS channel
+	LEFT JOIN watermarks USING (channel_id)
+	LEFT JOIN last_timer_changes USING (channel_id)
+-- :endmacro
+
+-- :macro set_watermark()
+-- params: guild_id, channel_id, message_id
+INSERT INTO watermarks (guild_id, channel_id, message_id)
+VALUES ($1, $2, $3)
+ON CONFLICT (channel_id) DO UPDATE
+	SET message_id = coalesce_max(watermarks.message_id, EXCLUDED.message_id)
+-- :endmacro
+
+-- :macro delete_watermark()
+-- params: channel_id
+DELETE FROM watermarks
+WHERE channel_id = $1
+-- :endmacro
+
+-- :macro get_kept_message_ids()
+-- params: channel_id, message_id (exclusive lower bound), message_id (inclusive upper bound)
+SELECT message_id
+FROM timers
+WHERE channel_id = $1 AND message_id > $2 AND message_id <= $3
+UNION ALL
+SELECT message_id
+FROM last_timer_changes
+WHERE channel_id = $1 AND message_id > $2 AND message_id <= $3
+-- :endmacro
+
+-- :macro get_timer_partitions()
+SELECT
+	child.relname AS name, pg_get_expr(child.relpartbound, child.oid) AS bound,
+	pg_inherits.inhdetachpending AS detach_pending
+FROM pg_inherits
+	INNER JOIN pg_class AS parent ON pg_inherits.inhparent = parent.oid
+	INNER JOIN pg_class AS child ON pg_inherits.inhrelid = child.oid
+WHERE parent.relname = 'timers'
+-- :endmacro
+
+-- :macro create_timer_partition()
+-- params: start, end
+SELECT create_timer_partition($1, $2)
+-- :endmacro
+
+-- :macro get_retimed_expirations()
+-- params: channel_id, expiry, now
+-- the new expirations of the timers retime_channel_timers would move, so that partitions can be made for them
+SELECT DISTINCT snowflake_time(message_id) + $2 AS expires
+FROM timers
+WHERE channel_id = $1 AND snowflake_time(message_id) + $2 > $3
+-- :endmacro
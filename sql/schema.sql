@@ -28,12 +28,58 @@ CREATE TABLE timers(
 	channel_id BIGINT NOT NULL,
 	message_id BIGINT NOT NULL,
 	expires TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+	-- the process that is going to dispatch this timer, when timer_dispatch is 'claim'
+	claimed_by TEXT,
+	claimed_until TIMESTAMP WITHOUT TIME ZONE,
 
 	-- ordered by access pattern
 	PRIMARY KEY (message_id, channel_id));
 
 -- for getting the soonest timer
 CREATE INDEX "timers_expires_idx" ON timers (expires);
+-- for deleting the timers of deleted channels and guilds, and finding the soonest and latest timer of a channel
+CREATE INDEX "timers_channel_id_idx" ON timers (channel_id, expires);
+-- for renewing and releasing claims
+CREATE INDEX "timers_claimed_by_idx" ON timers (claimed_by) WHERE claimed_by IS NOT NULL;
+
+-- pending timers per channel and per guild, kept up to date by triggers on timers (see functions.sql),
+-- so that finding the busiest channels doesn't take counting the whole timers table
+CREATE TABLE timer_counts(
+	guild_id BIGINT NOT NULL,
+	channel_id BIGINT PRIMARY KEY,
+	pending BIGINT NOT NULL,
+	earliest TIMESTAMP WITHOUT TIME ZONE,
+	latest TIMESTAMP WITHOUT TIME ZONE);
+
+CREATE INDEX timer_counts_guild_id_idx ON timer_counts (guild_id);
+
+CREATE TABLE guild_timer_counts(
+	guild_id BIGINT PRIMARY KEY,
+	pending BIGINT NOT NULL,
+	earliest TIMESTAMP WITHOUT TIME ZONE,
+	latest TIMESTAMP WITHOUT TIME ZONE);
+
+-- messages whose deletion failed for reasons that may be temporary, to be retried (see utils/retry.py)
+CREATE TABLE failed_deletions(
+	-- NULL if the guild of the channel wasn't known
+	guild_id BIGINT,
+	channel_id BIGINT NOT NULL,
+	message_id BIGINT NOT NULL,
+	-- NULL if the message had no timer, eg if it was deleted by timer sweep
+	expires TIMESTAMP WITHOUT TIME ZONE,
+	attempts INTEGER NOT NULL,
+	retry_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+
+	PRIMARY KEY (channel_id, message_id));
+
+CREATE INDEX failed_deletions_guild_id_idx ON failed_deletions (guild_id);
+
+-- used instead of timers when the timer_storage config option is 'watermark'
+CREATE TABLE watermarks(
+	guild_id BIGINT NOT NULL,
+	channel_id BIGINT PRIMARY KEY,
+	-- the last message that was deleted or deliberately kept
+	message_id BIGINT NOT NULL);
 
 -- consider setting a timer for an invalid future date instead of using this table
 -- that would obviate a full outer join and insertion into this table
@@ -0,0 +1,102 @@
+import asyncio
+import random
+import tracemalloc
+
+from utils import keep as keep_module
+from utils.keep import KeptMessages
+
+def test_consumed_ids_dont_count_toward_max_size():
+	async def run():
+		keep = KeptMessages(max_size=2)
+		keep.add(1, 1)
+		assert await keep.consume(1, 1)
+		keep.add(1, 2)
+		keep.add(2, 3)
+		assert len(keep) == 2
+		assert await keep.consume(1, 2)
+		assert await keep.consume(2, 3)
+		assert not keep.channels
+
+	asyncio.run(run())
+
+def test_oldest_ids_are_evicted():
+	async def run():
+		keep = KeptMessages(max_size=2)
+		for message_id in range(1, 4):
+			keep.add(1, message_id)
+		assert len(keep) == 2
+		assert not await keep.consume(1, 1)
+		assert await keep.consume(1, 2)
+		assert await keep.consume(1, 3)
+		assert len(keep) == 0
+
+	asyncio.run(run())
+
+def test_holds_doesnt_consume():
+	async def run():
+		keep = KeptMessages()
+		keep.add(1, 1)
+		assert keep.holds(1, 1)
+		assert not keep.holds(1, 2)
+		assert not keep.holds(2, 1)
+		assert await keep.consume(1, 1)
+		assert not keep.holds(1, 1)
+
+	asyncio.run(run())
+
+def test_ids_expire(monkeypatch):
+	now = 0.0
+	monkeypatch.setattr(keep_module.time, 'monotonic', lambda: now)
+
+	async def run():
+		nonlocal now
+		keep = KeptMessages(ttl=60)
+		keep.add(1, 1)
+		now = 30
+		keep.add(1, 2)
+		now = 61
+		# expiry happens as IDs are added and consumed
+		keep.add(2, 3)
+		assert not await keep.consume(1, 1)
+		assert await keep.consume(1, 2)
+		assert await keep.consume(2, 3)
+		now = 200
+		keep.add(2, 4)
+		assert len(keep.queue) == 1
+
+	asyncio.run(run())
+
+def test_memory_stays_flat():
+	"""like benchmarks/keep.py, on a smaller scale"""
+	max_size = 1_000
+	messages = 200_000
+	checkpoints = 10
+
+	async def run():
+		keep = KeptMessages(ttl=60, max_size=max_size)
+		rng = random.Random(0)
+		results = []
+
+		tracemalloc.start()
+		try:
+			baseline = tracemalloc.get_traced_memory()[0]
+			for message_id in range(1, messages + 1):
+				channel_id = rng.randrange(100_000)
+				if message_id % 10 == 0:
+					async with keep.sending(channel_id):
+						keep.add(channel_id, message_id)
+				# some of those messages never arrive
+				if message_id % 100 != 0:
+					await keep.consume(channel_id, message_id)
+
+				if message_id % (messages // checkpoints) == 0:
+					assert len(keep) <= max_size
+					assert len(keep.queue) <= 2 * max_size
+					assert len(keep.channels) <= max_size
+					results.append(tracemalloc.get_traced_memory()[0] - baseline)
+		finally:
+			tracemalloc.stop()
+		return results
+
+	results = asyncio.run(run())
+	assert results[-1] <= 2 * results[len(results) // 2] + 64 * 1024
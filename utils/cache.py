@@ -0,0 +1,102 @@
+import collections
+
+MISSING = object()
+
+class ExpiryCache:
+	"""Bounded LRU mapping of channel ID to expiry.
+
+	Channels known to have no expiry are cached as None.
+	Once every row of the expiries table has been loaded, the cache is "complete",
+	and any channel not in it is known to have no expiry, so no negative entries need to be stored.
+	Channels that were discarded while complete are the exception: they're unknown until they're set again.
+	"""
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = collections.OrderedDict()
+		self.complete = False
+		# channels not in entries whose expiry isn't known, even though the cache is complete
+		self.unknown = set()
+		self.hits = self.misses = 0
+		self._loading = False
+		self._touched = set()
+
+	def __repr__(self):
+		return '<{} size={} complete={} hits={} misses={}>'.format(
+			type(self).__qualname__, len(self.entries), self.complete, self.hits, self.misses)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, channel_id):
+		"""return the cached expiry for this channel, None if it has none, or MISSING if it's not known"""
+		try:
+			expiry = self.entries[channel_id]
+		except KeyError:
+			if self.complete and channel_id not in self.unknown:
+				self.hits += 1
+				return None
+			self.misses += 1
+			return MISSING
+
+		self.entries.move_to_end(channel_id)
+		self.hits += 1
+		return expiry
+
+	def set(self, channel_id, expiry):
+		if self._loading:
+			self._touched.add(channel_id)
+		self.unknown.discard(channel_id)
+		if expiry is None and self.complete:
+			self.entries.pop(channel_id, None)
+			return
+
+		self.entries[channel_id] = expiry
+		self.entries.move_to_end(channel_id)
+		self._evict()
+
+	def discard(self, channel_id):
+		"""forget what we know about this channel, eg because a write to it may have been rolled back"""
+		if self._loading:
+			self._touched.add(channel_id)
+		self.entries.pop(channel_id, None)
+		# whether or not it was cached, its absence no longer means it has no expiry
+		self.unknown.add(channel_id)
+
+	def begin_load(self):
+		self._loading = True
+		self._touched.clear()
+
+	def finish_load(self, rows, stale=()):
+		"""populate the cache from an iterable of (channel_id, expiry) pairs representing the whole expiries table.
+		Channels changed since begin_load() was called are left alone.
+		Cached channels in stale that aren't in rows are forgotten.
+		"""
+		complete = True
+		loaded = set()
+		for channel_id, expiry in rows:
+			loaded.add(channel_id)
+			if channel_id in self._touched:
+				continue
+			if len(self.entries) >= self.max_size:
+				complete = False
+				break
+			self.entries[channel_id] = expiry
+
+		for channel_id in stale:
+			if channel_id not in loaded and channel_id not in self._touched:
+				self.entries.pop(channel_id, None)
+		# the rows are up to date for every channel not changed since begin_load()
+		self.unknown &= self._touched
+		self._loading = False
+		self._touched.clear()
+		if complete:
+			# negative entries are implied now
+			for channel_id in [channel_id for channel_id, expiry in self.entries.items() if expiry is None]:
+				del self.entries[channel_id]
+		self.complete = complete
+
+	def _evict(self):
+		while len(self.entries) > self.max_size:
+			_, expiry = self.entries.popitem(last=False)
+			if expiry is not None:
+				self.complete = False
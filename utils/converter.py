@@ -1,4 +1,6 @@
+import collections
 import re
+import time
 
 import discord
 from discord.ext.commands import Converter, clean_content, errors
@@ -13,6 +15,43 @@ MESSAGE_LINK_RE = re.compile(
 	r'(?:([0-9]{15,21})|(@me))'
 	r'/(?P<channel_id>[0-9]{15,21})/(?P<message_id>[0-9]{15,21})$')
 
+class FetchedMessages:
+	"""Remembers messages fetched from the API for ttl seconds, so that asking about the same message again is free.
+
+	At most max_size messages are remembered, forgetting the oldest first.
+	"""
+	def __init__(self, *, ttl=60, max_size=1000):
+		self.ttl = ttl
+		self.max_size = max_size
+		# (channel_id, message_id): (forget_at, message), oldest first
+		self.messages = collections.OrderedDict()
+
+	def get(self, channel_id, message_id):
+		self._expire(time.monotonic())
+		try:
+			return self.messages[channel_id, message_id][1]
+		except KeyError:
+			return None
+
+	def add(self, message):
+		key = message.channel.id, message.id
+		self.messages.pop(key, None)
+		self.messages[key] = time.monotonic() + self.ttl, message
+		if len(self.messages) > self.max_size:
+			self.messages.popitem(last=False)
+
+	def _expire(self, now):
+		messages = self.messages
+		while messages and next(iter(messages.values()))[0] <= now:
+			messages.popitem(last=False)
+
+# shared by every Message converter, so that it outlives the command invocation
+fetched_messages = FetchedMessages()
+
+def get_known_message(bot, channel_id, message_id):
+	"""return the given message if it's cached or was fetched recently, otherwise None"""
+	return bot.get_cached_message(channel_id, message_id) or fetched_messages.get(channel_id, message_id)
+
 class MessageId(Converter):
 	"""Match message_id, channel-message_id, or jump url to a discord.Channel, message_id pair
 
@@ -45,7 +84,7 @@ class Message(Converter):
 	async def convert(self, ctx, argument):
 		channel, msg_id = await MessageId().convert(ctx, argument)
 
-		msg = discord.utils.get(ctx.bot.cached_messages, id=msg_id)
+		msg = get_known_message(ctx.bot, channel.id, msg_id)
 		if msg is None:
 			try:
 				msg = await channel.fetch_message(msg_id)
@@ -53,6 +92,5 @@ class Message(Converter):
 				raise errors.BadArgument(f'Message {msg_id} not found in channel {channel.mention}.')
 			except discord.Forbidden:
 				raise errors.CheckFailure(f"I don't have permission to view channel {channel.mention}.")
-		elif msg.channel.id != channel.id:
-			raise errors.BadArgument('Message not found.')
+			fetched_messages.add(msg)
 		return msg
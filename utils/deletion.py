@@ -0,0 +1,333 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+import discord
+
+from utils import metrics
+from utils.fair import FairSemaphore
+from utils.ratelimit import RateLimiter
+from utils.retry import BULK_DELETE_TOO_OLD, RETRY_KEY, is_permanent
+
+logger = logging.getLogger(__name__)
+
+# Discord refuses to bulk delete more messages than this at once
+BULK_DELETE_LIMIT = 100
+# or messages older than this
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14)
+# leave some room for time spent waiting on rate limits between the age check and the API call
+BULK_DELETE_LEEWAY = datetime.timedelta(minutes=5)
+# how long, in seconds, and how many of the messages we deleted to remember,
+# so that the message delete events for them can be told apart from anyone else's deletions
+RECENTLY_DELETED_TTL = 60
+RECENTLY_DELETED_MAX_SIZE = 100_000
+# the most channels whose deletion backlog is exported as a metric, so that the number of series stays bounded
+BACKLOG_METRIC_CHANNELS = 50
+
+def bulk_delete_cutoff():
+	"""return the lowest message ID that may still be bulk deleted"""
+	return discord.utils.time_snowflake(datetime.datetime.utcnow() - BULK_DELETE_MAX_AGE + BULK_DELETE_LEEWAY)
+
+DELETE_LATENCY = metrics.Histogram(
+	'chrona_delete_request_seconds', 'Duration of message deletion API calls', ['route'])
+DELETE_FAILURES = metrics.Counter(
+	'chrona_delete_request_failures_total', 'Failed message deletion API calls', ['route', 'status'])
+MESSAGES_DELETED = metrics.Counter('chrona_messages_deleted_total', 'Messages deleted')
+DELETIONS_DROPPED = metrics.Counter(
+	'chrona_deletions_dropped_total', 'Messages that could not be deleted and will not be retried')
+DELETION_LAG = metrics.Histogram(
+	'chrona_deletion_lag_seconds', 'Time between a message expiring and it being deleted')
+
+def chunks(xs, n):
+	for i in range(0, len(xs), n):
+		yield xs[i:i+n]
+
+def group_by_channel(timers):
+	"""return a mapping of channel ID to {message_id: expires} for the given timers"""
+	channels = collections.defaultdict(dict)
+	for timer in timers:
+		channels[timer.channel_id][timer.message_id] = timer.expires
+	return channels
+
+class MessageDeleter:
+	"""Deletes messages by ID, using as few API calls as possible.
+
+	Deletions are queued per channel, and each channel's queue is worked on separately, so a channel whose
+	rate limit is exhausted only holds up its own deletions. While a channel's deletions are in flight,
+	any new deletions for that channel are coalesced into the next batch.
+
+	API calls are shared out round-robin between guilds once there are more waiting than concurrency allows,
+	and each guild may have at most guild_concurrency in flight, so that a burst of expirations in one guild
+	doesn't hold up every other guild's deletions.
+
+	If retries is set to a RetryQueue, deletions that fail for reasons that may be temporary are handed to it,
+	and so are deletions that were yet to finish when the deleter is closed, since their timers are already gone.
+	"""
+	def __init__(self, bot, *, concurrency, global_rate, guild_concurrency=4):
+		self.bot = bot
+		self.pending = {}  # channel_id: {message_id: expires or None}
+		# channel_id: {message_id: expires or None}, the batch each channel's worker is deleting
+		self.deleting = {}
+		self.workers = {}  # channel_id: asyncio.Task
+		self.guilds = {}  # channel_id: guild_id, for channels with messages waiting to be deleted
+		self.ratelimits = RateLimiter(global_rate=global_rate)
+		self.in_flight = FairSemaphore(concurrency, per_key=guild_concurrency)
+		self.retries = None
+		# the longest any message deleted so far waited after expiring, in seconds
+		self.max_lag = 0.0
+		self.closed = False
+		self.save_task = None
+		# (channel_id, message_id): when we started deleting it, oldest first
+		self.recently_deleted = collections.OrderedDict()
+		metrics.CallbackGauge(
+			'chrona_deletion_backlog', 'Messages waiting to be deleted', lambda: sum(self.backlog().values()))
+		metrics.CallbackGauge(
+			'chrona_deletion_busy_channels', 'Channels with messages waiting to be deleted', lambda: len(self.workers))
+		metrics.CallbackGauge(
+			'chrona_channel_deletion_backlog',
+			f'Messages waiting to be deleted in each of the {BACKLOG_METRIC_CHANNELS} channels with the most',
+			lambda: {(channel_id,): count for channel_id, count in self.backlog(BACKLOG_METRIC_CHANNELS).items()},
+			['channel'])
+		metrics.CallbackGauge(
+			'chrona_guild_deletion_lag_seconds',
+			'How long the oldest expired message waiting to be deleted in each guild has been expired',
+			lambda: {(guild_id,): lag for guild_id, lag in self.guild_lags().items()},
+			['guild'])
+
+	def submit(self, channel_id, message_ids, expires=None, *, guild_id=None):
+		"""queue messages for deletion. message_ids may also be a mapping of message ID to expiration."""
+		if guild_id is not None:
+			self.guilds[channel_id] = guild_id
+		if not isinstance(message_ids, dict):
+			message_ids = dict.fromkeys(message_ids, expires)
+		pending = self.pending.setdefault(channel_id, {})
+		for message_id, expires in message_ids.items():
+			pending.setdefault(message_id, expires)
+
+		if self.closed:
+			# eg timers dispatched while the bot is shutting down
+			self._save_unfinished()
+		elif channel_id not in self.workers:
+			self.workers[channel_id] = self.bot.loop.create_task(self._drain(channel_id))
+
+	def submit_timers(self, timers):
+		guilds = {timer.channel_id: timer.guild_id for timer in timers}
+		for channel_id, message_ids in group_by_channel(timers).items():
+			self.submit(channel_id, message_ids, guild_id=guilds[channel_id])
+
+	def close(self):
+		"""stop deleting messages. return a task that saves those yet to be deleted, to be retried when next loaded,
+		or None if there are none.
+		"""
+		if self.closed:
+			return self.save_task
+		self.closed = True
+		# batches in flight may or may not have been deleted, but deleting them again is harmless
+		for channel_id, message_ids in self.deleting.items():
+			pending = self.pending.setdefault(channel_id, {})
+			for message_id, expires in message_ids.items():
+				pending.setdefault(message_id, expires)
+		for task in self.workers.values():
+			task.cancel()
+		if self.retries is not None:
+			self.retries.close()
+		self._save_unfinished()
+		return self.save_task
+
+	def _save_unfinished(self):
+		if not self.pending or self.save_task is not None and not self.save_task.done():
+			return
+		if self.retries is None:
+			logger.warning(
+				'Not deleting %d messages, as there is no retry queue to save them to',
+				sum(map(len, self.pending.values())))
+			self.pending.clear()
+			return
+		self.save_task = self.bot.loop.create_task(self._save_pending())
+
+	async def _save_pending(self):
+		# more may be submitted while saving
+		while self.pending:
+			pending, self.pending = self.pending, {}
+			logger.info('Saving %d messages yet to be deleted, to be retried', sum(map(len, pending.values())))
+			for channel_id, message_ids in pending.items():
+				await self.retries.save_unfinished(channel_id, self.guilds.get(channel_id), message_ids)
+
+	def forget(self, channel_id, message_ids=None):
+		"""stop waiting to delete the given messages, or every message in the channel, because they're already gone"""
+		if self.retries is not None:
+			self.retries.forget(channel_id, message_ids)
+		if message_ids is None:
+			self.pending.pop(channel_id, None)
+			if channel_id not in self.workers:
+				self.guilds.pop(channel_id, None)
+			return
+		pending = self.pending.get(channel_id)
+		if pending is not None:
+			for message_id in message_ids:
+				pending.pop(message_id, None)
+
+	def deleted_by_us(self, channel_id, message_id):
+		"""return whether we deleted the given message recently. each deletion is only reported once."""
+		return self.recently_deleted.pop((channel_id, message_id), None) is not None
+
+	def backlog(self, limit=None):
+		"""return a mapping of channel ID to the number of messages waiting to be deleted in that channel,
+		including those being deleted. if limit is given, only the channels with the most are included.
+		"""
+		backlog = collections.Counter({channel_id: len(message_ids) for channel_id, message_ids in self.pending.items()})
+		for channel_id, message_ids in self.deleting.items():
+			backlog[channel_id] += len(message_ids)
+		return dict(backlog.most_common(limit))
+
+	def guild_lags(self):
+		"""return a mapping of guild ID to how many seconds its oldest expired, undeleted message has been expired"""
+		now = datetime.datetime.utcnow()
+		oldest = {}
+		for channel_id, message_ids in self.pending.items():
+			expirations = [expires for expires in message_ids.values() if expires is not None]
+			if not expirations:
+				continue
+			guild_id = self.guilds.get(channel_id, channel_id)
+			expires = min(expirations)
+			if guild_id not in oldest or expires < oldest[guild_id]:
+				oldest[guild_id] = expires
+		return {guild_id: max(0, (now - expires).total_seconds()) for guild_id, expires in oldest.items()}
+
+	def stats(self):
+		lags = DELETION_LAG.children[()]
+		guild_lags = self.guild_lags()
+		return dict(
+			backlog=sum(self.backlog().values()),
+			busy_channels=len(self.workers),
+			waiting_calls=self.in_flight.waiting(),
+			lag_p50=lags.quantile(0.5),
+			lag_p99=lags.quantile(0.99),
+			lag_max=self.max_lag,
+			busiest_channels=self.backlog(5),
+			lagging_guilds=dict(sorted(guild_lags.items(), key=lambda item: item[1], reverse=True)[:5]),
+			retries=None if self.retries is None else self.retries.stats())
+
+	async def _drain(self, channel_id):
+		try:
+			while True:
+				message_ids = self.pending.pop(channel_id, None)
+				if not message_ids:
+					return
+				self.deleting[channel_id] = message_ids
+				await self.delete_messages(channel_id, message_ids)
+				del self.deleting[channel_id]
+		finally:
+			del self.workers[channel_id]
+			if not self.closed:
+				# unfinished deletions still need it to be saved
+				self.deleting.pop(channel_id, None)
+				self.guilds.pop(channel_id, None)
+			self.ratelimits.forget(channel_id)
+
+	async def _request(self, key, fair_key, func, *args):
+		while True:
+			# wait on the bucket before taking our turn, so that a channel that's rate limited doesn't hold up others.
+			# the global rate limit is waited on during our turn, so that it's also shared out fairly.
+			await self.ratelimits.wait(key)
+			async with self.in_flight.slot(fair_key):
+				if not await self.ratelimits.acquire(key):
+					# the bucket filled up while we waited for our turn
+					continue
+				self.ratelimits.attach(self.bot.http)
+				route = key[0]
+				start = time.perf_counter()
+				try:
+					return await func(*args)
+				except discord.HTTPException as exc:
+					DELETE_FAILURES.labels(route, exc.status).inc()
+					raise
+				except (OSError, asyncio.TimeoutError) as exc:
+					DELETE_FAILURES.labels(route, type(exc).__name__).inc()
+					raise
+				finally:
+					DELETE_LATENCY.labels(route).observe(time.perf_counter() - start)
+
+	def _remember_deleted(self, channel_id, message_ids):
+		# before the API call, as the gateway may tell us of the deletion before the call returns
+		deleted_at = time.monotonic()
+		recent = self.recently_deleted
+		for message_id in message_ids:
+			recent[channel_id, message_id] = deleted_at
+		while recent and (
+			len(recent) > RECENTLY_DELETED_MAX_SIZE or next(iter(recent.values())) < deleted_at - RECENTLY_DELETED_TTL
+		):
+			recent.popitem(last=False)
+
+	def _record_lag(self, message_ids, expirations):
+		now = datetime.datetime.utcnow()
+		MESSAGES_DELETED.inc(len(message_ids))
+		for message_id in message_ids:
+			expires = expirations.get(message_id)
+			if expires is not None:
+				lag = max(0, (now - expires).total_seconds())
+				DELETION_LAG.observe(lag)
+				self.max_lag = max(self.max_lag, lag)
+
+	async def delete_messages(self, channel_id, message_ids, *, guild_id=None, retrying=False):
+		"""delete the given messages now. message_ids may also be a mapping of message ID to expiration.
+		return {message_id: expires} of the messages that failed to be deleted for reasons that may be temporary.
+		Unless retrying, those are also handed to the retry queue.
+		"""
+		if guild_id is None:
+			guild_id = self.guilds.get(channel_id)
+		# channels whose guild we don't know are treated as a guild of their own,
+		# and retries all share one turn, so that they can't crowd out new deletions
+		fair_key = RETRY_KEY if retrying else guild_id or channel_id
+		if not isinstance(message_ids, dict):
+			message_ids = dict.fromkeys(message_ids)
+		failed = {}
+
+		def failed_to_delete(ids, exc):
+			for message_id in ids:
+				self.recently_deleted.pop((channel_id, message_id), None)
+			if is_permanent(exc):
+				DELETIONS_DROPPED.inc(len(ids))
+			else:
+				failed.update((message_id, message_ids[message_id]) for message_id in ids)
+
+		cutoff = bulk_delete_cutoff()
+		old, recent = [], []
+		for message_id in sorted(message_ids):
+			(old if message_id < cutoff else recent).append(message_id)
+
+		for chunk in chunks(recent, BULK_DELETE_LIMIT):
+			if len(chunk) == 1:
+				# the bulk delete endpoint requires at least two messages
+				old.extend(chunk)
+				continue
+
+			self._remember_deleted(channel_id, chunk)
+			try:
+				await self._request(
+					('bulk_delete', channel_id), fair_key, self.bot.http.delete_messages, channel_id, chunk)
+			except (discord.HTTPException, OSError, asyncio.TimeoutError) as exc:
+				logger.debug('Bulk deleting %d messages in %d failed: %r', len(chunk), channel_id, exc)
+				if getattr(exc, 'code', None) == BULK_DELETE_TOO_OLD:
+					# they aged out while we waited on rate limits
+					old.extend(chunk)
+				else:
+					failed_to_delete(chunk, exc)
+			else:
+				self._record_lag(chunk, message_ids)
+
+		for message_id in old:
+			self._remember_deleted(channel_id, (message_id,))
+			try:
+				await self._request(('delete', channel_id), fair_key, self.bot.http.delete_message, channel_id, message_id)
+			except (discord.HTTPException, OSError, asyncio.TimeoutError) as exc:
+				logger.debug('Deleting message %d in %d failed: %r', message_id, channel_id, exc)
+				failed_to_delete((message_id,), exc)
+			else:
+				self._record_lag((message_id,), message_ids)
+
+		if failed and not retrying and self.retries is not None:
+			await self.retries.add(channel_id, guild_id, failed)
+		return failed
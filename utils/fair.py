@@ -0,0 +1,93 @@
+import asyncio
+import collections
+import contextlib
+
+class FairSemaphore:
+	"""A semaphore whose waiters are served round-robin by key, with a cap on how many slots each key may hold.
+
+	While there are free slots, keys without waiters are handed one right away, even if other keys are waiting,
+	since those can only be waiting because they're at their cap. Once a backlog builds up, each key with waiters
+	gets a turn in order, so that one key with many waiters can't hold up the others.
+	"""
+	def __init__(self, value, *, per_key):
+		self.value = value
+		self.per_key = per_key
+		self.in_use = 0
+		self.held = collections.Counter()
+		# key: deque of futures. the order of keys is the order in which they get their next turn.
+		self.waiters = collections.OrderedDict()
+
+	def __repr__(self):
+		return f'<{type(self).__qualname__} in_use={self.in_use}/{self.value} waiting_keys={len(self.waiters)}>'
+
+	def waiting(self):
+		return sum(map(len, self.waiters.values()))
+
+	@contextlib.asynccontextmanager
+	async def slot(self, key):
+		await self.acquire(key)
+		try:
+			yield
+		finally:
+			self.release(key)
+
+	async def acquire(self, key):
+		if key not in self.waiters and self._has_room(key):
+			self._take(key)
+			return
+
+		future = asyncio.get_running_loop().create_future()
+		self.waiters.setdefault(key, collections.deque()).append(future)
+		try:
+			await future
+		except asyncio.CancelledError:
+			if future.done() and not future.cancelled():
+				# we were given a slot just as we were cancelled
+				self.release(key)
+			else:
+				self._remove_waiter(key, future)
+			raise
+
+	def release(self, key):
+		self.in_use -= 1
+		self.held[key] -= 1
+		if not self.held[key]:
+			del self.held[key]
+		self._wake()
+
+	def _has_room(self, key):
+		return self.in_use < self.value and self.held[key] < self.per_key
+
+	def _take(self, key):
+		self.in_use += 1
+		self.held[key] += 1
+
+	def _remove_waiter(self, key, future):
+		futures = self.waiters.get(key)
+		if futures is None:
+			return
+		with contextlib.suppress(ValueError):
+			futures.remove(future)
+		if not futures:
+			del self.waiters[key]
+
+	def _wake(self):
+		"""give free slots to waiters, one key at a time"""
+		skipped = 0
+		while self.waiters and self.in_use < self.value and skipped < len(self.waiters):
+			key, futures = next(iter(self.waiters.items()))
+			if self.held[key] >= self.per_key:
+				# at its cap. it keeps its place at the back of the line.
+				self.waiters.move_to_end(key)
+				skipped += 1
+				continue
+
+			skipped = 0
+			future = futures.popleft()
+			if futures:
+				self.waiters.move_to_end(key)
+			else:
+				del self.waiters[key]
+			if not future.done():
+				self._take(key)
+				future.set_result(None)
@@ -0,0 +1,147 @@
+import asyncio
+import collections
+import logging
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = frozenset(('block', 'coalesce', 'catch_up'))
+
+QUEUE_DEPTH = metrics.Gauge('chrona_ingest_queue_depth', 'Messages waiting to be handled')
+OVERFLOWS = metrics.Counter(
+	'chrona_ingest_overflow_total', 'Messages received while the ingest queue was full, by overflow policy', ['policy'])
+DEGRADED_CHANNELS = metrics.Gauge(
+	'chrona_ingest_degraded_channels', 'Channels waiting to be caught up on because their messages were dropped')
+
+class IngestQueue:
+	"""Bounded queue between on_message and the database.
+
+	Messages are handled by a fixed number of workers, so that a flood of messages can't hold more than that many
+	database connections at once. Once max_size messages are waiting, new messages are handled by the overflow policy:
+
+	- 'block': on_message waits until there's room in the queue.
+	- 'coalesce': new messages in each channel are merged into one range of message IDs, which takes up one place
+	  in the queue however many messages it covers. The range is read back from the channel's history when its turn comes.
+	- 'catch_up': new messages are dropped, and the range of dropped messages in each channel is read back
+	  from its history once the queue is empty, like after a restart.
+
+	handle(channel, message_ids) and catch_up(channel, after, before) are coroutine functions that do the work.
+	"""
+	def __init__(self, loop, *, handle, catch_up, max_size, workers, overflow):
+		if overflow not in OVERFLOW_POLICIES:
+			raise ValueError(f'unknown ingest overflow policy {overflow!r}')
+		self.handle = handle
+		self.catch_up = catch_up
+		self.max_size = max_size
+		self.overflow = overflow
+		# (channel, [message_id, ...]), or (channel, [first message ID, last message ID]) of a coalesced range
+		self.items = collections.deque()
+		# messages waiting, counting each coalesced range as one
+		self.depth = 0
+		# channel_id: [first, last] of the range that messages in that channel are being coalesced into
+		self.coalesced = {}
+		# channel_id: [channel, first dropped message ID, last dropped message ID]
+		self.degraded = {}
+		self.nonempty = asyncio.Event()
+		# set while no messages are waiting or being handled
+		self.idle = asyncio.Event()
+		self.idle.set()
+		self.busy = 0
+		self.has_room = asyncio.Event()
+		self.has_room.set()
+		self.workers = [loop.create_task(self._work()) for _ in range(workers)]
+
+	def close(self):
+		"""stop handling messages. return how many were still waiting, which are dropped."""
+		for task in self.workers:
+			task.cancel()
+		return self.depth + len(self.degraded)
+
+	def stats(self):
+		return dict(
+			depth=self.depth,
+			degraded_channels=len(self.degraded),
+			overflows={labels[0]: child.value for labels, child in OVERFLOWS.children.items()})
+
+	async def put(self, message):
+		channel = message.channel
+		if self.depth < self.max_size:
+			self._append(channel, [message.id])
+			return
+
+		OVERFLOWS.labels(self.overflow).inc()
+		if self.overflow == 'block':
+			while self.depth >= self.max_size:
+				await self.has_room.wait()
+			self._append(channel, [message.id])
+		elif self.overflow == 'coalesce':
+			coalesced = self.coalesced.get(channel.id)
+			if coalesced is None:
+				self.coalesced[channel.id] = coalesced = [message.id, message.id]
+				self._append(channel, coalesced, depth=1)
+			else:
+				coalesced[0] = min(coalesced[0], message.id)
+				coalesced[1] = max(coalesced[1], message.id)
+		else:
+			dropped = self.degraded.get(channel.id)
+			if dropped is None:
+				self.degraded[channel.id] = [channel, message.id, message.id]
+				DEGRADED_CHANNELS.set(len(self.degraded))
+				self.nonempty.set()
+				self.idle.clear()
+			else:
+				dropped[2] = message.id
+
+	async def join(self):
+		"""wait until every message received so far has been handled"""
+		await self.idle.wait()
+
+	def _append(self, channel, message_ids, *, depth=None):
+		self.items.append((channel, message_ids))
+		self._set_depth(self.depth + (len(message_ids) if depth is None else depth))
+		self.nonempty.set()
+		self.idle.clear()
+
+	def _set_depth(self, depth):
+		self.depth = depth
+		QUEUE_DEPTH.set(depth)
+		if depth < self.max_size:
+			self.has_room.set()
+		else:
+			self.has_room.clear()
+
+	def _next(self):
+		if self.items:
+			channel, message_ids = self.items.popleft()
+			if self.coalesced.get(channel.id) is message_ids:
+				del self.coalesced[channel.id]
+				self._set_depth(self.depth - 1)
+				first, last = message_ids
+				return self.catch_up(channel, first - 1, last + 1)
+			self._set_depth(self.depth - len(message_ids))
+			return self.handle(channel, message_ids)
+
+		# only catch up once everything else is done, as catching up is the slowest way to handle messages
+		channel_id, (channel, first, last) = self.degraded.popitem()
+		DEGRADED_CHANNELS.set(len(self.degraded))
+		return self.catch_up(channel, first - 1, last + 1)
+
+	async def _work(self):
+		while True:
+			if not self.items and not self.degraded:
+				if not self.busy:
+					self.idle.set()
+				self.nonempty.clear()
+				await self.nonempty.wait()
+				continue
+
+			self.busy += 1
+			try:
+				await self._next()
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				logger.exception('Handling new messages failed')
+			finally:
+				self.busy -= 1
@@ -0,0 +1,120 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+class _Channel:
+	__slots__ = frozenset(('lock', 'message_ids', 'users'))
+
+	def __init__(self):
+		self.lock = asyncio.Lock()
+		self.message_ids = set()
+		# how many coroutines are holding or waiting for the lock
+		self.users = 0
+
+class KeptMessages:
+	"""Remembers messages that on_message should leave alone, such as the bot's own timer change announcements.
+
+	A message is sent and its ID remembered inside sending(channel_id). The gateway may deliver the message before
+	the send returns, so on_message for that channel waits until it's done. Channels with nothing to keep and no
+	send in progress have no entry at all, so on_message doesn't have to lock anything for them.
+
+	IDs are forgotten after ttl seconds in case their message is never received, and at most max_size are remembered.
+	"""
+	def __init__(self, *, ttl=60, max_size=10_000):
+		self.ttl = ttl
+		self.max_size = max_size
+		self.channels = {}  # channel_id: _Channel
+		# (forget_at, channel_id, message_id), oldest first. may include IDs that were already consumed,
+		# which are skipped when evicting and dropped once there are more than 2 × max_size entries.
+		self.queue = collections.deque()
+		# how many IDs are remembered
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	def holds(self, channel_id, message_id):
+		"""return whether the given message is to be kept, without forgetting it"""
+		entry = self.channels.get(channel_id)
+		return entry is not None and message_id in entry.message_ids
+
+	@contextlib.asynccontextmanager
+	async def sending(self, channel_id):
+		entry = self._entry(channel_id)
+		entry.users += 1
+		try:
+			async with entry.lock:
+				yield
+		finally:
+			entry.users -= 1
+			self._prune(channel_id, entry)
+
+	def add(self, channel_id, message_id):
+		now = time.monotonic()
+		self._expire(now)
+		entry = self._entry(channel_id)
+		if message_id not in entry.message_ids:
+			entry.message_ids.add(message_id)
+			self.size += 1
+		self.queue.append((now + self.ttl, channel_id, message_id))
+		while self.size > self.max_size:
+			self._forget(*self.queue.popleft()[1:])
+		if len(self.queue) > 2 * self.max_size:
+			self._compact()
+
+	async def consume(self, channel_id, message_id):
+		"""return whether the given message was to be kept, forgetting it if so"""
+		entry = self.channels.get(channel_id)
+		if entry is None:
+			return False
+
+		if entry.lock.locked():
+			entry.users += 1
+			try:
+				async with entry.lock:
+					pass
+			finally:
+				entry.users -= 1
+
+		try:
+			entry.message_ids.remove(message_id)
+		except KeyError:
+			return False
+		else:
+			self.size -= 1
+			return True
+		finally:
+			self._prune(channel_id, entry)
+			self._expire(time.monotonic())
+
+	def _entry(self, channel_id):
+		try:
+			return self.channels[channel_id]
+		except KeyError:
+			entry = self.channels[channel_id] = _Channel()
+			return entry
+
+	def _prune(self, channel_id, entry):
+		if not entry.users and not entry.message_ids and self.channels.get(channel_id) is entry:
+			del self.channels[channel_id]
+
+	def _forget(self, channel_id, message_id):
+		entry = self.channels.get(channel_id)
+		if entry is not None:
+			if message_id in entry.message_ids:
+				entry.message_ids.remove(message_id)
+				self.size -= 1
+			self._prune(channel_id, entry)
+
+	def _compact(self):
+		"""drop queued IDs that were already consumed"""
+		channels = self.channels
+		self.queue = collections.deque(
+			item for item in self.queue
+			if item[1] in channels and item[2] in channels[item[1]].message_ids)
+
+	def _expire(self, now):
+		queue = self.queue
+		while queue and queue[0][0] <= now:
+			self._forget(*queue.popleft()[1:])
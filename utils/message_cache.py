@@ -0,0 +1,46 @@
+import collections
+
+from discord.state import AutoShardedConnectionState
+
+class IndexedMessages(collections.deque):
+	"""discord.py's message cache, plus an index of its messages by (channel_id, message_id).
+
+	discord.py only appends to and removes from its message cache, so those are the only changes the index follows.
+	"""
+	def __init__(self, iterable=(), maxlen=None):
+		super().__init__(iterable, maxlen)
+		self.index = {(message.channel.id, message.id): message for message in self}
+
+	def append(self, message):
+		if self.maxlen is not None and len(self) == self.maxlen:
+			self._unindex(self[0])
+		super().append(message)
+		self.index[message.channel.id, message.id] = message
+
+	def remove(self, message):
+		super().remove(message)
+		self._unindex(message)
+
+	def clear(self):
+		super().clear()
+		self.index.clear()
+
+	def get(self, channel_id, message_id):
+		return self.index.get((channel_id, message_id))
+
+	def _unindex(self, message):
+		key = message.channel.id, message.id
+		if self.index.get(key) is message:
+			del self.index[key]
+
+class IndexedConnectionState(AutoShardedConnectionState):
+	"""An AutoShardedConnectionState whose message cache is indexed, including after it's replaced (eg on reconnect)"""
+	@property
+	def _messages(self):
+		return self.__messages
+
+	@_messages.setter
+	def _messages(self, messages):
+		if messages is not None and not isinstance(messages, IndexedMessages):
+			messages = IndexedMessages(messages, maxlen=messages.maxlen)
+		self.__messages = messages
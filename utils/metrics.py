@@ -0,0 +1,178 @@
+"""Minimal metrics collection, exposed in the Prometheus text format.
+
+Metrics are meant to be cheap enough to update on every message: updating one is a dict lookup and an addition.
+Anything that can be computed when the metrics are scraped should be a CallbackGauge instead.
+"""
+
+import bisect
+import math
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+def _format_labels(names, values):
+	if not names:
+		return ''
+	pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')) for name, value in zip(names, values))
+	return '{' + pairs + '}'
+
+def _format_value(value):
+	if value == math.inf:
+		return '+Inf'
+	return repr(float(value))
+
+class Registry:
+	def __init__(self):
+		self.metrics = {}
+
+	def register(self, metric):
+		# re-registering (eg when a cog is reloaded) replaces the old metric
+		self.metrics[metric.name] = metric
+		return metric
+
+	def render(self):
+		lines = []
+		for metric in self.metrics.values():
+			lines.append(f'# HELP {metric.name} {metric.help}')
+			lines.append(f'# TYPE {metric.name} {metric.type}')
+			lines.extend(metric.render())
+		return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class _Metric:
+	type = None
+
+	def __init__(self, name, help, labels=(), *, registry=REGISTRY):
+		self.name = name
+		self.help = help
+		self.label_names = tuple(labels)
+		self.children = {}
+		if not self.label_names:
+			self.children[()] = self._new_child()
+		registry.register(self)
+
+	def labels(self, *values):
+		try:
+			return self.children[values]
+		except KeyError:
+			child = self.children[values] = self._new_child()
+			return child
+
+	def remove(self, *values):
+		self.children.pop(values, None)
+
+class _CounterChild:
+	__slots__ = ('value',)
+
+	def __init__(self):
+		self.value = 0
+
+	def inc(self, amount=1):
+		self.value += amount
+
+class Counter(_Metric):
+	type = 'counter'
+	_new_child = _CounterChild
+
+	def inc(self, amount=1):
+		self.children[()].value += amount
+
+	def render(self):
+		for values, child in self.children.items():
+			yield f'{self.name}{_format_labels(self.label_names, values)} {_format_value(child.value)}'
+
+class _GaugeChild(_CounterChild):
+	__slots__ = ()
+
+	def set(self, value):
+		self.value = value
+
+	def dec(self, amount=1):
+		self.value -= amount
+
+class Gauge(Counter):
+	type = 'gauge'
+	_new_child = _GaugeChild
+
+	def set(self, value):
+		self.children[()].value = value
+
+class CallbackGauge(_Metric):
+	"""A gauge whose value is computed when it's rendered.
+
+	The callback returns either a number, or if the gauge has labels, a mapping of label value tuples to numbers.
+	"""
+	type = 'gauge'
+
+	def __init__(self, name, help, callback, labels=(), *, registry=REGISTRY):
+		self.callback = callback
+		super().__init__(name, help, labels, registry=registry)
+
+	def _new_child(self):
+		return None
+
+	def render(self):
+		result = self.callback()
+		if not self.label_names:
+			result = {(): result}
+		for values, value in result.items():
+			if value is not None:
+				yield f'{self.name}{_format_labels(self.label_names, values)} {_format_value(value)}'
+
+class _HistogramChild:
+	__slots__ = ('bounds', 'counts', 'sum', 'count')
+
+	def __init__(self, bounds):
+		self.bounds = bounds
+		self.counts = [0] * len(bounds)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value):
+		i = bisect.bisect_left(self.bounds, value)
+		if i < len(self.counts):
+			self.counts[i] += 1
+		self.sum += value
+		self.count += 1
+
+	def quantile(self, q):
+		"""estimate a quantile as the upper bound of the bucket it falls in"""
+		if not self.count:
+			return None
+		target = q * self.count
+		cumulative = 0
+		for bound, count in zip(self.bounds, self.counts):
+			cumulative += count
+			if cumulative >= target:
+				return bound
+		return math.inf
+
+class Histogram(_Metric):
+	type = 'histogram'
+
+	def __init__(self, name, help, labels=(), *, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+		self.bounds = tuple(sorted(buckets))
+		super().__init__(name, help, labels, registry=registry)
+
+	def _new_child(self):
+		return _HistogramChild(self.bounds)
+
+	def observe(self, value):
+		self.children[()].observe(value)
+
+	def render(self):
+		for values, child in self.children.items():
+			cumulative = 0
+			for bound, count in zip(self.bounds, child.counts):
+				cumulative += count
+				labels = _format_labels(self.label_names + ('le',), values + (_format_value(bound),))
+				yield f'{self.name}_bucket{labels} {cumulative}'
+			labels = _format_labels(self.label_names + ('le',), values + ('+Inf',))
+			yield f'{self.name}_bucket{labels} {child.count}'
+			labels = _format_labels(self.label_names, values)
+			yield f'{self.name}_sum{labels} {_format_value(child.sum)}'
+			yield f'{self.name}_count{labels} {child.count}'
+
+class CallbackCounter(CallbackGauge):
+	"""A counter whose value is read from elsewhere when it's rendered."""
+	type = 'counter'
@@ -0,0 +1,14 @@
+import jinja2.runtime
+
+class RenderedQueries:
+	"""The query macros of a template module, rendered once into plain SQL strings.
+
+	Every macro becomes an attribute of the same name, rendered without arguments.
+	Macros that take arguments may also be rendered under other names, given as name=(macro_name, *args).
+	"""
+	def __init__(self, module, **variants):
+		for name, macro in vars(module).items():
+			if isinstance(macro, jinja2.runtime.Macro):
+				setattr(self, name, str(macro()))
+		for name, (macro_name, *args) in variants.items():
+			setattr(self, name, str(getattr(module, macro_name)(*args)))
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import re
+import time
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_ROUTE_RE = re.compile(r'/channels/(?P<channel_id>[0-9]+)/messages/(?P<message>bulk[-_]delete|[0-9]+)$')
+
+# used until Discord tells us the real limits of a bucket
+DEFAULT_LIMIT = 5
+DEFAULT_PER = 1.0
+
+class Bucket:
+	"""Token accounting for one rate limit bucket."""
+	__slots__ = frozenset(('limit', 'per', 'remaining', 'reset_at'))
+
+	def __init__(self, limit, per):
+		self.limit = limit
+		self.per = per
+		self.remaining = limit
+		self.reset_at = 0.0
+
+	def __repr__(self):
+		return f'<{type(self).__qualname__} limit={self.limit} remaining={self.remaining} reset_at={self.reset_at}>'
+
+	def delay(self, now):
+		"""return how long to wait before a request may be made"""
+		if now >= self.reset_at or self.remaining > 0:
+			return 0.0
+		return self.reset_at - now
+
+	def consume(self, now):
+		if now >= self.reset_at:
+			self.remaining = self.limit
+			self.reset_at = now + self.per
+		self.remaining -= 1
+
+	def update(self, limit, remaining, reset_after, now):
+		self.limit = limit
+		self.remaining = remaining
+		self.per = max(self.per, reset_after)
+		self.reset_at = now + reset_after
+
+class RateLimiter:
+	"""Tracks Discord's rate limit buckets for message deletion routes, keyed by (route, channel_id).
+
+	Bucket state is learned from the X-RateLimit-* headers of responses, which are read using an aiohttp trace
+	hook on the HTTP client's session. If that's not possible, conservative defaults are used.
+	"""
+	def __init__(self, *, global_rate):
+		self.buckets = {}
+		self.global_bucket = Bucket(global_rate, 1.0)
+		self.trace_config = aiohttp.TraceConfig()
+		self.trace_config.on_request_end.append(self._on_request_end)
+		self.trace_config.freeze()
+		self._traced_session = None
+
+	def bucket(self, key):
+		try:
+			return self.buckets[key]
+		except KeyError:
+			bucket = self.buckets[key] = Bucket(DEFAULT_LIMIT, DEFAULT_PER)
+			return bucket
+
+	async def wait(self, key):
+		"""wait until the given bucket has room for a request, regardless of the global rate limit"""
+		while True:
+			delay = self.bucket(key).delay(time.monotonic())
+			if delay <= 0:
+				return
+			await asyncio.sleep(delay)
+
+	async def acquire(self, key):
+		"""wait until the global rate limit allows a request, then account for it in the given bucket.
+		return False right away if the bucket itself has no room, eg because another request took it since wait().
+		"""
+		while True:
+			now = time.monotonic()
+			bucket = self.bucket(key)
+			if bucket.delay(now) > 0:
+				return False
+			delay = self.global_bucket.delay(now)
+			if delay <= 0:
+				bucket.consume(now)
+				self.global_bucket.consume(now)
+				return True
+			await asyncio.sleep(delay)
+
+	def forget(self, channel_id):
+		"""drop the buckets of a channel that no longer has anything to delete, unless they're still limited"""
+		now = time.monotonic()
+		for key in [key for key in self.buckets if key[1] == channel_id]:
+			if self.buckets[key].delay(now) <= 0:
+				del self.buckets[key]
+
+	def attach(self, http):
+		"""make sure the session of the given discord.py HTTPClient reports responses to us"""
+		session = getattr(http, '_HTTPClient__session', None)
+		if session is None or session is self._traced_session:
+			return
+		try:
+			session._trace_configs.append(self.trace_config)
+		except AttributeError:
+			logger.warning('Unable to read rate limit headers; falling back to default rate limits')
+		self._traced_session = session
+
+	async def _on_request_end(self, session, ctx, params):
+		match = MESSAGE_ROUTE_RE.search(params.url.path)
+		if match is None:
+			return
+		route = 'bulk_delete' if match['message'].startswith('bulk') else 'delete'
+		self.update((route, int(match['channel_id'])), params.response.headers)
+
+	def update(self, key, headers):
+		try:
+			limit = int(headers['X-RateLimit-Limit'])
+			remaining = int(headers['X-RateLimit-Remaining'])
+			reset_after = float(headers['X-RateLimit-Reset-After'])
+		except (KeyError, ValueError):
+			return
+		self.bucket(key).update(limit, remaining, reset_after, time.monotonic())
@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import datetime
+import heapq
+import logging
+import random
+
+import asyncpg
+import discord
+
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+# the fair scheduling key that retries share, so that they get at most as many API calls as one busy guild
+RETRY_KEY = 'retries'
+
+# Discord error codes that mean a deletion will never succeed
+PERMANENT_ERROR_CODES = frozenset({
+	10003,  # unknown channel
+	10008,  # unknown message
+	50001,  # missing access
+	50013,  # missing permissions
+})
+# Discord error code for bulk deleting messages that are too old to be bulk deleted
+BULK_DELETE_TOO_OLD = 50034
+
+RETRY_OUTCOMES = metrics.Counter(
+	'chrona_deletion_retries_total',
+	'Messages whose deletion was retried, by outcome: done (deleted or no longer deletable), rescheduled or gave_up',
+	['outcome'])
+
+def is_permanent(exc):
+	"""return whether a deletion that failed with exc will never succeed, so that it's not worth retrying"""
+	if not isinstance(exc, discord.HTTPException):
+		# connection errors and timeouts
+		return False
+	# Discord already retries rate limited and server error responses a few times before giving up,
+	# so these are outages rather than blips, but they still are temporary
+	return exc.code in PERMANENT_ERROR_CODES or exc.status in (400, 403, 404)
+
+class RetryQueue:
+	"""Deletions that failed for reasons that may be temporary, such as a Discord outage, to be tried again later.
+
+	Failed messages are stored in the database, so that they're not forgotten on restart, and retried after
+	a jittered delay that doubles with each attempt, up to max_delay. Every message waiting in a channel is retried
+	at once, so that messages that failed separately during an outage are deleted in bulk once it's over.
+	At most concurrency channels are retried at once, and their API calls share one fair scheduling key
+	(see MessageDeleter), so that recovering from an outage doesn't hold up new deletions.
+	Messages still failing after max_attempts attempts are given up on.
+	"""
+	def __init__(self, deleter, db, *, base_delay, max_delay, max_attempts, concurrency):
+		self.deleter = deleter
+		self.db = db
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.max_attempts = max_attempts
+		self.pending = {}  # channel_id: {message_id: [expires, attempts]}
+		self.guilds = {}  # channel_id: guild_id
+		# (retry_at, channel_id). entries that don't match retry_at are stale.
+		self.heap = []
+		self.retry_at = {}  # channel_id: datetime
+		self.changed = asyncio.Event()
+		self.semaphore = asyncio.Semaphore(concurrency)
+		self.retrying = set()
+		metrics.CallbackGauge(
+			'chrona_deletion_retry_backlog', 'Messages waiting for their deletion to be retried',
+			lambda: sum(map(len, self.pending.values())))
+		loop = deleter.bot.loop
+		self.load_task = loop.create_task(self._load())
+		self.task = loop.create_task(self._run())
+
+	def close(self):
+		self.load_task.cancel()
+		self.task.cancel()
+		for task in self.retrying:
+			task.cancel()
+
+	def stats(self):
+		return dict(
+			backlog=sum(map(len, self.pending.values())),
+			channels=len(self.pending),
+			outcomes={labels[0]: child.value for labels, child in RETRY_OUTCOMES.children.items()})
+
+	async def add(self, channel_id, guild_id, message_ids, attempts=1):
+		"""remember messages whose deletion failed, given as a mapping of message ID to expiration"""
+		messages = {message_id: [expires, attempts] for message_id, expires in message_ids.items()}
+		retry_at = self._schedule(channel_id, guild_id, messages)
+		await self._save(channel_id, guild_id, messages, retry_at)
+
+	async def save_unfinished(self, channel_id, guild_id, message_ids):
+		"""remember messages that were yet to be deleted when the deleter was closed, given as a mapping of message ID
+		to expiration, so that they're deleted once loaded again. they're retried right away, as they didn't fail.
+		"""
+		messages = {message_id: [expires, 0] for message_id, expires in message_ids.items()}
+		await self._save(channel_id, guild_id, messages, datetime.datetime.utcnow())
+
+	def forget(self, channel_id, message_ids=None):
+		"""stop retrying the given messages, or every message in the channel, because they're already gone.
+		Their rows are deleted along with the channel, or found to be gone if they're retried after a restart.
+		"""
+		if message_ids is None:
+			self.pending.pop(channel_id, None)
+			return
+		pending = self.pending.get(channel_id)
+		if pending is not None:
+			for message_id in message_ids:
+				pending.pop(message_id, None)
+
+	def _backoff(self, attempts):
+		delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+		# jitter, so that channels that failed together aren't all retried at the same moment
+		return datetime.timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+	def _schedule(self, channel_id, guild_id, messages):
+		"""add messages to a channel's retries. return when the channel will be retried."""
+		pending = self.pending.setdefault(channel_id, {})
+		pending.update(messages)
+		if guild_id is not None:
+			self.guilds[channel_id] = guild_id
+
+		retry_at = datetime.datetime.utcnow() + self._backoff(min(attempts for _, attempts in messages.values()))
+		current = self.retry_at.get(channel_id)
+		if current is not None and current <= retry_at:
+			return current
+		self.retry_at[channel_id] = retry_at
+		heapq.heappush(self.heap, (retry_at, channel_id))
+		self.changed.set()
+		return retry_at
+
+	async def _load(self):
+		try:
+			rows = await self.db.get_failed_deletions()
+		except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+			logger.error('Loading failed deletions to retry failed: %r', exc)
+			return
+		for row in rows:
+			self.pending.setdefault(row['channel_id'], {})[row['message_id']] = [row['expires'], row['attempts']]
+			self.guilds[row['channel_id']] = row['guild_id']
+			current = self.retry_at.get(row['channel_id'])
+			if current is None or row['retry_at'] < current:
+				self.retry_at[row['channel_id']] = row['retry_at']
+				heapq.heappush(self.heap, (row['retry_at'], row['channel_id']))
+		self.changed.set()
+		if rows:
+			logger.info('Loaded %d failed deletions to retry', len(rows))
+
+	async def _run(self):
+		while True:
+			now = datetime.datetime.utcnow()
+			heap = self.heap
+			while heap and heap[0][0] <= now:
+				retry_at, channel_id = heapq.heappop(heap)
+				if self.retry_at.get(channel_id) != retry_at:
+					continue
+				del self.retry_at[channel_id]
+				await self.semaphore.acquire()
+				task = self.deleter.bot.loop.create_task(self._retry(channel_id))
+				self.retrying.add(task)
+				task.add_done_callback(self._retried)
+
+			self.changed.clear()
+			timeout = (heap[0][0] - now).total_seconds() if heap else None
+			with contextlib.suppress(asyncio.TimeoutError):
+				await asyncio.wait_for(self.changed.wait(), timeout)
+
+	def _retried(self, task):
+		self.retrying.discard(task)
+		self.semaphore.release()
+		if not task.cancelled() and task.exception() is not None:
+			logger.error('Retrying deletions failed', exc_info=task.exception())
+
+	async def _retry(self, channel_id):
+		messages = self.pending.pop(channel_id, None)
+		guild_id = self.guilds.pop(channel_id, None)
+		if not messages:
+			return
+
+		failed = await self.deleter.delete_messages(
+			channel_id, {message_id: expires for message_id, (expires, _) in messages.items()},
+			guild_id=guild_id, retrying=True)
+
+		retry = {}
+		gave_up = 0
+		for message_id, expires in failed.items():
+			attempts = messages[message_id][1] + 1
+			if attempts > self.max_attempts:
+				gave_up += 1
+			else:
+				retry[message_id] = [expires, attempts]
+		RETRY_OUTCOMES.labels('done').inc(len(messages) - len(failed))
+		RETRY_OUTCOMES.labels('rescheduled').inc(len(retry))
+		RETRY_OUTCOMES.labels('gave_up').inc(gave_up)
+		if gave_up:
+			logger.warning('Giving up on deleting %d messages in %d', gave_up, channel_id)
+
+		if retry:
+			retry_at = self._schedule(channel_id, guild_id, retry)
+			await self._save(channel_id, guild_id, retry, retry_at)
+		done = [(channel_id, message_id) for message_id in messages.keys() - retry.keys()]
+		if done:
+			try:
+				await self.db.delete_failed_deletions(done)
+			except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+				# they'll merely be retried again after a restart, and found to be gone
+				logger.warning('Deleting %d retried deletions failed: %r', len(done), exc)
+
+	async def _save(self, channel_id, guild_id, messages, retry_at):
+		try:
+			await self.db.save_failed_deletions(
+				guild_id, channel_id,
+				[(message_id, expires, attempts) for message_id, (expires, attempts) in messages.items()],
+				retry_at)
+		except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as exc:
+			# still retried for as long as we're running
+			logger.warning('Saving %d failed deletions failed: %r', len(messages), exc)
@@ -0,0 +1,212 @@
+import asyncio
+import datetime
+import heapq
+
+from utils.timer_columns import TimerColumns, from_micros, to_micros
+
+# sorts after every timer with the same expiry
+_END = float('inf'), float('inf')
+
+class TimerHeap:
+	"""In-memory window of upcoming timers, refilled incrementally from the database.
+
+	Timers are ordered by their key, (expires, channel_id, message_id).
+	Every timer in the database whose key is at most `loaded_until` is also in the heap (or has been dispatched),
+	so new timers at or before `loaded_until` must be added to the heap, and later ones will be picked up
+	by a future refill.
+	"""
+	def __init__(self, *, timer_class, window: datetime.timedelta, preload_size: int):
+		self.timer_class = timer_class
+		self.window = window
+		self.preload_size = preload_size
+		# (expires, channel_id, message_id, guild_id)
+		self.heap = []
+		# (channel_id, message_id): expires
+		# heap entries that don't match this are stale (the timer was removed or moved sooner) and are skipped
+		self.entries = {}
+		self.loaded_until = None
+		# whether the last refill stopped at preload_size rather than the end of the window
+		self.truncated = False
+		# set whenever the soonest timer changes
+		self.changed = asyncio.Event()
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		"""return whether the timer with the given (channel_id, message_id) is held"""
+		return key in self.entries
+
+	def covers(self, expires, channel_id, message_id):
+		return self.loaded_until is not None and (expires, channel_id, message_id) <= self.loaded_until
+
+	def add(self, timer, *, upsert=True):
+		"""add a timer if it falls within the loaded window. return whether it was added.
+
+		If the timer is already present, it is only moved if upsert is true and the new expiry is sooner.
+		"""
+		if not self.covers(timer.expires, timer.channel_id, timer.message_id):
+			return False
+		self._push(timer.expires, timer.channel_id, timer.message_id, timer.guild_id, upsert=upsert)
+		return True
+
+	def schedule(self, timer):
+		"""add a timer regardless of the loaded window, for timers that are never stored in the database"""
+		self._push(timer.expires, timer.channel_id, timer.message_id, timer.guild_id, upsert=False)
+
+	def _push(self, expires, channel_id, message_id, guild_id, *, upsert=True):
+		old = self.entries.get((channel_id, message_id))
+		if old is not None and (not upsert or old <= expires):
+			return
+
+		soonest = self._peek()
+		self.entries[channel_id, message_id] = expires
+		heapq.heappush(self.heap, (expires, channel_id, message_id, guild_id))
+		if soonest is None or expires < soonest[0]:
+			self.changed.set()
+
+	def discard(self, channel_id, message_id):
+		"""remove a timer. return whether it was present."""
+		return self.entries.pop((channel_id, message_id), None) is not None
+
+	def discard_channels(self, channel_ids):
+		"""remove every timer in the given channels. return how many were removed."""
+		doomed = [key for key in self.entries if key[0] in channel_ids]
+		for key in doomed:
+			del self.entries[key]
+		return len(doomed)
+
+	def _peek(self):
+		heap = self.heap
+		while heap:
+			expires, channel_id, message_id, _ = entry = heap[0]
+			if self.entries.get((channel_id, message_id)) == expires:
+				return entry
+			heapq.heappop(heap)
+		return None
+
+	def _make_timer(self, entry):
+		expires, channel_id, message_id, guild_id = entry
+		return self.timer_class(guild_id=guild_id, channel_id=channel_id, message_id=message_id, expires=expires)
+
+	def peek(self):
+		"""return the soonest timer, or None"""
+		entry = self._peek()
+		return entry and self._make_timer(entry)
+
+	def pop_due(self, before: datetime.datetime, limit: int):
+		"""remove and return up to `limit` timers expiring no later than `before`, soonest first"""
+		timers = []
+		heap = self.heap
+		entries = self.entries
+		while heap and heap[0][0] <= before and len(timers) < limit:
+			entry = heapq.heappop(heap)
+			expires, channel_id, message_id, _ = entry
+			if entries.get((channel_id, message_id)) != expires:
+				continue
+			del entries[channel_id, message_id]
+			timers.append(self._make_timer(entry))
+		return timers
+
+	### refilling
+
+	def invalidate(self):
+		"""forget how far the heap was loaded, so that the next refill loads it from the start again.
+		Used when timers may have been added to the database without being added to the heap.
+		"""
+		self.loaded_until = None
+		self.truncated = False
+		self.changed.set()
+
+	def refill_bounds(self, now: datetime.datetime):
+		"""return (lower bound key, upper bound expiry) of the next refill query"""
+		lower = self.loaded_until or (datetime.datetime.min, 0, 0)
+		return lower, now + self.window
+
+	def needs_refill(self, now: datetime.datetime):
+		if self.loaded_until is None:
+			return True
+		if self.truncated:
+			return len(self) < self.preload_size // 2
+		return self.loaded_until[0] - now < self.window / 2
+
+	def next_refill(self):
+		"""return the time at which the window will next need to be extended, or None if it depends on the heap size"""
+		if self.loaded_until is None or self.truncated:
+			return None
+		return self.loaded_until[0] - self.window / 2
+
+	def extend(self, rows, upper: datetime.datetime, pending=()):
+		"""add rows fetched from the database by a refill query.
+
+		rows must be ordered by key, and the query must have been limited to preload_size rows.
+		pending are timers that may not have been written to the database yet when the query ran.
+		"""
+		for row in rows:
+			self._push(row['expires'], row['channel_id'], row['message_id'], row['guild_id'])
+
+		self.truncated = len(rows) >= self.preload_size
+		if self.truncated:
+			last = rows[-1]
+			self.loaded_until = last['expires'], last['channel_id'], last['message_id']
+		else:
+			self.loaded_until = (upper, *_END)
+
+		for timer in pending:
+			self.add(timer)
+
+class ColumnarTimerHeap(TimerHeap):
+	"""A TimerHeap that keeps its timers in a TimerColumns rather than as a tuple each,
+	for large windows of upcoming timers. Timer objects are only made for timers as they're dispatched.
+	Requires NumPy, as without it every dispatch would scan every timer.
+	"""
+	def __init__(self, **kwargs):
+		super().__init__(**kwargs)
+		self.store = TimerColumns(use_numpy=True)
+
+	def __len__(self):
+		return len(self.store)
+
+	def __contains__(self, key):
+		channel_id, message_id = key
+		return self.store.channel_of(message_id) == channel_id
+
+	def _push(self, expires, channel_id, message_id, guild_id, *, upsert=True):
+		store = self.store
+		micros = to_micros(expires)
+		old = store.get_expires(message_id)
+		if old is not None and (not upsert or old <= micros):
+			return
+
+		soonest = store.soonest()
+		store.add(guild_id, channel_id, message_id, micros)
+		if soonest is None or micros < soonest[0]:
+			self.changed.set()
+
+	def discard(self, channel_id, message_id):
+		if (channel_id, message_id) not in self:
+			return False
+		return self.store.remove(message_id)
+
+	def discard_channels(self, channel_ids):
+		return self.store.remove_channels(channel_ids)
+
+	def _peek(self):
+		row = self.store.soonest()
+		if row is None:
+			return None
+		expires, guild_id, channel_id, message_id = row
+		return from_micros(expires), channel_id, message_id, guild_id
+
+	def pop_due(self, before: datetime.datetime, limit: int):
+		timers = []
+		for channel_id, (guild_id, message_ids, expirations) in self.take_due(before, limit).items():
+			timers.extend(
+				self.timer_class(guild_id=guild_id, channel_id=channel_id, message_id=message_id, expires=from_micros(expires))
+				for message_id, expires in zip(message_ids, expirations))
+		timers.sort(key=lambda timer: (timer.expires, timer.channel_id, timer.message_id))
+		return timers
+
+	def take_due(self, before: datetime.datetime, limit: int):
+		"""like pop_due, but return the timers by channel as TimerColumns.take_due does, without making Timer objects"""
+		return self.store.take_due(to_micros(before), limit)
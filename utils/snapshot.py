@@ -0,0 +1,81 @@
+"""Binary snapshots of timer state, written on shutdown and read back on startup.
+
+Layout, all little endian 64 bit integers:
+- header: magic, when the snapshot was written (microseconds since the epoch), and the number of records in each section
+- timers: (expires in microseconds since the epoch, guild_id, channel_id, message_id)
+- expiries: (channel_id, expiry in microseconds)
+- last seen messages: (channel_id, message_id)
+"""
+
+import datetime
+import mmap
+import os
+import struct
+
+from utils.timer_columns import MICROSECOND, from_micros, to_micros
+
+MAGIC = b'CHRSNAP1'
+HEADER = struct.Struct('<8sqqqq')
+TIMER = struct.Struct('<qqqq')
+EXPIRY = struct.Struct('<qq')
+LAST_SEEN = struct.Struct('<qq')
+
+class Snapshot:
+	def __init__(self, *, written_at, timers, expiries, last_seen):
+		self.written_at = written_at
+		# (expires, guild_id, channel_id, message_id)
+		self.timers = timers
+		self.expiries = expiries  # channel_id: expiry
+		self.last_seen = last_seen  # channel_id: message_id
+
+	def __repr__(self):
+		return '<{} written_at={} timers={} expiries={} last_seen={}>'.format(
+			type(self).__qualname__, self.written_at, len(self.timers), len(self.expiries), len(self.last_seen))
+
+def write(path, *, timers, expiries, last_seen):
+	"""write a snapshot of the given timers, {channel_id: expiry} and {channel_id: message_id} to path.
+	The snapshot is written to a temporary file first, so that path only ever holds a whole snapshot.
+	"""
+	timers = [(to_micros(timer.expires), timer.guild_id, timer.channel_id, timer.message_id) for timer in timers]
+	expiries = [(channel_id, expiry // MICROSECOND) for channel_id, expiry in expiries.items()]
+	last_seen = list(last_seen.items())
+	size = HEADER.size + TIMER.size * len(timers) + EXPIRY.size * len(expiries) + LAST_SEEN.size * len(last_seen)
+
+	temp_path = f'{path}.tmp'
+	with open(temp_path, 'w+b') as f:
+		f.truncate(size)
+		with mmap.mmap(f.fileno(), size) as m:
+			HEADER.pack_into(
+				m, 0, MAGIC, to_micros(datetime.datetime.utcnow()), len(timers), len(expiries), len(last_seen))
+			offset = HEADER.size
+			for record, records in (TIMER, timers), (EXPIRY, expiries), (LAST_SEEN, last_seen):
+				for values in records:
+					record.pack_into(m, offset, *values)
+					offset += record.size
+			m.flush()
+	os.replace(temp_path, path)
+
+def read(path):
+	"""read the snapshot at path. raise ValueError if it isn't a valid snapshot."""
+	with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+		if len(m) < HEADER.size:
+			raise ValueError('snapshot is truncated')
+		magic, written_at, timer_count, expiry_count, last_seen_count = HEADER.unpack_from(m, 0)
+		if magic != MAGIC:
+			raise ValueError('not a snapshot, or a snapshot of an unknown version')
+
+		sections = []
+		offset = HEADER.size
+		for record, count in (TIMER, timer_count), (EXPIRY, expiry_count), (LAST_SEEN, last_seen_count):
+			end = offset + record.size * count
+			if end > len(m):
+				raise ValueError('snapshot is truncated')
+			sections.append(list(record.iter_unpack(m[offset:end])))
+			offset = end
+
+	timers, expiries, last_seen = sections
+	return Snapshot(
+		written_at=from_micros(written_at),
+		timers=[(from_micros(expires), guild_id, channel_id, message_id) for expires, guild_id, channel_id, message_id in timers],
+		expiries={channel_id: datetime.timedelta(microseconds=expiry) for channel_id, expiry in expiries},
+		last_seen=dict(last_seen))
@@ -0,0 +1,94 @@
+import datetime
+import logging
+
+import discord
+
+from utils import sleep
+
+logger = logging.getLogger(__name__)
+
+class WatermarkSweeper:
+	"""Deletes expired messages without storing a timer for each one.
+
+	Each channel only has a watermark: the ID of the last message that was deleted (or deliberately kept).
+	Since message IDs are ordered by time, every message after the watermark and before the snowflake of
+	(now - expiry) has expired. Messages with an explicit timer, and the latest timer change message, are left alone.
+	"""
+	def __init__(self, bot, db, deleter):
+		self.bot = bot
+		self.db = db
+		self.deleter = deleter
+		self.tasks = {}  # channel_id: asyncio.Task
+		# sweeps requested while one was already running, which might not have seen the new messages
+		self.requested = {}  # channel_id: datetime
+
+	def close(self):
+		for task in self.tasks.values():
+			task.cancel()
+
+	def forget(self, channel_id):
+		"""cancel any sweep of a channel that no longer exists"""
+		self.requested.pop(channel_id, None)
+		task = self.tasks.get(channel_id)
+		if task is not None:
+			task.cancel()
+
+	def schedule(self, channel, when: datetime.datetime):
+		"""sweep the channel at the given time, unless a sweep is already scheduled"""
+		# messages arrive in order, so an already scheduled sweep can't be any later than this one
+		if channel.id not in self.tasks:
+			self.tasks[channel.id] = self.bot.loop.create_task(self._sweep_later(channel, when))
+		else:
+			self.requested.setdefault(channel.id, when)
+
+	async def _sweep_later(self, channel, when):
+		try:
+			await sleep((when - datetime.datetime.utcnow()).total_seconds())
+			self.requested.pop(channel.id, None)
+			next_sweep = await self.sweep(channel)
+		finally:
+			del self.tasks[channel.id]
+
+		next_sweep = min(filter(None, (next_sweep, self.requested.pop(channel.id, None))), default=None)
+		if next_sweep is not None:
+			self.schedule(channel, next_sweep)
+
+	async def sweep(self, channel):
+		"""delete every expired message in the channel. return when the next one will expire, if known."""
+		expiry = await self.db.get_expiry(channel)
+		watermark = await self.db.get_watermark(channel.id)
+		if expiry is None or watermark is None:
+			return None
+
+		cutoff = discord.utils.time_snowflake(datetime.datetime.utcnow() - expiry, high=True)
+		if cutoff <= watermark:
+			return discord.utils.snowflake_time(watermark) + expiry
+
+		kept = await self.db.get_kept_message_ids(channel.id, watermark, cutoff)
+		to_delete = {}  # message_id: expires
+		next_sweep = None
+		last_seen = watermark
+		try:
+			async for message in channel.history(after=discord.Object(watermark), limit=None, oldest_first=True):
+				if message.id > cutoff:
+					next_sweep = message.created_at + expiry
+					break
+				last_seen = message.id
+				if message.id not in kept:
+					to_delete[message.id] = message.created_at + expiry
+		except discord.HTTPException as exc:
+			logger.warning('Sweeping channel %d failed: %r', channel.id, exc)
+
+		if to_delete:
+			self.deleter.submit(channel.id, to_delete, guild_id=channel.guild.id)
+		if last_seen != watermark:
+			await self.db.set_watermark(channel, last_seen)
+		return next_sweep
+
+	async def get_message_expiration(self, message):
+		"""return when the given message will be swept, or None if it won't be"""
+		expiry = await self.db.get_expiry(message.channel)
+		watermark = await self.db.get_watermark(message.channel.id)
+		if expiry is None or watermark is None or message.id <= watermark:
+			return None
+		return message.created_at + expiry
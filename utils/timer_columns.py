@@ -0,0 +1,206 @@
+import array
+import datetime
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+# the expiry of removed rows, which is after every real expiry
+REMOVED = 2 ** 63 - 1
+COLUMNS = ('expires', 'guild_id', 'channel_id', 'message_id')
+
+def to_micros(dt):
+	return (dt - EPOCH) // MICROSECOND
+
+def from_micros(micros):
+	return EPOCH + datetime.timedelta(microseconds=int(micros))
+
+class TimerColumns:
+	"""Timers stored as parallel int64 columns of expiry (microseconds since the epoch), guild, channel and message ID,
+	rather than as one object per timer.
+
+	Uses NumPy arrays if NumPy is installed, which makes selecting due timers vectorized,
+	otherwise the standard library's array module. Without NumPy, finding the soonest or due timers
+	scans every row in Python, so that's only good for comparison (see benchmarks/timer_store.py).
+	Timers are identified by message ID alone, since message IDs are unique across channels.
+	Removed rows are only marked as such, and are compacted away once they make up most of the columns.
+	"""
+	def __init__(self, *, use_numpy=None):
+		if use_numpy is None:
+			use_numpy = numpy is not None
+		elif use_numpy and numpy is None:
+			raise RuntimeError('NumPy is not installed')
+		self.use_numpy = use_numpy
+		self.rows = {}  # message_id: row
+		self._clear_columns(0)
+		# row of the soonest timer, or None if that has to be looked up again
+		self._soonest = None
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __contains__(self, message_id):
+		return message_id in self.rows
+
+	def _clear_columns(self, capacity):
+		self.size = 0  # rows in use, including removed ones
+		if self.use_numpy:
+			for name in COLUMNS:
+				setattr(self, name, numpy.empty(max(capacity, 1024), dtype=numpy.int64))
+		else:
+			for name in COLUMNS:
+				setattr(self, name, array.array('q'))
+
+	def nbytes(self):
+		"""return how many bytes the columns take up, not counting the message ID index"""
+		if self.use_numpy:
+			return sum(getattr(self, name).nbytes for name in COLUMNS)
+		return sum(len(getattr(self, name)) * getattr(self, name).itemsize for name in COLUMNS)
+
+	def get_expires(self, message_id):
+		row = self.rows.get(message_id)
+		return None if row is None else int(self.expires[row])
+
+	def channel_of(self, message_id):
+		row = self.rows.get(message_id)
+		return None if row is None else int(self.channel_id[row])
+
+	def add(self, guild_id, channel_id, message_id, expires):
+		"""add a timer expiring at expires (in microseconds), replacing any existing timer for the same message"""
+		row = self.rows.get(message_id)
+		if row is not None:
+			if row == self._soonest and expires > self.expires[row]:
+				self._soonest = None
+			self.expires[row] = expires
+		else:
+			row = self.rows[message_id] = self._append(expires, guild_id, channel_id, message_id)
+
+		if len(self.rows) == 1:
+			self._soonest = row
+		elif self._soonest is not None and expires < self.expires[self._soonest]:
+			self._soonest = row
+
+	def _append(self, *values):
+		row = self.size
+		if self.use_numpy:
+			if row == len(self.expires):
+				for name in COLUMNS:
+					column = getattr(self, name)
+					grown = numpy.empty(len(column) * 2, dtype=numpy.int64)
+					grown[:row] = column[:row]
+					setattr(self, name, grown)
+			for name, value in zip(COLUMNS, values):
+				getattr(self, name)[row] = value
+		else:
+			for name, value in zip(COLUMNS, values):
+				getattr(self, name).append(value)
+		self.size += 1
+		return row
+
+	def remove(self, message_id):
+		"""remove a timer. return whether it was present."""
+		row = self.rows.pop(message_id, None)
+		if row is None:
+			return False
+		self._remove_row(row)
+		self._maybe_compact()
+		return True
+
+	def _remove_row(self, row):
+		self.expires[row] = REMOVED
+		if row == self._soonest:
+			self._soonest = None
+
+	def remove_channels(self, channel_ids):
+		"""remove every timer in the given channels. return how many were removed."""
+		channel_ids = set(channel_ids)
+		if self.use_numpy:
+			size = self.size
+			doomed = numpy.flatnonzero(
+				numpy.isin(self.channel_id[:size], list(channel_ids)) & (self.expires[:size] != REMOVED)).tolist()
+		else:
+			channels = self.channel_id
+			expires = self.expires
+			doomed = [row for row in range(self.size) if channels[row] in channel_ids and expires[row] != REMOVED]
+		for row in doomed:
+			del self.rows[int(self.message_id[row])]
+			self._remove_row(row)
+		self._maybe_compact()
+		return len(doomed)
+
+	def soonest(self):
+		"""return (expires, guild_id, channel_id, message_id) of the soonest timer, or None"""
+		if not self.rows:
+			return None
+		if self._soonest is None:
+			if self.use_numpy:
+				self._soonest = int(numpy.argmin(self.expires[:self.size]))
+			else:
+				expires = self.expires
+				self._soonest = min(range(self.size), key=expires.__getitem__)
+		return self._row(self._soonest)
+
+	def _row(self, row):
+		return tuple(int(getattr(self, name)[row]) for name in COLUMNS)
+
+	def take_due(self, before, limit):
+		"""remove up to limit timers expiring no later than before (in microseconds), soonest first.
+		return a mapping of channel ID to (guild ID, [message ID, ...], [expires, ...]) of the removed timers.
+		"""
+		if self.use_numpy:
+			size = self.size
+			due = numpy.flatnonzero(self.expires[:size] <= before)
+			# the last key sorts first
+			order = numpy.lexsort((self.message_id[due], self.channel_id[due], self.expires[due]))
+			due = due[order[:limit]]
+			taken = zip(*(getattr(self, name)[due].tolist() for name in COLUMNS))
+		else:
+			expires = self.expires
+			due = [row for row in range(self.size) if expires[row] <= before]
+			# (expires, channel_id, message_id), as with NumPy
+			taken = sorted((self._row(row) for row in due), key=lambda row: (row[0], row[2], row[3]))[:limit]
+			due = [self.rows[message_id] for *_, message_id in taken]
+
+		grouped = {}
+		for expires, guild_id, channel_id, message_id in taken:
+			try:
+				_, message_ids, expirations = grouped[channel_id]
+			except KeyError:
+				_, message_ids, expirations = grouped[channel_id] = guild_id, [], []
+			message_ids.append(message_id)
+			expirations.append(expires)
+			del self.rows[message_id]
+
+		if self.use_numpy:
+			self.expires[due] = REMOVED
+		else:
+			for row in due:
+				self.expires[row] = REMOVED
+		self._soonest = None
+		self._maybe_compact()
+		return grouped
+
+	def _maybe_compact(self):
+		if self.size < 1024 or len(self.rows) * 2 > self.size:
+			return
+
+		old = {name: getattr(self, name) for name in COLUMNS}
+		if self.use_numpy:
+			live = numpy.flatnonzero(old['expires'][:self.size] != REMOVED)
+			self._clear_columns(len(live) * 2)
+			for name in COLUMNS:
+				getattr(self, name)[:len(live)] = old[name][live]
+			self.size = len(live)
+			messages = self.message_id[:self.size].tolist()
+		else:
+			live = [row for row in range(self.size) if old['expires'][row] != REMOVED]
+			self._clear_columns(0)
+			for name in COLUMNS:
+				getattr(self, name).extend(old[name][row] for row in live)
+			self.size = len(live)
+			messages = self.message_id.tolist()
+		self.rows = dict(zip(messages, range(self.size)))
+		self._soonest = None